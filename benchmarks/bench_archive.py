@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Measure archive time and size for each archive codec on a synthetic application tree.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_archive.py [--size-mb 100] [--files 2000] [--binary-ratio 0.3]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from mordor.libs import AppConfig
+from mordor.libs.compression import ArchiveCodec
+
+SOURCE_LINES = [
+    "import os\n",
+    "def handler(request, context):\n",
+    "    return {'status': 200, 'body': request.get('body', '')}\n",
+    "# configuration for the service, see README for details\n",
+    "class Worker(object):\n",
+    "    def run(self, *args, **kwargs):\n",
+    "        raise NotImplementedError()\n",
+]
+
+
+def create_tree(home_dir: str, size_mb: int, file_count: int, binary_ratio: float) -> None:
+    rnd = random.Random(0)
+    os.makedirs(home_dir)
+    with open(os.path.join(home_dir, "manifest.yaml"), "wt") as f:
+        f.write("version: 0.0.1\n")
+    file_size = size_mb * 1024 * 1024 // file_count
+    for i in range(file_count):
+        sub_dir = os.path.join(home_dir, f"pkg{i % 20}")
+        os.makedirs(sub_dir, exist_ok=True)
+        if rnd.random() < binary_ratio:
+            with open(os.path.join(sub_dir, f"blob{i}.bin"), "wb") as f:
+                f.write(rnd.randbytes(file_size) if hasattr(rnd, "randbytes") else os.urandom(file_size))
+        else:
+            with open(os.path.join(sub_dir, f"module{i}.py"), "wt") as f:
+                written = 0
+                while written < file_size:
+                    line = rnd.choice(SOURCE_LINES)
+                    f.write(line)
+                    written += len(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Archive codec benchmark")
+    parser.add_argument("--size-mb", type=int, default=100, help="total size of the synthetic tree")
+    parser.add_argument("--files", type=int, default=2000, help="number of files in the synthetic tree")
+    parser.add_argument("--binary-ratio", type=float, default=0.3, help="ratio of incompressible files")
+    parser.add_argument(
+        "--codecs", type=str, nargs="+",
+        default=["none", "gzip:1", "gzip:6", "zstd:1", "zstd:3", "zstd:9"],
+        help="codecs to measure, in form of name:level"
+    )
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        home_dir = os.path.join(temp_dir, "app")
+        create_tree(home_dir, args.size_mb, args.files, args.binary_ratio)
+        app = AppConfig("bench", {"home_dir": home_dir, "deploy_to": []})
+        file_manifest = app.create_file_manifest()
+        tree_size = sum(
+            os.path.getsize(app.path(name)) for (name, value) in file_manifest.items()
+            if value != "dir" and not value.startswith("symlink:")
+        )
+
+        print(f"tree: {len(file_manifest)} entries, {tree_size/1024/1024:.1f} MB")
+        print(f"{'codec':<15} {'time(s)':>8} {'size(MB)':>9} {'ratio':>6} {'MB/s':>7}")
+        for codec_spec in args.codecs:
+            name, _, level = codec_spec.partition(":")
+            app.archive_codec = ArchiveCodec(name, int(level) if level else None)
+            archive_filename = os.path.join(temp_dir, app.archive_filename)
+            start_time = time.time()
+            with open(archive_filename, "wb") as f:
+                app.write_archive(f, file_manifest)
+            duration = time.time() - start_time
+            size = os.path.getsize(archive_filename)
+            os.remove(archive_filename)
+            print(
+                f"{app.archive_codec.cache_id:<15} {duration:8.2f} {size/1024/1024:9.1f} "
+                f"{size/tree_size:6.2f} {tree_size/1024/1024/duration:7.1f}"
+            )
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
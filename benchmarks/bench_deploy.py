@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Measure init-host, stage, stage --config-only, stage --update-venv and run on a simulated fleet.
+
+Every host of the fleet is a local directory used as env_home. ssh and scp are replaced by the
+stand-ins in benchmarks/fake_fleet, which run everything on the local machine, so no sshd is
+needed. The numbers show the overhead mordor adds as the fleet grows, not network costs.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_deploy.py [--hosts 1 4 16] [--size-mb 20] [--files 500] [--parallel 0]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+from bench_archive import create_tree
+
+FAKE_FLEET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_fleet")
+
+DISPATCH_PY = """\
+import sys
+
+for i in range(10):
+    print(f"{sys.argv[1:]} line {i}")
+"""
+
+
+def create_fleet(base_dir: str, host_count: int, size_mb: int, file_count: int) -> None:
+    """ Create the config, the application and the hosts for a fleet
+
+    :param base_dir: everything is created in this directory
+    :param host_count: number of hosts
+    :param size_mb: total size of the application
+    :param file_count: number of files in the application
+    :return: Nothing
+    """
+    home_dir = os.path.join(base_dir, "app")
+    create_tree(home_dir, size_mb, file_count, 0.3)
+    with open(os.path.join(home_dir, "requirements.txt"), "wt") as f:
+        f.write("# no packages\n")
+    with open(os.path.join(home_dir, "dispatch.py"), "wt") as f:
+        f.write(DISPATCH_PY)
+
+    config_dir = os.path.join(base_dir, "config")
+    os.makedirs(os.path.join(config_dir, "configs", "bench"))
+    with open(os.path.join(config_dir, "configs", "bench", "app.json"), "wt") as f:
+        f.write('{"host": "{{ host_name }}", "log_dir": "{{ log_dir }}", "revision": 0}\n')
+    config = {
+        "hosts": {
+            f"h{i}": {"env_home": os.path.join(base_dir, "fleet", f"h{i}")} for i in range(host_count)
+        },
+        "deployments": {
+            "bench_beta": {
+                "name": "bench",
+                "stage": "beta",
+                "home_dir": home_dir,
+                "deploy_to": [f"h{i}" for i in range(host_count)],
+                "config": {"app.json": "template"},
+            }
+        }
+    }
+    with open(os.path.join(config_dir, "config.json"), "wt") as f:
+        json.dump(config, f, indent=4)
+
+    bin_dir = os.path.join(base_dir, "bin")
+    shutil.copytree(FAKE_FLEET_DIR, bin_dir)
+    os.makedirs(os.path.join(base_dir, "home"))
+
+
+def run_mordor(base_dir: str, args: List[str]) -> Tuple[float, List[dict]]:
+    """ Run mordor against the fleet
+
+    :param base_dir: the fleet directory, see create_fleet
+    :param args: mordor command line args
+    :return: tuple, wall clock time in seconds, and the trace events
+    """
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(base_dir, "bin") + os.pathsep + env["PATH"]
+    # init_host.sh writes to ~/.bashrc
+    env["HOME"] = os.path.join(base_dir, "home")
+    env["MORDOR_CACHE_DIR"] = os.path.join(base_dir, "cache")
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    trace_filename = os.path.join(base_dir, "trace.json")
+
+    start_time = time.time()
+    p = subprocess.run(
+        [sys.executable, "-m", "mordor.mordor"] + args + [
+            "-c", os.path.join(base_dir, "config"),
+            "--trace-file", trace_filename,
+        ],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT
+    )
+    duration = time.time() - start_time
+    if p.returncode != 0:
+        print(p.stdout.decode("utf-8", errors="replace"))
+        raise Exception(f"mordor {' '.join(args)} failed with exit code {p.returncode}")
+    with open(trace_filename, "rt") as f:
+        trace = json.load(f)
+    return duration, [event["args"] for event in trace["traceEvents"] if event["ph"] == "X"]
+
+
+def get_host_latencies(events: List[dict]) -> List[float]:
+    # time from the first to the last phase of every host
+    spans = {}  # host name -> (start, end)
+    for event in events:
+        if event["host"] is None:
+            continue
+        start, end = spans.get(event["host"], (event["start"], event["start"]))
+        spans[event["host"]] = (min(start, event["start"]), max(end, event["start"] + event["duration"]))
+    return sorted(end - start for (start, end) in spans.values())
+
+
+def bump_config(base_dir: str, revision: int) -> None:
+    filename = os.path.join(base_dir, "config", "configs", "bench", "app.json")
+    with open(filename, "wt") as f:
+        f.write('{"host": "{{ host_name }}", "log_dir": "{{ log_dir }}", "revision": %d}\n' % revision)
+
+
+def bump_requirements(base_dir: str, revision: int) -> None:
+    # a new requirements digest, so a new virtual environment is created
+    with open(os.path.join(base_dir, "app", "requirements.txt"), "wt") as f:
+        f.write(f"# no packages, revision {revision}\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Deployment benchmark on a simulated fleet")
+    parser.add_argument("--hosts", type=int, nargs="+", default=[1, 4, 16], help="fleet sizes to measure")
+    parser.add_argument("--size-mb", type=int, default=20, help="total size of the synthetic application")
+    parser.add_argument("--files", type=int, default=500, help="number of files in the synthetic application")
+    parser.add_argument("--parallel", type=int, default=0, help="hosts to work on concurrently, 0 for all hosts")
+    parser.add_argument("--skip-venv", action="store_true", help="do not measure stage --update-venv")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<22} {'hosts':>5} {'wall(s)':>8} {'host p50(s)':>12} {'host max(s)':>12} {'MB/s':>8}")
+    for host_count in args.hosts:
+        base_dir = tempfile.mkdtemp()
+        try:
+            create_fleet(base_dir, host_count, args.size_mb, args.files)
+            host_names = [f"h{i}" for i in range(host_count)]
+            parallel = ["--parallel", str(args.parallel or host_count)]
+
+            scenarios = [
+                ("init-host", None, ["init-host", "-o"] + host_names + parallel),
+                ("stage", None, ["stage", "-p", "bench", "-s", "beta"] + parallel),
+                ("stage --config-only", lambda: bump_config(base_dir, 1),
+                    ["stage", "-p", "bench", "-s", "beta", "--config-only"] + parallel),
+            ]
+            if not args.skip_venv:
+                scenarios.append(("stage --update-venv", lambda: bump_requirements(base_dir, 1),
+                    ["stage", "-p", "bench", "-s", "beta", "--update-venv", "--wheelhouse"] + parallel))
+            scenarios.append(("run", None, ["run", "-p", "bench", "-s", "beta", "--cmd", "hello"] + parallel))
+
+            for (name, prepare, mordor_args) in scenarios:
+                if prepare is not None:
+                    prepare()
+                duration, events = run_mordor(base_dir, mordor_args)
+                latencies = get_host_latencies(events) or [0.0]
+                byte_count = sum(event["bytes"] or 0 for event in events)
+                print(
+                    f"{name:<22} {host_count:5d} {duration:8.2f} {latencies[len(latencies)//2]:12.2f} "
+                    f"{latencies[-1]:12.2f} {byte_count/1024/1024/duration:8.1f}"
+                )
+        finally:
+            shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Measure cold start time and number of imported modules for common entry points.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_startup.py [--runs 10]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Tuple
+
+# every scenario reports its module count from an atexit hook, so it works even when
+# the command exits with SystemExit (e.g., --help)
+PRELUDE = (
+    "import sys, atexit\n"
+    "atexit.register(lambda: sys.stderr.write('MODULES=%d\\n' % len(sys.modules)))\n"
+)
+
+SCENARIOS = [
+    ("python -c pass", ""),
+    ("mordor --help", "sys.argv = ['mordor', '--help']\nfrom mordor.mordor import main\nmain()\n"),
+    ("mordor run", "sys.argv = ['mordor', 'run', '-c', {config_dir!r}, '-p', 'missing']\nfrom mordor.mordor import main\nmain()\n"),
+    ("from mordor import AppEnv", "from mordor import AppEnv\n"),
+]
+
+
+def run_once(code: str) -> Tuple[float, int]:
+    start_time = time.time()
+    p = subprocess.run(
+        [sys.executable, "-c", PRELUDE + code],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+    duration = time.time() - start_time
+    module_count = 0
+    for line in p.stderr.decode("utf-8").splitlines():
+        if line.startswith("MODULES="):
+            module_count = int(line[len("MODULES="):])
+    return duration, module_count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Startup benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="number of runs per scenario, best one is reported")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        config_dir = os.path.join(temp_dir, "config")
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, "config.yaml"), "wt") as f:
+            f.write("hosts: {}\ndeployments: {}\n")
+
+        print(f"{'scenario':<28} {'best(ms)':>9} {'median(ms)':>11} {'modules':>8}")
+        for (name, code) in SCENARIOS:
+            code = code.format(config_dir=config_dir)
+            durations = []
+            for _ in range(args.runs):
+                duration, module_count = run_once(code)
+                durations.append(duration)
+            durations.sort()
+            print(
+                f"{name:<28} {durations[0]*1000:9.1f} {durations[len(durations)//2]*1000:11.1f} {module_count:8d}"
+            )
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,7 @@ def main():
     action = args.action[0]
 
     app_env = AppEnv("sample")
-    context = app_env.get_config("_deployment.json")
+    context = dict(app_env.get_config("_deployment.json"))
     docker = app_env.get_config("docker.json")
     docker_app_env = AppEnv(app_env.app_name, version=app_env.version, env_home=docker["env_home"])
     context.update({
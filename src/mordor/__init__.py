@@ -1 +1,2 @@
+# app_env only imports light modules, so "import mordor" stays cheap for dispatch.py
 from .app_env import AppEnv, process_templates, prepare_for_docker
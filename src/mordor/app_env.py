@@ -1,14 +1,46 @@
 import os
 import json
-import yaml
-import glob
-import shutil
-import importlib
-from copy import deepcopy
-from typing import Optional
-from jinja2 import Template
-from .libs.tools import get_config
+import stat
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from .libs.tools import get_config, get_json, get_yaml
 from .libs.app_manifest import AppManifest
+from .libs.read_only import freeze
+
+# build record of process_templates, in the data dir of the application
+TEMPLATES_RECORD_FILENAME = ".mordor_templates.json"
+
+# templates rendered concurrently by process_templates
+TEMPLATE_WORKERS = 8
+
+# parsed manifests and configs shared by the process,
+# key is the real path, value is (stat key, read only value)
+_file_cache: Dict[str, Tuple[tuple, Any]] = {}
+_file_cache_lock = threading.Lock()
+
+
+def load_cached(filename: str, loader: Callable[[str], Any] = get_config) -> Any:
+    """ Load a json or yaml file, the parsed value is cached for the process
+
+    The cache is keyed by the real path of the file, its mtime, size and inode, so a file changed
+    in place, or a new version made current by a stage, is loaded again.
+
+    :param filename: the file location
+    :param loader: parses the file
+    :return: read only view of the parsed value, see mordor.libs.read_only
+    """
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    with _file_cache_lock:
+        entry = _file_cache.get(path)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    value = freeze(loader(path))
+    with _file_cache_lock:
+        _file_cache[path] = (key, value)
+    return value
+
 
 class AppEnv:
     def __init__(self, app_name: str, version:Optional[str] = None, env_home:Optional[str] = None):
@@ -22,17 +54,20 @@ class AppEnv:
                 os.path.join(app_base_dir, "manifest.yaml"),
                 os.path.join(app_base_dir, "manifest.json"),
             ]
-            app_manifest = None
             for manifest_filename in manifest_filenames:
                 if os.path.isfile(manifest_filename):
-                    app_manifest = AppManifest(get_config(manifest_filename))
+                    self._manifest = AppManifest(load_cached(manifest_filename))
                     break
-            if app_manifest is None:
+            if self._manifest is None:
                 raise Exception("Missing manifest")
-            self.version = app_manifest.version
+            self.version = self._manifest.version
         else:
             self.version = version
 
+    def __repr__(self) -> str:
+        # stable, so template contexts holding an AppEnv have a stable digest
+        return f"AppEnv({self.app_name!r}, version={self.version!r}, env_home={self.env_home!r})"
+
     @property
     def app_dir(self) -> str:
         return os.path.join(self.env_home, "apps", self.app_name, self.version)
@@ -57,19 +92,20 @@ class AppEnv:
     def venv_dir(self) -> str:
         return os.path.join(self.env_home, "venvs", f"{self.app_name}-{self.version}")
 
+    # configs are cached for the process and returned as read only views, use dict(config)
+    # or copy.deepcopy(config) to get a copy you can modify
+
     def get_json_config(self, filename: str):
         full_path = os.path.join(
             self.env_home, "configs", self.app_name, filename
         )
-        with open(full_path, "r") as f:
-            return json.load(f)
+        return load_cached(full_path, get_json)
 
     def get_yaml_config(self, filename: str):
         full_path = os.path.join(
             self.env_home, "configs", self.app_name, filename
         )
-        with open(full_path, "r") as f:
-            return yaml.safe_load(f)
+        return load_cached(full_path, get_yaml)
 
     def get_config(self, filename: str):
         if filename.endswith(".json"):
@@ -78,65 +114,307 @@ class AppEnv:
             return self.get_yaml_config(filename)
         assert False, "Only json or yaml are supported"
 
-def deltree(p:str) -> None:
+def deltree(p:str, keep: Optional[List[str]] = None) -> None:
     """ Delete everything inside a directory
 
     :param p: directory location
+    :param keep: names in the directory not to delete
     :return: Nothing
     """
+    import glob
+    import shutil
+
     files = []
     files.extend(glob.glob(os.path.join(p, ".*"), recursive=False))
     files.extend(glob.glob(os.path.join(p, "*"), recursive=False))
     for file in files:
+        if keep is not None and os.path.basename(file) in keep:
+            continue
         if os.path.isfile(file):
             os.remove(file)
         elif os.path.isdir(file):
             shutil.rmtree(file)
 
 
-def prepare_for_docker(app_name: str, context: dict = {}) -> None:
+def sync_tree(src_dir: str, dst_dir: str, exclude: Optional[List[str]] = None) -> None:
+    """ Make dst_dir the same as src_dir, only touching what differs
+
+    Files are hardlinked if the file system allows, otherwise copied with their mtime, so
+    unchanged files keep their mtime. Entries in dst_dir not in src_dir are deleted.
+
+    :param src_dir: the source directory
+    :param dst_dir: the destination directory, created if needed
+    :param exclude: names at the top level of src_dir to skip
+    :return: Nothing
+    """
+    import shutil
+
+    os.makedirs(dst_dir, exist_ok=True)
+    dst_names = set(os.listdir(dst_dir))
+    for name in sorted(os.listdir(src_dir)):
+        if exclude is not None and name in exclude:
+            continue
+        dst_names.discard(name)
+        src_path = os.path.join(src_dir, name)
+        dst_path = os.path.join(dst_dir, name)
+        src_st = os.lstat(src_path)
+        try:
+            dst_st = os.lstat(dst_path)
+        except FileNotFoundError:
+            dst_st = None
+
+        if stat.S_ISDIR(src_st.st_mode):
+            if dst_st is not None and not stat.S_ISDIR(dst_st.st_mode):
+                os.remove(dst_path)
+            sync_tree(src_path, dst_path)
+            continue
+
+        if stat.S_ISLNK(src_st.st_mode):
+            target = os.readlink(src_path)
+            if dst_st is not None and stat.S_ISLNK(dst_st.st_mode) and os.readlink(dst_path) == target:
+                continue
+            _remove_path(dst_path, dst_st)
+            os.symlink(target, dst_path)
+            continue
+
+        if dst_st is not None and stat.S_ISREG(dst_st.st_mode) and (
+            (dst_st.st_ino, dst_st.st_dev) == (src_st.st_ino, src_st.st_dev) or (
+                dst_st.st_size == src_st.st_size and
+                dst_st.st_mtime_ns == src_st.st_mtime_ns and
+                dst_st.st_mode == src_st.st_mode
+            )
+        ):
+            # same file, or a copy of it
+            continue
+        _remove_path(dst_path, dst_st)
+        try:
+            os.link(src_path, dst_path)
+        except OSError:
+            # e.g., different file systems
+            shutil.copy2(src_path, dst_path, follow_symlinks=False)
+
+    for name in dst_names:
+        dst_path = os.path.join(dst_dir, name)
+        _remove_path(dst_path, os.lstat(dst_path))
+
+
+def _remove_path(path: str, st: Optional[os.stat_result]) -> None:
+    import shutil
+
+    if st is None:
+        return
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def get_tree_digest(dir_name: str, state_filename: str) -> str:
+    """ Return the sha256 of a directory tree, covering names, types, modes and file content
+
+    File digests are kept in state_filename, and only computed again for files whose size,
+    mtime or inode changed.
+
+    :param dir_name: the directory
+    :param state_filename: file to keep the file digests in, it must not be inside dir_name
+    :return: sha256 hex digest
+    """
+    import hashlib
+    from .libs.tools import file_digest
+
+    try:
+        with open(state_filename, "rt") as f:
+            prev_state = json.load(f)
+    except (OSError, ValueError):
+        prev_state = {}
+
+    state = {}
+    entries = []
+    for (root, dir_names, file_names) in os.walk(dir_name):
+        dir_names.sort()
+        for name in sorted(dir_names + file_names):
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, dir_name)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                entries.append([rel_path, "symlink", os.readlink(path)])
+            elif stat.S_ISDIR(st.st_mode):
+                entries.append([rel_path, "dir"])
+            else:
+                key = [st.st_size, st.st_mtime_ns, st.st_ino]
+                prev = prev_state.get(rel_path)
+                digest = prev[1] if prev is not None and prev[0] == key else file_digest(path)
+                state[rel_path] = [key, digest]
+                entries.append([rel_path, oct(stat.S_IMODE(st.st_mode)), digest])
+
+    try:
+        with open(state_filename, "wt") as f:
+            json.dump(state, f)
+    except OSError:
+        # digests are computed again next time
+        pass
+    return hashlib.sha256(json.dumps(entries).encode("utf-8")).hexdigest()
+
+
+def prepare_for_docker(app_name: str, context: dict = {}) -> str:
+    """ Prepare the docker build context in data/<app>/docker
+
+    Templates in the docker directory of the application are rendered into it, and the
+    application is synced into data/<app>/docker/app, only changed files are touched so docker
+    can reuse its build cache.
+
+    :param app_name: application name
+    :param context: extra context for the templates
+    :return: sha256 hex digest of the build context
+    """
     app_env = AppEnv(app_name)
-    _context = app_env.get_config("_deployment.json")
+    _context = dict(app_env.get_config("_deployment.json"))
     _context.update(context)
-    process_templates(app_name, "docker", _context)
-    app_docker_dir = os.path.join(app_env.data_dir, "docker", "app")
-    if os.path.isdir(app_docker_dir):
-        shutil.rmtree(app_docker_dir)
-    def to_ignore(dir_name, contents):
-        if dir_name == app_env.app_dir:
-            return ['docker']
-        else:
-            return []
-    shutil.copytree(
-        os.path.join(app_env.app_dir),
-        app_docker_dir,
-        symlinks=True,
-        ignore=to_ignore
-    )
+    process_templates(app_name, "docker", _context, keep=["app"])
+    docker_dir = os.path.join(app_env.data_dir, "docker")
+    sync_tree(app_env.app_dir, os.path.join(docker_dir, "app"), exclude=["docker"])
+    return get_tree_digest(docker_dir, os.path.join(app_env.data_dir, ".docker_digests.json"))
+
 
+def get_context_digest(context: dict) -> Optional[str]:
+    """ Return the digest of a template context
 
-def process_templates(app_name: str, template_dir: str, context: dict) -> None:
+    Values json does not support are represented by repr(), objects without a stable repr()
+    give a different digest every time, so templates using them are always rendered.
+
+    :param context: the template context
+    :return: sha256 hex digest, None if the context cannot be represented
+    """
+    import hashlib
+
+    def to_json(value):
+        if isinstance(value, (set, frozenset)):
+            return sorted(repr(item) for item in value)
+        return repr(value)
+
+    try:
+        text = json.dumps(context, sort_keys=True, default=to_json)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def process_templates(app_name: str, template_dir: str, context: dict, keep: Optional[List[str]] = None) -> None:
     """ Process template directory, result stored in data dir
 
+    What was produced is recorded in data/<app>/.mordor_templates.json, with the digest of
+    every source file and of the context it is rendered with. Next time, only outputs whose
+    source or context changed, or which were modified, are produced again, and outputs whose
+    source is removed are deleted.
+
     :param app_name: application name
     :param template_dir: the relative path name of the template directory, relative to the app home
     :param context: the context we need to bind to
+    :param keep: names at the top level of the destination directory not to delete
     :return: Nothing
     """
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+    from .libs.tools import file_digest
 
     app_env = AppEnv(app_name)
     src_dir = os.path.join(app_env.app_dir)
     dst_dir = os.path.join(app_env.data_dir)
+    record_filename = os.path.join(dst_dir, TEMPLATES_RECORD_FILENAME)
 
     dst_template_dir = os.path.join(dst_dir, template_dir)
     os.makedirs(dst_template_dir, exist_ok=True)
-    deltree(dst_template_dir)
+    records = _load_templates_record(record_filename)
+    prev_record = records.get(template_dir)
+    if prev_record is None:
+        # we do not know what an earlier run produced
+        deltree(dst_template_dir, keep=keep)
+        prev_record = {"dirs": [], "outputs": {}}
 
-    process_templates_dir(src_dir, dst_dir, template_dir, context)
+    dir_names = []  # type: List[str]
+    jobs = []       # type: List[Tuple[str, str, Optional[dict], Optional[str]]]
+    _collect_template_jobs(src_dir, template_dir, context, dir_names, jobs)
+
+    outputs = {}
+    to_produce = []
+    for (src_name, dst_name, local_context, context_digest) in jobs:
+        output = {
+            "source": file_digest(os.path.join(src_dir, src_name)),
+            "context": context_digest,
+        }
+        prev_output = prev_record["outputs"].get(dst_name)
+        if prev_output is not None and prev_output["context"] is not None and \
+                (prev_output["source"], prev_output["context"]) == (output["source"], output["context"]) and \
+                prev_output["stat"] == _get_stat_key(os.path.join(dst_dir, dst_name)):
+            outputs[dst_name] = prev_output
+        else:
+            to_produce.append((src_name, dst_name, local_context, output))
+
+    dst_names = set(job[1] for job in jobs)
+    for dst_name in prev_record["outputs"]:
+        if dst_name not in dst_names:
+            if os.path.lexists(os.path.join(dst_dir, dst_name)):
+                os.remove(os.path.join(dst_dir, dst_name))
+    for dir_name in sorted(set(prev_record["dirs"]) - set(dir_names), reverse=True):
+        shutil.rmtree(os.path.join(dst_dir, dir_name), ignore_errors=True)
+    for dir_name in dir_names:
+        os.makedirs(os.path.join(dst_dir, dir_name), exist_ok=True)
+
+    def produce(job):
+        (src_name, dst_name, local_context, output) = job
+        _produce_template_output(
+            os.path.join(src_dir, src_name), os.path.join(dst_dir, dst_name), local_context
+        )
+        output["stat"] = _get_stat_key(os.path.join(dst_dir, dst_name))
+        return (dst_name, output)
+
+    if to_produce:
+        # templates are independent of each other
+        with ThreadPoolExecutor(max_workers=min(TEMPLATE_WORKERS, len(to_produce))) as executor:
+            for (dst_name, output) in executor.map(produce, to_produce):
+                outputs[dst_name] = output
+
+    records[template_dir] = {"dirs": dir_names, "outputs": dict(sorted(outputs.items()))}
+    with open(record_filename + ".tmp", "wt") as f:
+        json.dump(records, f, indent=4)
+    os.replace(record_filename + ".tmp", record_filename)
+
+
+def _load_templates_record(filename: str) -> dict:
+    try:
+        with open(filename, "rt") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _get_stat_key(filename: str) -> Optional[List[int]]:
+    try:
+        st = os.lstat(filename)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def _collect_template_jobs(
+    src_base_dir: str, template_dir: str, context: dict,
+    dir_names: List[str], jobs: List[Tuple[str, str, Optional[dict], Optional[str]]]
+) -> None:
+    """ Find what to produce for a template directory and its sub directories
+
+    :param src_base_dir: the application directory
+    :param template_dir: the template directory, relative to src_base_dir
+    :param context: the context from the parent directory
+    :param dir_names: template_dir and its sub directories are appended to it
+    :param jobs: (source name, output name, context, context digest) is appended for every
+        file, names are relative, context is None for files which are copied
+    :return: Nothing
+    """
+    import importlib
+    from copy import deepcopy
 
-def process_templates_dir(src_base_dir:str, dst_base_dir:str, template_dir: str, context: dict):
     src_dir = os.path.join(src_base_dir, template_dir)
-    dst_dir = os.path.join(dst_base_dir, template_dir)
+    dir_names.append(template_dir)
 
     if os.path.isfile(os.path.join(src_dir, "context.py")):
         module = importlib.import_module(
@@ -146,23 +424,33 @@ def process_templates_dir(src_base_dir:str, dst_base_dir:str, template_dir: str,
         local_context = get_context(deepcopy(context))
     else:
         local_context = context
+    context_digest = None
 
-    for file in os.listdir(src_dir):
+    for file in sorted(os.listdir(src_dir)):
         if file in ("context.py", "__pycache__"):
             continue
-        src_filename = os.path.join(src_dir, file)
+        src_name = os.path.join(template_dir, file)
+        src_filename = os.path.join(src_base_dir, src_name)
 
         if os.path.isfile(src_filename):
             if src_filename.endswith(".template"):
-                with open(src_filename, "rt") as rf:
-                    template = Template(rf.read())
-                    dst_filename = os.path.join(dst_dir, file[:-9]) # remove .template
-                    with open(dst_filename, "wt") as wf:
-                        wf.write(template.render(local_context))
+                if context_digest is None:
+                    context_digest = get_context_digest(local_context)
+                jobs.append((src_name, src_name[:-9], local_context, context_digest)) # remove .template
             else:
-                dst_filename = os.path.join(dst_dir, file)
-                shutil.copyfile(src_filename, dst_filename)
+                jobs.append((src_name, src_name, None, "copy"))
         elif os.path.isdir(src_filename):
-            sub_template_dir = os.path.join(template_dir, file)
-            os.makedirs(os.path.join(dst_base_dir, sub_template_dir), exist_ok=False)
-            process_templates_dir(src_base_dir, dst_base_dir, sub_template_dir, local_context)
+            _collect_template_jobs(src_base_dir, src_name, local_context, dir_names, jobs)
+
+
+def _produce_template_output(src_filename: str, dst_filename: str, context: Optional[dict]) -> None:
+    import shutil
+    from jinja2 import Template
+
+    if context is None:
+        shutil.copyfile(src_filename, dst_filename)
+        return
+    with open(src_filename, "rt") as rf:
+        template = Template(rf.read())
+    with open(dst_filename, "wt") as wf:
+        wf.write(template.render(context))
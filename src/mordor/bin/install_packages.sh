@@ -4,17 +4,27 @@
 # $2: app name
 # $3: version
 # $4: requirement.txt filename
+# $5: optional, wheelhouse directory, if specified, packages are installed from it without package index
+
+# fail if any install fails, mordor marks the venv complete only on success
+set -e
 
 source $1/venvs/$2-$3/bin/activate
-python -m pip -q install --upgrade pip setuptools
-python -m pip -q install wheel
+if [ -z "$5" ]
+then
+    python -m pip -q install --upgrade pip setuptools
+    python -m pip -q install wheel
+    PIP_OPTIONS=""
+else
+    PIP_OPTIONS="--no-index --find-links $5"
+fi
 
 if [ -e $1/apps/$2/$3/requirements_pre.txt ]
 then
-    python -m pip -q install -r $1/apps/$2/$3/requirements_pre.txt
+    python -m pip -q install $PIP_OPTIONS -r $1/apps/$2/$3/requirements_pre.txt
 fi
 if [ -e $1/apps/$2/$3/$4 ]
 then
-    python -m pip -q install -r $1/apps/$2/$3/$4
+    python -m pip -q install $PIP_OPTIONS -r $1/apps/$2/$3/$4
 fi
 deactivate
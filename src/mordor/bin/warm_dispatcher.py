@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Resident dispatcher of an application, it keeps dispatch.py imported so commands start fast
+
+warm_dispatcher.py run <env_home> <app_name> <base64 cmd>
+    Run a command with the resident dispatcher of the application, start the dispatcher if it
+    is not running. The command gets our stdout and stderr, and we exit with its exit code.
+    If the dispatcher cannot be started, fall back to run_dispatcher.sh.
+
+warm_dispatcher.py serve <env_home> <app_name>
+    The resident dispatcher, it runs with the python of the application venv. It loads
+    dispatch.py (without running it as __main__), listens on pids/<app_name>/dispatcher.sock,
+    and forks for every command, so the command finds all imports done. It exits once the
+    current version or the venv of the application changes, or it has been idle for an hour,
+    the next command starts a new one.
+"""
+
+import array
+import base64
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+SOCKET_NAME = "dispatcher.sock"
+PID_NAME = "dispatcher.pid"
+LOCK_NAME = "dispatcher.lock"
+
+# seconds to wait for a new dispatcher to load dispatch.py and listen
+START_TIMEOUT = 60
+# seconds without commands before the dispatcher exits
+IDLE_TIMEOUT = 3600
+# seconds between checks for a new version
+POLL_INTERVAL = 1
+
+# reply of a dispatcher which is about to exit, the client starts a new one
+STALE_REPLY = b"stale"
+
+
+def get_paths(env_home, app_name):
+    pid_dir = os.path.join(env_home, "pids", app_name)
+    return {
+        "app": os.path.join(env_home, "apps", app_name, "current"),
+        "venv": os.path.join(env_home, "venvs", app_name),
+        "socket": os.path.join(pid_dir, SOCKET_NAME),
+        "pid": os.path.join(pid_dir, PID_NAME),
+        "lock": os.path.join(pid_dir, LOCK_NAME),
+        "log": os.path.join(env_home, "logs", app_name, "dispatcher.log"),
+    }
+
+
+def get_exit_code(code):
+    # same as the python interpreter does for SystemExit
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+##########################################################################
+# client
+##########################################################################
+def connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def start_and_connect(paths, env_home, app_name):
+    import fcntl
+    import subprocess
+
+    os.makedirs(os.path.dirname(paths["lock"]), exist_ok=True)
+    os.makedirs(os.path.dirname(paths["log"]), exist_ok=True)
+    with open(paths["lock"], "w") as lock_file:
+        # only one client starts the dispatcher, others wait for it
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        sock = connect(paths["socket"])
+        if sock is not None:
+            return sock
+
+        with open(paths["log"], "ab") as log_file:
+            p = subprocess.Popen(
+                [
+                    os.path.join(paths["venv"], "bin", "python"), "-u",
+                    os.path.abspath(__file__), "serve", env_home, app_name
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=log_file,
+                start_new_session=True
+            )
+        deadline = time.time() + START_TIMEOUT
+        while time.time() < deadline and p.poll() is None:
+            sock = connect(paths["socket"])
+            if sock is not None:
+                return sock
+            time.sleep(0.05)
+        return None
+
+
+def send_command(sock, args):
+    """ Send a command to the dispatcher, with our stdout and stderr
+
+    :return: the reply, exit code of the command or STALE_REPLY
+    """
+    request = json.dumps({"args": args}).encode("utf-8") + b"\n"
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        sock.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [1, 2]))])
+    except OSError:
+        # the dispatcher closed the socket before accepting us, the command did not run
+        sock.close()
+        return STALE_REPLY
+    reply = b""
+    while True:
+        data = sock.recv(1024)
+        if not data:
+            break
+        reply += data
+    sock.close()
+    return reply.strip()
+
+
+def run(env_home, app_name, cmd):
+    paths = get_paths(env_home, app_name)
+    args = base64.b64decode(cmd).decode("utf-8").split()
+
+    # a dispatcher may be going away for a new version, then we start a new one
+    for i in range(2):
+        sock = connect(paths["socket"])
+        if sock is None:
+            sock = start_and_connect(paths, env_home, app_name)
+        if sock is None:
+            break
+        reply = send_command(sock, args)
+        if reply == STALE_REPLY:
+            time.sleep(0.05)
+            continue
+        if not reply:
+            print("warm dispatcher: lost the dispatcher while running the command", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(int(reply))
+
+    print("warm dispatcher: cannot start the dispatcher, see {}".format(paths["log"]), file=sys.stderr)
+    sys.stderr.flush()
+    os.execv(
+        "/bin/bash",
+        ["bash", os.path.join(env_home, "bin", "run_dispatcher.sh"), env_home, app_name, cmd]
+    )
+
+
+##########################################################################
+# server
+##########################################################################
+def get_versions(paths):
+    return (os.path.realpath(paths["app"]), os.path.realpath(paths["venv"]))
+
+
+def receive_command(conn):
+    """ Read a command and the stdout and stderr of the client
+
+    :return: tuple, args and list of file descriptors
+    """
+    fds = array.array("i")
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk, ancdata, flags, address = conn.recvmsg(65536, socket.CMSG_SPACE(2 * fds.itemsize))
+        if not chunk:
+            break
+        data += chunk
+        for (cmsg_level, cmsg_type, cmsg_data) in ancdata:
+            if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    return json.loads(data.decode("utf-8"))["args"], list(fds)
+
+
+def run_command(args, fds):
+    # in the forked child, run dispatch.py as if it is started by run_dispatcher.sh
+    import runpy
+    import traceback
+
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(fds[0], 1)
+    os.dup2(fds[1], 2)
+    for fd in fds + [devnull]:
+        os.close(fd)
+
+    sys.argv = ["dispatch.py"] + args
+    try:
+        runpy.run_path("dispatch.py", run_name="__main__")
+        exit_code = 0
+    except SystemExit as e:
+        exit_code = get_exit_code(e.code)
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        # do not run the exit handlers of the dispatcher
+        os._exit(exit_code)
+
+
+def serve(env_home, app_name):
+    import runpy
+
+    paths = get_paths(env_home, app_name)
+    versions = get_versions(paths)
+    app_dir, venv_dir = versions
+
+    # same environment as run_dispatcher.sh
+    os.environ["ENV_HOME"] = env_home
+    os.environ["VIRTUAL_ENV"] = venv_dir
+    os.environ["PATH"] = os.path.join(venv_dir, "bin") + os.pathsep + os.environ.get("PATH", "")
+    os.chdir(app_dir)
+    sys.path.insert(0, app_dir)
+    # do the imports of dispatch.py, it does not run main since it is not __main__
+    runpy.run_path("dispatch.py", run_name="__mordor_warm__")
+
+    # listen only after dispatch.py is loaded, the socket is replaced atomically
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    temp_socket_path = "{}.{}".format(paths["socket"], os.getpid())
+    server.bind(temp_socket_path)
+    os.chmod(temp_socket_path, 0o600)
+    server.listen(64)
+    os.replace(temp_socket_path, paths["socket"])
+    socket_ino = os.stat(paths["socket"]).st_ino
+    with open(paths["pid"], "w") as f:
+        f.write(str(os.getpid()))
+    print("{} dispatcher {} serving {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), os.getpid(), app_dir))
+
+    # wake up select when a command finishes
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wakeup_w)
+
+    def stop_serving():
+        server.close()
+        try:
+            # a new dispatcher may own the socket already
+            if os.stat(paths["socket"]).st_ino == socket_ino:
+                os.remove(paths["socket"])
+        except FileNotFoundError:
+            pass
+
+    children = {}   # pid -> connection of the client
+    serving = True
+    last_command_time = time.time()
+    while serving or children:
+        readable, _, _ = select.select([server, wakeup_r] if serving else [wakeup_r], [], [], POLL_INTERVAL)
+        if wakeup_r in readable:
+            while True:
+                try:
+                    if not os.read(wakeup_r, 1024):
+                        break
+                except BlockingIOError:
+                    break
+
+        while children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            conn = children.pop(pid, None)
+            if conn is None:
+                continue
+            exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+            try:
+                conn.sendall(str(exit_code).encode("utf-8"))
+            except OSError:
+                # the client is gone
+                pass
+            conn.close()
+
+        if not serving:
+            continue
+        if get_versions(paths) != versions or (not children and time.time() - last_command_time > IDLE_TIMEOUT):
+            stop_serving()
+            serving = False
+            continue
+        if server not in readable:
+            continue
+
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            continue
+        conn.setblocking(True)
+        last_command_time = time.time()
+        try:
+            args, fds = receive_command(conn)
+        except (OSError, ValueError, KeyError):
+            conn.close()
+            continue
+        if get_versions(paths) != versions:
+            for fd in fds:
+                os.close(fd)
+            conn.sendall(STALE_REPLY)
+            conn.close()
+            stop_serving()
+            serving = False
+            continue
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            server.close()
+            conn.close()
+            # other clients wait for EOF on their connection, we must not hold it open
+            for child_conn in children.values():
+                child_conn.close()
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+            run_command(args, fds)
+        for fd in fds:
+            os.close(fd)
+        children[pid] = conn
+
+    try:
+        with open(paths["pid"]) as f:
+            if f.read() == str(os.getpid()):
+                os.remove(paths["pid"])
+    except FileNotFoundError:
+        pass
+    print("{} dispatcher {} exits".format(time.strftime("%Y-%m-%d %H:%M:%S"), os.getpid()))
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "run":
+        run(sys.argv[2], sys.argv[3], sys.argv[4])
+    elif len(sys.argv) == 4 and sys.argv[1] == "serve":
+        serve(sys.argv[2], sys.argv[3])
+    else:
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
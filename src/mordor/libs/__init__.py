@@ -1,5 +1,36 @@
-from .app_config import AppConfig
-from .app_manifest import AppManifest
-from .host_config import HostConfig
-from .config import Config
-from .tools import get_config
+import importlib
+import sys
+
+# name -> submodule, submodules are only imported when a name is first used,
+# so importing one submodule does not pull in the others
+_EXPORTS = {
+    "AppConfig": "app_config",
+    "AppManifest": "app_manifest",
+    "HostConfig": "host_config",
+    "Config": "config",
+    "get_config": "tools",
+    "get_config_cached": "tools",
+    "HostResult": "fleet",
+    "run_on_hosts": "fleet",
+    "print_results": "fleet",
+    "RunResult": "fleet",
+    "run_commands": "fleet",
+    "print_run_results": "fleet",
+    "Tracer": "timing",
+    "get_tracer": "timing",
+}
+
+__all__ = list(_EXPORTS.keys())
+
+
+def __getattr__(name: str):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f".{module_name}", __name__), name)
+
+
+if sys.version_info < (3, 7):
+    # no module __getattr__ (PEP 562) before python 3.7, import everything upfront
+    for _name, _module_name in _EXPORTS.items():
+        globals()[_name] = getattr(importlib.import_module(f".{_module_name}", __name__), _name)
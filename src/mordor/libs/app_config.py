@@ -1,12 +1,80 @@
-from typing import Dict, List
-import subprocess
+from typing import Dict, List, Optional
 import os
-import glob
+import sys
+import json
+import stat
+import shutil
+import hashlib
+import tarfile
 import tempfile
-import platform
+import subprocess
+from fnmatch import fnmatch
 
 from .app_manifest import AppManifest
-from .tools import get_config
+from .artifact_cache import ArtifactCache
+from .compression import ArchiveCodec
+from .tools import get_config_cached, file_digest
+
+
+# per file manifest of an application version, stored in the version directory on host
+FILE_MANIFEST_FILENAME = ".mordor_files.json"
+
+# bump it when write_archive changes, so cached archives are not reused
+ARCHIVE_FORMAT_VERSION = 1
+
+# mtime of every archive entry, use SOURCE_DATE_EPOCH if it is set
+ARCHIVE_MTIME = int(os.environ.get("SOURCE_DATE_EPOCH", "0"))
+
+
+def is_excluded(rel_path: str, exclude_dirs: List[str]) -> bool:
+    """ Check if a path is excluded, same as tar --exclude
+
+    A pattern matches the whole relative path or any trailing part of it that starts at a
+    path component, e.g., "dir_ignore" excludes both "dir_ignore" and "a/dir_ignore".
+
+    :param rel_path: path relative to the application home directory
+    :param exclude_dirs: list of exclude patterns
+    :return: True if the path is excluded
+    """
+    parts = rel_path.split("/")
+    for i in range(len(parts)):
+        sub_path = "/".join(parts[i:])
+        for pattern in exclude_dirs:
+            if fnmatch(sub_path, pattern):
+                return True
+    return False
+
+
+def get_changed_names(prev_file_manifest: Dict[str, str], file_manifest: Dict[str, str]) -> List[str]:
+    """ Get the entries to remove from a copy of the previous version before adding the new files
+
+    An entry is returned if it is changed, added or removed. Entries inside a returned directory
+    are not returned, removing the directory covers them.
+
+    :param prev_file_manifest: per file manifest of the previous version
+    :param file_manifest: per file manifest of the new version
+    :return: list of relative names, sorted
+    """
+    changed = []
+    changed_dirs = set()
+    for name in sorted(set(prev_file_manifest.keys()) | set(file_manifest.keys())):
+        if prev_file_manifest.get(name) == file_manifest.get(name):
+            continue
+        parts = name.split("/")
+        if any("/".join(parts[:i]) in changed_dirs for i in range(1, len(parts))):
+            continue
+        changed.append(name)
+        changed_dirs.add(name)
+    return changed
+
+
+def get_file_manifest_digest(file_manifest: Dict[str, str]) -> str:
+    """ Return the digest of a per file manifest, it changes whenever any file of the application changes
+
+    :param file_manifest: per file manifest of the application, from AppConfig.create_file_manifest
+    :return: sha256 hex digest
+    """
+    return hashlib.sha256(json.dumps(file_manifest, sort_keys=True).encode("utf-8")).hexdigest()
 
 
 class AppConfig:
@@ -19,17 +87,23 @@ class AppConfig:
     def __init__(self, deployment_name: str, app_config: dict):
         self.app_config = app_config
         self.deployment_name = deployment_name
+        self._archive_codec = None
+        self._manifest = None
 
-        self.manifest = None
-        for manifest_filename in [
-            self.path("manifest.yaml"),
-            self.path("manifest.json"),
-        ]:
-            if os.path.isfile(manifest_filename):
-                self.manifest = AppManifest(get_config(manifest_filename))
-                break
-        if self.manifest is None:
-            raise Exception("Missing manifest file")
+    @property
+    def manifest(self) -> AppManifest:
+        # loaded on first access, commands usually only touch one application
+        if self._manifest is None:
+            for manifest_filename in [
+                self.path("manifest.yaml"),
+                self.path("manifest.json"),
+            ]:
+                if os.path.isfile(manifest_filename):
+                    self._manifest = AppManifest(get_config_cached(manifest_filename))
+                    break
+            if self._manifest is None:
+                raise Exception("Missing manifest file")
+        return self._manifest
 
     @property
     def name(self) -> str:
@@ -56,6 +130,11 @@ class AppConfig:
         # config files need to copied over
         return self.app_config.get("config", {})
 
+    @property
+    def wheel_python(self) -> Optional[str]:
+        # python interpreter to build wheels with, it must match the python on hosts
+        return self.app_config.get("wheel_python")
+
     @property
     def deploy_to(self) -> List[str]:
         return self.app_config["deploy_to"]
@@ -63,36 +142,175 @@ class AppConfig:
     def path(self, *args) -> str:
         return os.path.join(self.home_dir, *args)
 
+    @property
+    def archive_codec(self) -> ArchiveCodec:
+        # from manifest, unless it is overridden, e.g., from command line
+        if self._archive_codec is None:
+            return ArchiveCodec(self.manifest.archive_codec, self.manifest.archive_level)
+        return self._archive_codec
+
+    @archive_codec.setter
+    def archive_codec(self, archive_codec: ArchiveCodec) -> None:
+        self._archive_codec = archive_codec
+
     @property
     def archive_filename(self) -> str:
-        return "{}-{}.tar.gz".format(self.name, self.manifest.version)
+        return "{}-{}{}".format(self.name, self.manifest.version, self.archive_codec.extension)
 
     @property
     def venv_name(self) -> str:
         return "{}-{}".format(self.name, self.manifest.version)
 
-    def create_archive(self) -> str:
+    def get_venv_digest(self) -> str:
+        """ Return the digest of what goes into the virtual environment of the application
+
+        :return: sha256 hex digest of requirements_pre.txt and the requirements file
+        """
+        h = hashlib.sha256()
+        for filename in ["requirements_pre.txt", self.requirements]:
+            h.update(filename.encode("utf-8") + b"\0")
+            if os.path.isfile(self.path(filename)):
+                h.update(file_digest(self.path(filename)).encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def create_wheelhouse(self, artifact_cache: ArtifactCache, python: Optional[str] = None) -> str:
+        """ Build wheels for all requirements of the application, or reuse them from the artifact cache
+
+        The wheels are built with "pip wheel", so python must match the python on hosts, e.g.,
+        same version and platform.
+
+        :param artifact_cache: the artifact cache
+        :param python: the python interpreter to build wheels with, default to the current one
+        :return: the filename of an uncompressed tar of all the wheels, in the artifact cache
+        """
+        if python is None:
+            python = sys.executable
+        python_version = subprocess.check_output(
+            [python, "-c", "import sys; print(sys.version)"]
+        ).decode("utf-8")
+        h = hashlib.sha256()
+        h.update(f"wheelhouse\0{self.get_venv_digest()}\0{python_version}".encode("utf-8"))
+        return artifact_cache.get_or_create(
+            h.hexdigest(),
+            "wheelhouse.tar",
+            lambda filename: self._write_wheelhouse(filename, python)
+        )
+
+    def _write_wheelhouse(self, filename: str, python: str) -> None:
         temp_dir = tempfile.mkdtemp()
-        exclude_opts = []
-        for exclude_dir in self.manifest.exclude_dirs:
-            exclude_opts.extend(["--exclude", exclude_dir])
-
-        # macos might generate ._files, use --disable-copyfile to disable it
-        args = ['tar', '--no-xattrs']
-        if platform.system() == "Darwin":
-            args.append("--disable-copyfile")
-        args += exclude_opts + \
-            [
-                '-czf',
-                os.path.join(temp_dir, self.archive_filename),
-                "-C",
-                self.home_dir
+        try:
+            args = [python, "-m", "pip", "-q", "wheel", "-w", temp_dir]
+            requirements = [
+                self.path(name) for name in ["requirements_pre.txt", self.requirements]
+                if os.path.isfile(self.path(name))
             ]
-        files_to_add = glob.glob("{}/*".format(self.home_dir))
-        files_to_add = [item[len(self.home_dir) + 1:] for item in files_to_add]
-        args.extend(files_to_add)
-        subprocess.check_call(args)
-        return os.path.join(temp_dir, self.archive_filename)
+            for requirement in requirements:
+                args.extend(["-r", requirement])
+            if requirements:
+                subprocess.check_call(args)
+            with tarfile.open(filename, mode="w", format=tarfile.GNU_FORMAT) as tar:
+                for name in sorted(os.listdir(temp_dir)):
+                    tar.add(os.path.join(temp_dir, name), arcname=name)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def create_file_manifest(self) -> Dict[str, str]:
+        """ Create the per file manifest of the application, it covers what create_archive covers
+
+        :return: dict, key is the path relative to home_dir, value is "dir" for directory,
+            "symlink:<target>" for symlink and sha256 hex digest for file, with "+x" appended
+            if the file is executable
+        """
+        manifest = {}
+
+        def add(rel_path: str) -> None:
+            full_path = self.path(rel_path)
+            if os.path.islink(full_path):
+                manifest[rel_path] = "symlink:" + os.readlink(full_path)
+            elif os.path.isdir(full_path):
+                manifest[rel_path] = "dir"
+                for name in os.listdir(full_path):
+                    child = f"{rel_path}/{name}"
+                    if not is_excluded(child, self.manifest.exclude_dirs):
+                        add(child)
+            elif os.path.isfile(full_path):
+                executable = os.stat(full_path).st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+                manifest[rel_path] = file_digest(full_path) + ("+x" if executable else "")
+
+        # same as create_archive, hidden entries in home_dir are not included
+        for name in os.listdir(self.home_dir):
+            if not name.startswith(".") and not is_excluded(name, self.manifest.exclude_dirs):
+                add(name)
+        return dict(sorted(manifest.items()))
+
+    def write_archive(self, fileobj, file_manifest: Dict[str, str], names: Optional[List[str]] = None) -> None:
+        """ Write a reproducible archive of the application
+
+        Entries are sorted, mtime, owner and group are normalized, and permissions are
+        normalized to 755 or 644, so the same tree always gives the same bytes.
+
+        :param fileobj: binary file object to write the archive to, it can be a pipe
+        :param file_manifest: per file manifest of the application, from create_file_manifest
+        :param names: if specified, only add these entries (path relative to home_dir)
+        :return: Nothing
+        """
+        if names is None:
+            names = list(file_manifest.keys())
+        with self.archive_codec.open_writer(fileobj) as writer:
+            with tarfile.open(fileobj=writer, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                for name in sorted(names):
+                    value = file_manifest[name]
+                    tar_info = tarfile.TarInfo(name)
+                    tar_info.mtime = ARCHIVE_MTIME
+                    if value == "dir":
+                        tar_info.type = tarfile.DIRTYPE
+                        tar_info.mode = 0o755
+                        tar.addfile(tar_info)
+                    elif value.startswith("symlink:"):
+                        tar_info.type = tarfile.SYMTYPE
+                        tar_info.mode = 0o777
+                        tar_info.linkname = value[len("symlink:"):]
+                        tar.addfile(tar_info)
+                    else:
+                        tar_info.mode = 0o755 if value.endswith("+x") else 0o644
+                        tar_info.size = os.path.getsize(self.path(name))
+                        with open(self.path(name), "rb") as rf:
+                            tar.addfile(tar_info, rf)
+
+    def _write_archive_file(self, archive_filename: str, file_manifest: Dict[str, str]) -> None:
+        with open(archive_filename, "wb") as f:
+            self.write_archive(f, file_manifest)
+
+    def get_archive_key(self, file_manifest: Dict[str, str]) -> str:
+        """ Return the cache key for the archive of the application
+
+        :param file_manifest: per file manifest of the application, from create_file_manifest
+        :return: the key, it changes whenever the archive content would change
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            "format": ARCHIVE_FORMAT_VERSION,
+            "codec": self.archive_codec.cache_id,
+            "exclude_dirs": self.manifest.exclude_dirs,
+            "files": file_manifest,
+        }, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def create_archive(self, artifact_cache: ArtifactCache, file_manifest: Optional[Dict[str, str]] = None) -> str:
+        """ Create the archive of the application, or reuse it from the artifact cache
+
+        :param artifact_cache: the artifact cache
+        :param file_manifest: per file manifest of the application, computed if not specified
+        :return: the archive filename, in the artifact cache
+        """
+        if file_manifest is None:
+            file_manifest = self.create_file_manifest()
+        return artifact_cache.get_or_create(
+            self.get_archive_key(file_manifest),
+            self.archive_filename,
+            lambda archive_filename: self._write_archive_file(archive_filename, file_manifest)
+        )
 
     def to_json(self) -> dict:
         return {
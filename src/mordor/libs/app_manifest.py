@@ -22,9 +22,19 @@ class AppManifest:
     def on_stage(self) -> Optional[str]:
         return self.manifest.get("on_stage")
 
+    @property
+    def archive_codec(self) -> str:
+        return self.manifest.get("archive_codec", "gzip")
+
+    @property
+    def archive_level(self) -> Optional[int]:
+        return self.manifest.get("archive_level")
+
     def to_json(self) -> dict:
         return {
             "on_stage": self.on_stage,
             "version": self.version,
-            "exclude_dirs": self.exclude_dirs
+            "exclude_dirs": self.exclude_dirs,
+            "archive_codec": self.archive_codec,
+            "archive_level": self.archive_level
         }
@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import threading
+from typing import Callable, List, Optional
+
+from .tools import file_digest
+
+
+class ArtifactCache:
+    """Controller side cache for application archives
+
+    Each entry is a directory named by its key, holding the artifact and a .sha256 file
+    with the digest of the artifact. Entries are evicted in least recently used order
+    once the cache goes over its size or entry limit.
+    """
+
+    cache_dir: str   # the directory of the cache
+    max_size: int    # max total size in bytes
+    max_entries: int # max number of entries
+
+    def __init__(self, cache_dir: str, max_size: int = 2*1024*1024*1024, max_entries: int = 32):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key: str, filename: str) -> Optional[str]:
+        """ Get an artifact from the cache
+
+        :param key: the cache key
+        :param filename: the artifact filename
+        :return: the location of the artifact, or None if it is not cached
+        """
+        entry_dir = self._entry_dir(key)
+        path = os.path.join(entry_dir, filename)
+        if not os.path.isfile(path) or not os.path.isfile(path + ".sha256"):
+            return None
+        # mark as recently used
+        os.utime(entry_dir)
+        return path
+
+    def get_or_create(self, key: str, filename: str, create: Callable[[str], None]) -> str:
+        """ Get an artifact from the cache, create it if it is not cached
+
+        :param key: the cache key
+        :param filename: the artifact filename
+        :param create: called with a location to write the artifact to
+        :return: the location of the artifact
+        """
+        with self._lock:
+            path = self.get(key, filename)
+            if path is not None:
+                return path
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # build in a temp dir then rename, so a partial artifact is never seen
+            temp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+            try:
+                temp_path = os.path.join(temp_dir, filename)
+                create(temp_path)
+                with open(temp_path + ".sha256", "wt") as f:
+                    f.write(file_digest(temp_path))
+                entry_dir = self._entry_dir(key)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.rename(temp_dir, entry_dir)
+            except BaseException:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                raise
+
+            self.evict(keep=[key])
+            return os.path.join(entry_dir, filename)
+
+    def evict(self, keep: List[str] = []) -> None:
+        """ Remove least recently used entries until the cache is within its limits
+
+        :param keep: keys that must not be evicted
+        :return: Nothing
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if key.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            size = 0
+            for name in os.listdir(entry_dir):
+                size += os.path.getsize(os.path.join(entry_dir, name))
+            entries.append((os.path.getmtime(entry_dir), key, size))
+
+        # most recently used first
+        entries.sort(reverse=True)
+        total_size = 0
+        for i, (_, key, size) in enumerate(entries):
+            total_size += size
+            if key in keep:
+                continue
+            if i >= self.max_entries or total_size > self.max_size:
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                total_size -= size
+
+
+def get_artifact_digest(path: str) -> str:
+    """ Return the sha256 digest of an artifact in the cache
+
+    :param path: the location of the artifact
+    :return: sha256 hex digest
+    """
+    with open(path + ".sha256", "rt") as f:
+        return f.read().strip()
@@ -0,0 +1,214 @@
+import io
+import sys
+import threading
+import time
+from typing import List, Optional
+
+
+# bytes written at a time by ThrottledWriter, concurrent transfers take turns per chunk
+THROTTLE_CHUNK_SIZE = 64*1024
+
+# seconds between two progress lines
+PROGRESS_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """Limit the rate of bytes, shared by concurrent transfers
+
+    Every request reserves the next free slot of the bucket, in arrival order, so transfers
+    that write in small chunks take turns fairly instead of the fastest one taking it all.
+    """
+
+    rate: float     # bytes per second
+    burst: float    # bytes that can go without waiting after the bucket was idle
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = max(THROTTLE_CHUNK_SIZE, rate / 10) if burst is None else burst
+        self._lock = threading.Lock()
+        self._next_time = 0.0   # when the reserved bytes are all through
+
+    def reserve(self, count: int) -> float:
+        """ Reserve bytes
+
+        :param count: number of bytes
+        :return: seconds to wait before sending them
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._next_time = max(self._next_time, now) + count / self.rate
+            return max(0.0, self._next_time - now - self.burst / self.rate)
+
+
+_global_bucket = None   # type: Optional[TokenBucket]
+_global_bwlimit = None  # type: Optional[int]
+
+
+def set_global_bwlimit(bwlimit: Optional[int]) -> None:
+    """ Set the bandwidth limit shared by all uploads of the process
+
+    :param bwlimit: KB per second, None for no limit
+    :return: Nothing
+    """
+    global _global_bucket, _global_bwlimit
+    _global_bwlimit = bwlimit
+    _global_bucket = None if bwlimit is None else TokenBucket(bwlimit * 1024)
+
+
+def get_global_bwlimit() -> Optional[int]:
+    return _global_bwlimit
+
+
+def get_global_bucket() -> Optional[TokenBucket]:
+    return _global_bucket
+
+
+class Transfer:
+    """An upload in progress, for TransferMonitor
+    """
+
+    name: str               # e.g., the host name
+    size: Optional[int]     # bytes to send, if known
+    sent: int               # bytes sent so far
+
+    def __init__(self, monitor: "TransferMonitor", name: str, size: Optional[int]):
+        self._monitor = monitor
+        self.name = name
+        self.size = size
+        self.sent = 0
+
+    def add(self, count: int) -> None:
+        self.sent += count
+
+    def close(self) -> None:
+        self._monitor._remove(self)
+
+
+class TransferMonitor:
+    """Print the throughput and the ETA of all uploads in progress, every second, on one line
+
+    The line goes to the terminal (sys.__stderr__), so it does not mix with the buffered output of hosts.
+    """
+
+    def __init__(self, out=None):
+        self._out = sys.__stderr__ if out is None else out
+        self._lock = threading.Lock()
+        self._transfers = []        # type: List[Transfer]
+        self._done_bytes = 0        # bytes of finished transfers
+        self._thread = None
+        self._line_size = 0
+
+    def start(self, name: str, size: Optional[int] = None) -> Transfer:
+        """ Register an upload
+
+        :param name: e.g., the host name
+        :param size: bytes to send, if known
+        :return: the transfer, call add() for bytes sent and close() once done
+        """
+        transfer = Transfer(self, name, size)
+        with self._lock:
+            self._transfers.append(transfer)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._report, daemon=True)
+                self._thread.start()
+        return transfer
+
+    def _remove(self, transfer: Transfer) -> None:
+        with self._lock:
+            if transfer in self._transfers:
+                self._transfers.remove(transfer)
+                self._done_bytes += transfer.sent
+
+    def _get_sent(self) -> int:
+        with self._lock:
+            return self._done_bytes + sum(transfer.sent for transfer in self._transfers)
+
+    def get_status(self, rate: float) -> str:
+        """ Return the progress line
+
+        :param rate: current throughput, bytes per second
+        :return: the line
+        """
+        with self._lock:
+            transfers = list(self._transfers)
+        sent = sum(transfer.sent for transfer in transfers)
+        line = f"uploading to {len(transfers)} host(s), {sent/1024/1024:.1f} MB, {rate/1024/1024:.1f} MB/s"
+        if transfers and all(transfer.size is not None for transfer in transfers):
+            size = sum(transfer.size for transfer in transfers)
+            line += f" of {size/1024/1024:.1f} MB"
+            if rate > 0:
+                line += f", ETA {max(0, size - sent) / rate:.0f}s"
+        return line
+
+    def _report(self) -> None:
+        last_sent = self._get_sent()
+        last_time = time.monotonic()
+        rate = 0.0
+        while True:
+            time.sleep(PROGRESS_INTERVAL)
+            with self._lock:
+                if not self._transfers:
+                    self._thread = None
+                    break
+            now = time.monotonic()
+            sent = self._get_sent()
+            # smoothed, so one slow chunk does not swing the ETA
+            current_rate = (sent - last_sent) / (now - last_time)
+            rate = current_rate if rate == 0 else 0.7 * rate + 0.3 * current_rate
+            last_sent, last_time = sent, now
+            self._write(self.get_status(rate))
+        self._write("")
+
+    def _write(self, line: str) -> None:
+        try:
+            self._out.write("\r" + line.ljust(self._line_size) + ("\r" if not line else ""))
+            self._out.flush()
+        except (OSError, ValueError):
+            pass
+        self._line_size = len(line)
+
+
+_monitor = None  # type: Optional[TransferMonitor]
+_monitor_lock = threading.Lock()
+
+
+def get_transfer_monitor() -> Optional[TransferMonitor]:
+    """ Return the transfer monitor of the process
+
+    :return: the monitor, None if stderr is not a terminal
+    """
+    global _monitor
+    with _monitor_lock:
+        if _monitor is None and sys.__stderr__ is not None and sys.__stderr__.isatty():
+            _monitor = TransferMonitor()
+        return _monitor
+
+
+class ThrottledWriter:
+    """Wrap a binary file object, write in chunks no faster than the buckets allow
+
+    It has no fileno(), so nothing can write to the file object behind its back.
+    """
+
+    def __init__(self, fileobj, buckets: List[TokenBucket], transfer: Optional[Transfer] = None):
+        self._fileobj = fileobj
+        self._buckets = buckets
+        self._transfer = transfer
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        for offset in range(0, len(view), THROTTLE_CHUNK_SIZE):
+            chunk = view[offset:offset + THROTTLE_CHUNK_SIZE]
+            delay = max([bucket.reserve(len(chunk)) for bucket in self._buckets] + [0.0])
+            if delay > 0:
+                time.sleep(delay)
+            self._fileobj.write(chunk)
+            if self._transfer is not None:
+                self._transfer.add(len(chunk))
+        return len(view)
+
+    def fileno(self) -> int:
+        raise io.UnsupportedOperation("fileno")
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
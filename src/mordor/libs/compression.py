@@ -0,0 +1,148 @@
+import io
+import gzip
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+
+
+CODEC_NAMES = ["gzip", "zstd", "none"]
+
+DEFAULT_LEVELS = {
+    "gzip": 6,
+    "zstd": 3,
+    "none": 0,
+}
+
+EXTENSIONS = {
+    "gzip": ".tar.gz",
+    "zstd": ".tar.zst",
+    "none": ".tar",
+}
+
+
+class ArchiveCodec:
+    """Compression used for application archives
+
+    * gzip: use pigz (multi-threaded) if it is installed on the controller, otherwise python's gzip
+    * zstd: use the zstd command, multi-threaded, it must be installed on the controller and the hosts
+    * none: no compression, good for fast networks
+    """
+
+    name: str   # the codec name, one of CODEC_NAMES
+    level: int  # the compression level
+
+    def __init__(self, name: str = "gzip", level: Optional[int] = None):
+        if name not in CODEC_NAMES:
+            raise Exception(f"Unknown archive codec {name}, must be one of {', '.join(CODEC_NAMES)}")
+        self.name = name
+        self.level = DEFAULT_LEVELS[name] if level is None else level
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.name]
+
+    @property
+    def compress_args(self) -> Optional[List[str]]:
+        # command to compress stdin to stdout, None if we compress in process
+        if self.name == "gzip" and shutil.which("pigz") is not None:
+            # -n: do not store name and timestamp, so output is reproducible
+            return ["pigz", "-n", "-c", f"-{self.level}"]
+        if self.name == "zstd":
+            if shutil.which("zstd") is None:
+                raise Exception("zstd is not installed")
+            args = ["zstd", "-q", "-c", "-T0", f"-{self.level}"]
+            if self.level > 19:
+                args.append("--ultra")
+            return args
+        return None
+
+    @property
+    def cache_id(self) -> str:
+        # identify the compressed bytes, different implementations give different bytes
+        compress_args = self.compress_args
+        implementation = "python" if compress_args is None else compress_args[0]
+        return f"{self.name}-{self.level}-{implementation}"
+
+    @contextmanager
+    def open_writer(self, fileobj):
+        """ Compress into a file object
+
+        :param fileobj: a binary file object the compressed bytes are written to
+        :return: a context manager, gives a binary file object to write uncompressed bytes to
+        """
+        if self.name == "none":
+            yield fileobj
+            return
+
+        compress_args = self.compress_args
+        if compress_args is None:
+            with gzip.GzipFile(filename="", mode="wb", fileobj=fileobj, compresslevel=self.level, mtime=0) as gz:
+                yield gz
+            return
+
+        fileobj.flush()
+        try:
+            fileobj.fileno()
+            p = subprocess.Popen(compress_args, stdin=subprocess.PIPE, stdout=fileobj)
+            pump = None
+        except (AttributeError, io.UnsupportedOperation):
+            # e.g., a ThrottledWriter, compressed bytes must go through its write()
+            p = subprocess.Popen(compress_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            pump_errors = []
+
+            def copy_output():
+                try:
+                    shutil.copyfileobj(p.stdout, fileobj, 1024*1024)
+                except Exception as e:
+                    pump_errors.append(e)
+                    # unblock the compressor
+                    p.stdout.close()
+
+            pump = threading.Thread(target=copy_output)
+            pump.start()
+        try:
+            yield p.stdin
+        finally:
+            try:
+                p.stdin.close()
+            finally:
+                exit_code = p.wait()
+                if pump is not None:
+                    pump.join()
+        if pump is not None and pump_errors:
+            raise pump_errors[0]
+        if exit_code != 0:
+            raise subprocess.CalledProcessError(exit_code, compress_args)
+
+    def extract_command(
+        self,
+        dest_dir: str,
+        archive_filename: Optional[str] = None,
+        skip_old_files: bool = False
+    ) -> str:
+        """ Return the shell command to extract an archive on host
+
+        The mtime in the archive is normalized, so files get the extraction time (-m).
+
+        :param dest_dir: the directory to extract to
+        :param archive_filename: the archive on host, if not specified, the archive is read from stdin
+        :param skip_old_files: do not replace files that already exist in dest_dir, requires GNU tar
+        :return: the shell command
+        """
+        source = "-" if archive_filename is None else archive_filename
+        options = "--skip-old-files " if skip_old_files else ""
+        if self.name == "gzip":
+            return f"tar {options}-xmzf {source} -C {dest_dir}"
+        if self.name == "zstd":
+            if archive_filename is None:
+                return f"zstd -q -dc | tar {options}-xmf - -C {dest_dir}"
+            return f"zstd -q -dc {archive_filename} | tar {options}-xmf - -C {dest_dir}"
+        return f"tar {options}-xmf {source} -C {dest_dir}"
+
+    def to_json(self) -> dict:
+        return {
+            "name": self.name,
+            "level": self.level,
+        }
@@ -1,8 +1,13 @@
 from typing import Dict, Optional
 
+import os
 from collections import defaultdict
 from .host_config import HostConfig
+from .transport import remove_control_dir
 from .app_config import AppConfig
+from .artifact_cache import ArtifactCache
+from .deploy_state import DeployState, DEPLOY_STATE_FILENAME
+from .tools import get_cache_dir
 
 
 class Config:
@@ -15,6 +20,7 @@ class Config:
     def __init__(self, config: dict, config_dir: str):
         self.config_dir = config_dir
         self.config = config
+        self._deploy_state = None
         self.host_dict = {}
         for (host_name, host_config) in self.config["hosts"].items():
             self.host_dict[host_name] = HostConfig(host_name, host_config)
@@ -31,6 +37,22 @@ class Config:
             else:
                 self.app_dict[app.name][app.stage] = app
 
+    @property
+    def artifact_cache(self) -> ArtifactCache:
+        cache_config = self.config.get("artifact_cache", {})
+        return ArtifactCache(
+            cache_config.get("dir", get_cache_dir("artifacts")),
+            max_size=cache_config.get("max_size_mb", 2048)*1024*1024,
+            max_entries=cache_config.get("max_entries", 32)
+        )
+
+    @property
+    def deploy_state(self) -> DeployState:
+        # what is deployed on hosts, shared by all commands of the process
+        if self._deploy_state is None:
+            self._deploy_state = DeployState(os.path.join(self.config_dir, DEPLOY_STATE_FILENAME))
+        return self._deploy_state
+
     def get_host(self, host_name: str) -> Optional[HostConfig]:
         return self.host_dict.get(host_name)
 
@@ -39,3 +61,14 @@ class Config:
             return None
         return self.app_dict[app_name].get(stage)
 
+    def close(self) -> None:
+        """ Close all connections opened to hosts
+
+        :return: Nothing
+        """
+        for host in self.host_dict.values():
+            host.close()
+        remove_control_dir()
+        if self._deploy_state is not None:
+            self._deploy_state.close()
+
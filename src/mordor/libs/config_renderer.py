@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+from enum import Enum
+from typing import Dict, Optional
+
+from .app_config import AppConfig
+from .host_config import HostConfig
+from .tools import get_cache_dir
+
+# digests of the config files pushed to a host, in the application config directory
+CONFIG_DIGESTS_FILENAME = ".mordor_digests.json"
+
+
+class ConfigDeployType(Enum):
+    COPY        = "copy"
+    CONVERT     = "convert"
+    TEMPLATE    = "template"
+
+
+class ConfigRenderer:
+    """Render config files of an application for hosts of a stage
+
+    Overlay lookups, file reads and template compilation are done once per config file
+    and overlay directory and shared by all hosts, only rendering is done per host. It is
+    safe to render for many hosts concurrently.
+
+    When mordor looks for a config for a host, it looks in the following order:
+    * {config_dir}/configs/{app_name}/{stage}/{host_name}/
+    * {config_dir}/configs/{app_name}/{stage}/
+    * {config_dir}/configs/{app_name}/
+    """
+
+    config_base_dir: str    # the config directory of the application
+    app: AppConfig          # the application config
+    stage: str              # application stage, e.g., "beta", "prod", etc.
+
+    def __init__(self, config_dir: str, app: AppConfig, stage: str = ''):
+        self.config_base_dir = os.path.join(config_dir, "configs", app.name)
+        self.app = app
+        self.stage = stage
+        self._lock = threading.Lock()
+        self._isfile_cache = {}     # filename -> bool
+        self._content_cache = {}    # filename -> bytes
+        self._environment = None
+
+    def _isfile(self, filename: str) -> bool:
+        with self._lock:
+            if filename not in self._isfile_cache:
+                self._isfile_cache[filename] = os.path.isfile(filename)
+            return self._isfile_cache[filename]
+
+    def find_config_filename(self, name: str, host: HostConfig) -> Optional[str]:
+        """ Find the config file for a host, host specific one first
+
+        :param name: the config filename
+        :param host: host config
+        :return: the config file location relative to config_base_dir, or None if it does not exist
+        """
+        candidates = [
+            os.path.join(self.stage, host.name, name),
+            os.path.join(self.stage, name),
+            name
+        ]
+        for candidate in candidates:
+            if self._isfile(os.path.join(self.config_base_dir, candidate)):
+                return candidate
+        return None
+
+    def _read(self, filename: str) -> bytes:
+        with self._lock:
+            if filename not in self._content_cache:
+                with open(os.path.join(self.config_base_dir, filename), "rb") as f:
+                    self._content_cache[filename] = f.read()
+            return self._content_cache[filename]
+
+    def _get_template(self, filename: str):
+        with self._lock:
+            if self._environment is None:
+                from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+                bytecode_cache_dir = get_cache_dir("jinja")
+                os.makedirs(bytecode_cache_dir, exist_ok=True)
+                # compiled templates are kept for the whole run, and across runs in the bytecode cache
+                self._environment = Environment(
+                    loader=FileSystemLoader(self.config_base_dir),
+                    bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir),
+                    auto_reload=False,
+                    cache_size=-1
+                )
+            environment = self._environment
+        return environment.get_template(filename)
+
+    def render(self, host: HostConfig) -> Dict[str, bytes]:
+        """ Render config files of the application for a host
+
+        :param host: host config
+        :return: dict, key is the config filename, value is the rendered content, it
+            includes the deployment metadata _deployment.json
+        """
+        app = self.app
+        files = {}
+        # generate metadata.json
+        files["_deployment.json"] = json.dumps(
+            {
+                "host": host.to_json(),
+                "app": app.to_json(),
+            },
+            indent=4
+        ).encode("utf-8")
+        for (filename, deploy_type) in app.config.items():
+            config_filename = self.find_config_filename(filename, host)
+            if config_filename is None:
+                print(f"Config file {filename} does not exist.")
+                sys.exit(1)
+
+            if deploy_type == ConfigDeployType.COPY.value:
+                files[filename] = self._read(config_filename)
+                continue
+            if deploy_type == ConfigDeployType.CONVERT.value:
+                content = self._read(config_filename).decode("utf-8")
+                config_dir = os.path.join(host.env_home, "configs", app.name)
+                content = content.format(
+                    config_dir=config_dir,
+                    env_home=host.env_home,
+                    app_name=app.name
+                )
+                files[filename] = content.encode("utf-8")
+                continue
+            if deploy_type == ConfigDeployType.TEMPLATE.value:
+                context = {
+                    "host_name": host.name,
+                    "config_dir": os.path.join(host.env_home, "configs", app.name),
+                    "log_dir": os.path.join(host.env_home, "logs", app.name),
+                    "data_dir": os.path.join(host.env_home, "data", app.name),
+                    "pid_dir": os.path.join(host.env_home, "pids", app.name),
+                    "env_home": host.env_home,
+                    "app_name": app.name
+                }
+                files[filename] = self._get_template(config_filename).render(context).encode("utf-8")
+                continue
+        return files
+
+
+def get_config_digests(files: Dict[str, bytes]) -> Dict[str, str]:
+    """ Return the sha256 hex digest of every rendered config file
+
+    :param files: key is the config filename, value is the rendered content
+    :return: dict, key is the config filename, value is the sha256 hex digest
+    """
+    return {filename: hashlib.sha256(content).hexdigest() for (filename, content) in files.items()}
+
+
+def get_remote_config_digests(app: AppConfig, host: HostConfig) -> Dict[str, str]:
+    """ Get the digests of the config files pushed to a host by the previous stage
+
+    :param app: application config
+    :param host: host config
+    :return: dict, key is the config filename, value is the sha256 hex digest, empty if
+        the host has no digests
+    """
+    stdout, exit_code = host.capture(
+        f"cat {host.path('configs', app.name, CONFIG_DIGESTS_FILENAME)} 2>/dev/null"
+    )
+    if exit_code != 0:
+        return {}
+    try:
+        digests = json.loads(stdout.decode("utf-8"))
+    except ValueError:
+        return {}
+    return digests if isinstance(digests, dict) else {}
@@ -0,0 +1,119 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+
+# state database in the config directory
+DEPLOY_STATE_FILENAME = ".mordor_state.db"
+
+
+class HostState:
+    """What mordor deployed for an application on a host, as recorded after the last stage
+    """
+
+    host_name: str                  # the host name
+    app_name: str                   # the application name
+    version: Optional[str]          # the current version, None if unknown
+    files_digest: Optional[str]     # digest of the per file manifest of the current version, None if unknown
+    venv_digest: Optional[str]      # digest of the requirements the virtual environment of the current version
+                                    # was set up with, None if it was not set up by mordor
+    config_digests: Dict[str, str]  # config filename -> sha256 hex digest
+    fingerprint: str                # what the host looked like after the stage, see get_host_fingerprint
+    updated_at: float               # when it was recorded, seconds since epoch
+
+    def __init__(
+        self, host_name: str, app_name: str,
+        version: Optional[str], files_digest: Optional[str], venv_digest: Optional[str],
+        config_digests: Dict[str, str], fingerprint: str, updated_at: Optional[float] = None
+    ):
+        self.host_name = host_name
+        self.app_name = app_name
+        self.version = version
+        self.files_digest = files_digest
+        self.venv_digest = venv_digest
+        self.config_digests = config_digests
+        self.fingerprint = fingerprint
+        self.updated_at = time.time() if updated_at is None else updated_at
+
+
+class DeployState:
+    """Controller side record of what is deployed on every host, in a SQLite database
+
+    Hosts can change without mordor knowing (e.g., staged from another machine), so a record
+    is only trusted if the fingerprint of the host still matches it.
+    """
+
+    filename: str   # the database file
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # hosts are staged from several threads, the lock serializes access
+            self._connection = sqlite3.connect(self.filename, check_same_thread=False, timeout=30)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS host_state ("
+                "host_name TEXT NOT NULL, "
+                "app_name TEXT NOT NULL, "
+                "version TEXT, "
+                "files_digest TEXT, "
+                "venv_digest TEXT, "
+                "config_digests TEXT NOT NULL, "
+                "fingerprint TEXT NOT NULL, "
+                "updated_at REAL NOT NULL, "
+                "PRIMARY KEY (host_name, app_name))"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def get(self, host_name: str, app_name: str) -> Optional[HostState]:
+        """ Get the record of an application on a host
+
+        :param host_name: the host name
+        :param app_name: the application name
+        :return: the record, None if there is none
+        """
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT version, files_digest, venv_digest, config_digests, fingerprint, updated_at "
+                "FROM host_state WHERE host_name = ? AND app_name = ?",
+                (host_name, app_name)
+            ).fetchone()
+        if row is None:
+            return None
+        version, files_digest, venv_digest, config_digests, fingerprint, updated_at = row
+        return HostState(
+            host_name, app_name, version, files_digest, venv_digest,
+            json.loads(config_digests), fingerprint, updated_at
+        )
+
+    def put(self, host_state: HostState) -> None:
+        """ Record what is deployed for an application on a host, replaces the previous record
+
+        :param host_state: the record
+        :return: Nothing
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO host_state "
+                "(host_name, app_name, version, files_digest, venv_digest, config_digests, fingerprint, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    host_state.host_name, host_state.app_name, host_state.version, host_state.files_digest,
+                    host_state.venv_digest, json.dumps(host_state.config_digests, sort_keys=True),
+                    host_state.fingerprint, host_state.updated_at
+                )
+            )
+            connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,113 @@
+import os
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .host_config import HostConfig
+
+
+def get_receive_command(remote_filename: str, digest: str) -> str:
+    """ Return the shell command to receive a file from stdin on a host
+
+    The file is written to a .part file first, and only moved in place if its sha256 matches.
+
+    :param remote_filename: the file location on host
+    :param digest: the expected sha256 hex digest
+    :return: the shell command
+    """
+    part_filename = f"{remote_filename}.part"
+    return " && ".join([
+        f"mkdir -p {os.path.dirname(remote_filename)}",
+        f"cat > {part_filename}",
+        f"echo \"{digest}  {part_filename}\" | sha256sum -c --quiet -",
+        f"mv {part_filename} {remote_filename}",
+    ])
+
+
+def distribute_artifact(
+    hosts: List[HostConfig],
+    local_filename: str,
+    digest: str,
+    get_remote_filename: Callable[[HostConfig], str],
+    fanout: int = 2
+) -> Dict[str, bool]:
+    """ Copy an artifact to many hosts using a fan-out tree
+
+    The controller uploads the artifact to the first fanout hosts (seeds). After that, in each
+    round, every host that has the artifact relays it to up to fanout hosts that do not have it
+    yet, using ssh from host to host, so the number of hosts having the artifact grows by a
+    factor of (fanout + 1) each round. Every host verifies the sha256 of what it receives.
+
+    Hosts must be able to ssh to each other without password, using the relay_host of the
+    destination host.
+
+    :param hosts: hosts to copy the artifact to
+    :param local_filename: the artifact on the controller
+    :param digest: sha256 hex digest of the artifact
+    :param get_remote_filename: returns the artifact location on a host
+    :param fanout: number of hosts the controller and each host sends to in a round
+    :return: dict, key is host name, value is True if the host has the artifact
+    """
+    status = {host.name: False for host in hosts}
+    pending = list(hosts)
+
+    def upload(dst: HostConfig) -> Optional[str]:
+        try:
+            with dst.open_stream(
+                get_receive_command(get_remote_filename(dst), digest), size=os.path.getsize(local_filename)
+            ) as stdin:
+                with open(local_filename, "rb") as f:
+                    shutil.copyfileobj(f, stdin, 1024*1024)
+        except Exception as e:
+            return f"upload to {dst.name} failed: {e}"
+        return None
+
+    def relay(src: HostConfig, dst: HostConfig) -> Optional[str]:
+        receive_command = get_receive_command(get_remote_filename(dst), digest)
+        command = (
+            f"cat {get_remote_filename(src)} | "
+            f"ssh -q -o BatchMode=yes {dst.relay_host} {shlex.quote(receive_command)}"
+        )
+        _, exit_code = src.capture(command)
+        if exit_code != 0:
+            return f"relay from {src.name} to {dst.name} failed with exit code {exit_code}"
+        return None
+
+    def run_round(transfers: List[Tuple[Optional[HostConfig], HostConfig]]) -> None:
+        with ThreadPoolExecutor(max_workers=len(transfers)) as executor:
+            futures = [
+                (dst, executor.submit(upload, dst) if src is None else executor.submit(relay, src, dst))
+                for (src, dst) in transfers
+            ]
+            errors = []
+            for (dst, future) in futures:
+                error = future.result()
+                status[dst.name] = error is None
+                if error is not None:
+                    errors.append(error)
+        print("Done!" if not errors else f"{len(errors)} failed!")
+        for error in errors:
+            print(f"        {error}")
+
+    # round 0: controller to seeds
+    seeds = pending[:fanout]
+    pending = pending[fanout:]
+    print(f"    Distribute artifact to {len(seeds)} seed host(s) ... ", end="", flush=True)
+    run_round([(None, dst) for dst in seeds])
+
+    round_number = 0
+    while pending:
+        sources = [host for host in hosts if status[host.name]]
+        if not sources:
+            break
+        transfers = []
+        for src in sources:
+            for _ in range(fanout):
+                if pending:
+                    transfers.append((src, pending.pop(0)))
+        round_number += 1
+        print(f"    Relay round {round_number}: {len(transfers)} host(s) ... ", end="", flush=True)
+        run_round(transfers)
+
+    return status
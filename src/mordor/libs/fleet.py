@@ -0,0 +1,200 @@
+import sys
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from .host_config import HostConfig
+from .host_output import HostOutput, StdoutProxy, set_current_output
+from .timing import phase
+
+
+_print_lock = threading.Lock()
+
+
+class HostResult:
+    """The outcome of an action on one host
+    """
+
+    host_name: str          # the host id
+    succeeded: bool         # True if the action finished without error
+    duration: float         # wall clock time in seconds
+    error: Optional[str]    # error message if the action failed
+
+    def __init__(self, host_name: str, succeeded: bool, duration: float, error: Optional[str] = None):
+        self.host_name = host_name
+        self.succeeded = succeeded
+        self.duration = duration
+        self.error = error
+
+    def to_json(self) -> dict:
+        return {
+            "host": self.host_name,
+            "succeeded": self.succeeded,
+            "duration": self.duration,
+            "error": self.error,
+        }
+
+
+class RunResult(HostResult):
+    """The outcome of a command on one host
+    """
+
+    exit_code: Optional[int]    # the command exit code, None if the command could not be started
+    tail: List[str]             # the last lines of the command output, stdout and stderr mixed
+
+    def __init__(
+        self,
+        host_name: str,
+        exit_code: Optional[int],
+        duration: float,
+        tail: List[str],
+        error: Optional[str] = None
+    ):
+        super().__init__(host_name, exit_code == 0, duration, error)
+        self.exit_code = exit_code
+        self.tail = tail
+
+    def to_json(self) -> dict:
+        result = super().to_json()
+        result["exit_code"] = self.exit_code
+        result["tail"] = self.tail
+        return result
+
+
+def run_on_hosts(
+    hosts: List[HostConfig],
+    action: Callable[[HostConfig], None],
+    parallel: int = 1
+) -> List[HostResult]:
+    """ Run an action on many hosts, at most parallel hosts at a time
+
+    A failing host does not stop the others, every host gets a HostResult.
+
+    :param hosts: hosts to run the action on
+    :param action: the action, it is called with the host as the only argument
+    :param parallel: max number of hosts to process concurrently
+    :return: list of HostResult, in the same order as hosts
+    """
+    parallel = max(1, min(parallel, len(hosts))) if hosts else 1
+    buffered = parallel > 1
+
+    stdout = sys.stdout
+
+    def run_one(host: HostConfig) -> HostResult:
+        output = HostOutput(host.name, buffered, stdout)
+        set_current_output(output)
+        start_time = time.time()
+        try:
+            action(host)
+            result = HostResult(host.name, True, time.time() - start_time)
+        except SystemExit as e:
+            result = HostResult(host.name, False, time.time() - start_time, f"exit code {e.code}")
+        except Exception as e:
+            result = HostResult(host.name, False, time.time() - start_time, str(e))
+        if not result.succeeded:
+            print(f"Failed on host {host.name}: {result.error}")
+        set_current_output(None)
+
+        if buffered:
+            with _print_lock:
+                stdout.write(output.getvalue())
+                stdout.flush()
+        return result
+
+    sys.stdout = StdoutProxy(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            return list(executor.map(run_one, hosts))
+    finally:
+        sys.stdout = stdout
+
+
+def print_results(results: List[HostResult]) -> None:
+    """ Print a per host summary
+
+    :param results: list of HostResult
+    :return: Nothing
+    """
+    if not results:
+        return
+    width = max(len("host"), max(len(result.host_name) for result in results))
+    print("Summary:")
+    print(f"    {'host':<{width}}  status   duration  error")
+    for result in results:
+        status = "OK" if result.succeeded else "FAILED"
+        print(f"    {result.host_name:<{width}}  {status:<7}  {result.duration:7.1f}s  {result.error or ''}")
+    failed = len([result for result in results if not result.succeeded])
+    print(f"    {len(results) - failed} succeeded, {failed} failed")
+
+
+def run_commands(
+    hosts: List[HostConfig],
+    get_command: Callable[[HostConfig], str],
+    parallel: int = 1,
+    tail_lines: int = 5,
+    stream=None
+) -> List[RunResult]:
+    """ Run a shell command on many hosts, at most parallel hosts at a time
+
+    Output is streamed line by line as it arrives, every line is prefixed with the host name.
+
+    :param hosts: hosts to run the command on
+    :param get_command: returns the shell command line for a host
+    :param parallel: max number of hosts to run the command on concurrently
+    :param tail_lines: number of output lines to keep for each host
+    :param stream: if specified, stdout and stderr lines go there, otherwise they go to
+        sys.stdout and sys.stderr
+    :return: list of RunResult, in the same order as hosts
+    """
+    parallel = max(1, min(parallel, len(hosts))) if hosts else 1
+    width = max([len(host.name) for host in hosts], default=0)
+
+    def run_one(host: HostConfig) -> RunResult:
+        tail = deque(maxlen=tail_lines)
+        prefix = f"{host.name:<{width}} | "
+
+        def on_output(name: str, line: str) -> None:
+            tail.append(line)
+            event.add_bytes(len(line) + 1)
+            if stream is not None:
+                out = stream
+            else:
+                out = sys.stdout if name == "stdout" else sys.stderr
+            with _print_lock:
+                out.write(f"{prefix}{line}\n")
+                out.flush()
+
+        start_time = time.time()
+        with phase("run", host.name) as event:
+            try:
+                exit_code = host.stream_output(get_command(host), on_output)
+            except Exception as e:
+                event.succeeded = False
+                return RunResult(host.name, None, time.time() - start_time, list(tail), str(e))
+            event.succeeded = exit_code == 0
+        return RunResult(host.name, exit_code, time.time() - start_time, list(tail))
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        return list(executor.map(run_one, hosts))
+
+
+def print_run_results(results: List[RunResult]) -> None:
+    """ Print a per host summary of a command, with the tail of its output
+
+    :param results: list of RunResult
+    :return: Nothing
+    """
+    if not results:
+        return
+    width = max(len("host"), max(len(result.host_name) for result in results))
+    print("Summary:")
+    print(f"    {'host':<{width}}  exit code  duration  error")
+    for result in results:
+        exit_code = "-" if result.exit_code is None else str(result.exit_code)
+        print(f"    {result.host_name:<{width}}  {exit_code:>9}  {result.duration:7.1f}s  {result.error or ''}")
+        for line in result.tail:
+            print(f"    {'':<{width}}  | {line}")
+    failed = len([result for result in results if not result.succeeded])
+    print(f"    {len(results) - failed} succeeded, {failed} failed")
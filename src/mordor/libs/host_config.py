@@ -1,8 +1,27 @@
 import subprocess
 import os
-from typing import Optional, List, Tuple
+import sys
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Callable, Optional, List, Tuple
 import tempfile
 
+from .bandwidth import ThrottledWriter, TokenBucket, get_global_bucket, get_transfer_monitor
+from .host_output import current_output
+from .process import LineSplitter, ProcessResult, run_process
+from .transport import Transport, create_transport, expand_path
+
+
+def _write_stderr(data: bytes) -> None:
+    # pass the stderr of a captured command through, to the host output if it is buffered
+    output = current_output()
+    text = data.decode("utf-8", errors="replace")
+    if output is not None and output.buffered:
+        output.write(text)
+    else:
+        sys.stderr.write(text)
+
 
 class HostConfig:
     """Represent configuration for a given host
@@ -10,10 +29,19 @@ class HostConfig:
 
     name: str  # the unique name of the host we address this host, not necessary be the DNS name
     host_config: dict  # the config dictionary for this host
+    transport: Transport  # how we reach this host, ssh, or local for the machine mordor runs on
 
     def __init__(self, host_name: str, host_config: dict):
         self.host_config = host_config
         self.name = host_name
+        self.transport = create_transport(
+            host_config.get("transport"),
+            self.ssh_host,
+            multiplex=self.ssh_multiplex,
+            bwlimit=self.bwlimit
+        )
+        # shared by all uploads to this host
+        self._bucket = None if self.bwlimit is None else TokenBucket(self.bwlimit * 1024)
 
     @property
     def env_home(self) -> str:
@@ -23,13 +51,74 @@ class HostConfig:
     def ssh_host(self) -> str:
         return self.host_config.get("ssh_host", self.name)
 
+    @property
+    def relay_host(self) -> str:
+        # address other hosts use to ssh to this host, when artifacts are relayed host to host
+        return self.host_config.get("relay_host", self.ssh_host)
+
     @property
     def python3(self) -> Optional[str]:
         return self.host_config.get("python3", "/usr/bin/python3")
 
+    @property
+    def ssh_multiplex(self) -> bool:
+        # reuse one ssh connection for all ssh and scp commands to this host
+        return self.host_config.get("ssh_multiplex", True)
+
+    @property
+    def bwlimit(self) -> Optional[int]:
+        # max KB per second for uploads to this host, on top of the global limit (--bwlimit)
+        return self.host_config.get("bwlimit")
+
     def path(self, *args) -> str:
         return os.path.join(self.env_home, *args)
 
+    @property
+    def is_local(self) -> bool:
+        # True if this host is the machine mordor runs on, reached without ssh
+        return self.transport.name == "local"
+
+    def ssh_options(self) -> List[str]:
+        """ Return ssh/scp options to reuse the master connection for this host
+
+        :return: list of options, empty if multiplexing is disabled or not available, or the host is local
+        """
+        if self.is_local:
+            return []
+        return self.transport.ssh_options()
+
+    def close(self) -> None:
+        """ Close the connection to this host, if any
+
+        :return: Nothing
+        """
+        self.transport.close()
+
+    def _run(self, args: List[str], stdin=None) -> None:
+        """ Run a local command (ssh, scp, ...) for this host
+
+        If the output of this host is buffered (hosts are processed concurrently),
+        the command output is captured into the buffer instead of the terminal.
+
+        :param args: the command line
+        :param stdin: optional file object for stdin
+        :return: Nothing
+        """
+        output = current_output()
+        if output is None or not output.buffered:
+            subprocess.check_call(args, stdin=stdin)
+            return
+
+        p = subprocess.run(
+            args,
+            stdin=subprocess.DEVNULL if stdin is None else stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+        output.write(p.stdout.decode("utf-8", errors="replace"))
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, args)
+
     def execute_batch(self, lines: List[str]) -> None:
         """ Execute a bash batch file on this host
 
@@ -42,8 +131,7 @@ class HostConfig:
             f.write(f"exit\n".encode("utf-8"))
             f.seek(0)
 
-            new_args = ["ssh", "-q", self.ssh_host]
-            subprocess.check_call(new_args, stdin=f)
+            self._run(self.transport.shell_args(), stdin=f)
 
     def execute(self, *args) -> None:
         """ Execute a one-line command on this host
@@ -51,9 +139,10 @@ class HostConfig:
         :param args: args for this script
         :return: Nothing
         """
-        new_args = ["ssh", "-q", "-t", self.ssh_host]
-        new_args.extend(args)
-        subprocess.check_call(new_args)
+        output = current_output()
+        # no terminal to attach when output is captured
+        tty = output is None or not output.buffered
+        self._run(self.transport.shell_args(" ".join(args), tty=tty))
 
     def execute2(self, *args) -> Tuple[str, int]:
         """ Execute a script on this host, capture the output.
@@ -61,12 +150,126 @@ class HostConfig:
         :param args: args for this script
         :return: tuple, script stdout as string, and script exit code as integer
         """
-        new_args = ["ssh", self.ssh_host]
-        new_args.extend(args)
-        p = subprocess.Popen(new_args, stdout=subprocess.PIPE)
-        _ = p.wait()
-        output, err = p.communicate()
-        return output, err
+        result = self.run(" ".join(args), on_stderr=_write_stderr)
+        return result.stdout.decode("utf-8", errors="replace"), result.exit_code
+
+    def run(
+        self,
+        command: str,
+        stdin=None,
+        on_stdout: Optional[Callable[[bytes], None]] = None,
+        on_stderr: Optional[Callable[[bytes], None]] = None,
+        max_output: Optional[int] = None,
+        timeout: Optional[float] = None
+    ) -> ProcessResult:
+        """ Execute a shell command on this host, read its stdout and stderr concurrently
+
+        See run_process for details.
+
+        :param command: the shell command line
+        :param stdin: optional file object for stdin, default to no input
+        :param on_stdout: called with every chunk of stdout
+        :param on_stderr: called with every chunk of stderr
+        :param max_output: max number of bytes to keep for stdout and for stderr, None for no limit
+        :param timeout: if specified, the command is killed if it runs longer than timeout seconds
+        :return: ProcessResult
+        """
+        new_args = self.transport.shell_args(command)
+        return run_process(
+            new_args,
+            stdin=stdin,
+            on_stdout=on_stdout,
+            on_stderr=on_stderr,
+            max_output=max_output,
+            timeout=timeout
+        )
+
+    def capture(self, command: str) -> Tuple[bytes, int]:
+        """ Execute a shell command on this host, capture the stdout.
+
+        :param command: the shell command line
+        :return: tuple, command stdout as bytes, and command exit code as integer
+        """
+        result = self.run(command, on_stderr=_write_stderr)
+        return result.stdout, result.exit_code
+
+    def stream_output(
+        self,
+        command: str,
+        on_output: Callable[[str, str], None],
+        timeout: Optional[float] = None
+    ) -> int:
+        """ Execute a shell command on this host, pass its output to a callback line by line
+
+        stdout and stderr are read concurrently, so the command never blocks on a full pipe.
+
+        :param command: the shell command line
+        :param on_output: called with "stdout" or "stderr" and the line without line ending,
+            it is called from reader threads
+        :param timeout: if specified, the command is killed if it runs longer than timeout seconds
+        :return: the command exit code
+        """
+        result = self.run(
+            command,
+            on_stdout=LineSplitter(lambda line: on_output("stdout", line)),
+            on_stderr=LineSplitter(lambda line: on_output("stderr", line)),
+            max_output=0,
+            timeout=timeout
+        )
+        return result.exit_code
+
+    @contextmanager
+    def open_stream(self, command: str, size: Optional[int] = None):
+        """ Execute a shell command on this host, stream data to its stdin
+
+        Writes are limited by the global bandwidth limit and the one of this host, and shown
+        by the transfer monitor, if any.
+
+        Usage:
+            with host.open_stream("tar -xf - -C /tmp/foo") as stdin:
+                stdin.write(...)
+
+        :param command: the shell command line
+        :param size: number of bytes that will be written, if known, for the ETA
+        :return: a context manager, gives a binary file object connected to the command's stdin
+        """
+        new_args = self.transport.shell_args(command)
+        output = current_output()
+        if output is None or not output.buffered:
+            p = subprocess.Popen(new_args, stdin=subprocess.PIPE)
+            captured = None
+        else:
+            p = subprocess.Popen(new_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            captured = []
+            reader = threading.Thread(target=lambda: captured.append(p.stdout.read()))
+            reader.start()
+        stdin = p.stdin
+        transfer = None
+        if not self.is_local:
+            buckets = [bucket for bucket in [get_global_bucket(), self._bucket] if bucket is not None]
+            monitor = get_transfer_monitor()
+            if monitor is not None:
+                transfer = monitor.start(self.name, size)
+            if buckets or transfer is not None:
+                stdin = ThrottledWriter(p.stdin, buckets, transfer)
+        try:
+            yield stdin
+        except BrokenPipeError:
+            # the command exited early, its exit code tells what happened
+            pass
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+            exit_code = p.wait()
+            if transfer is not None:
+                transfer.close()
+            if captured is not None:
+                reader.join()
+                output.write(b"".join(captured).decode("utf-8", errors="replace"))
+        if exit_code != 0:
+            raise subprocess.CalledProcessError(exit_code, new_args)
 
     def upload_batch(self, local_path: str, remote_path: str) -> None:
         """ Upload an entire directory to the host
@@ -75,13 +278,7 @@ class HostConfig:
         :param remote_path: the destination path
         :return: Nothing
         """
-        scp_options = os.environ.get('SCP_OPTIONS','').strip()
-        options = scp_options.split(" ") if scp_options else []
-        new_args = ["scp"] + options + ["-r", "-q",
-            local_path,
-            "{}:{}".format(self.ssh_host, remote_path)
-        ]
-        subprocess.check_call(new_args)
+        self.transport.upload(local_path, remote_path, True, self._run)
 
     def upload(self, local_path: str, remote_path: str) -> None:
         """ Upload a file to the host
@@ -90,17 +287,36 @@ class HostConfig:
         :param remote_path: the destination path
         :return: Nothing
         """
-        scp_options = os.environ.get('SCP_OPTIONS','').strip()
-        options = scp_options.split(" ") if scp_options else []
-        new_args = ["scp"] + options + ["-q",
-            local_path,
-            "{}:{}".format(self.ssh_host, remote_path)
-        ]
-        subprocess.check_call(new_args)
+        self.transport.upload(local_path, remote_path, False, self._run)
+
+    def put_file(self, local_path: str, remote_path: str) -> None:
+        """ Put a file on the host, it is hardlinked for a local host if possible
+
+        The file on host must be treated as read only, it may share the content with local_path.
+
+        :param local_path: the path to the file
+        :param remote_path: the destination path, its directory is created if needed
+        :return: Nothing
+        """
+        if self.is_local:
+            remote_path = expand_path(remote_path)
+            os.makedirs(os.path.dirname(remote_path), exist_ok=True)
+            if os.path.lexists(remote_path):
+                os.remove(remote_path)
+            try:
+                os.link(local_path, remote_path)
+            except OSError:
+                # e.g., different file systems
+                shutil.copyfile(local_path, remote_path)
+            return
+        with self.open_stream(f"mkdir -p {os.path.dirname(remote_path)} && cat > {remote_path}") as stdin:
+            with open(local_path, "rb") as f:
+                shutil.copyfileobj(f, stdin, 1024*1024)
 
     def to_json(self) -> dict:
         return {
             "name": self.name,
             "env_home": self.env_home,
             "ssh_host": self.ssh_host,
+            "transport": self.transport.name,
         }
@@ -0,0 +1,69 @@
+import io
+import sys
+import threading
+from typing import Optional
+
+
+_local = threading.local()
+
+
+class HostOutput:
+    """Collect the output for a host.
+
+    When hosts are processed concurrently, output is buffered and written out as
+    one block once the host is done, so output from different hosts never interleaves.
+    """
+
+    host_name: str  # the host this output belongs to
+    buffered: bool  # if False, output goes straight to stream
+
+    def __init__(self, host_name: str, buffered: bool, stream=None):
+        self.host_name = host_name
+        self.buffered = buffered
+        self.stream = sys.__stdout__ if stream is None else stream
+        self._buffer = io.StringIO()
+
+    def write(self, s: str) -> int:
+        if self.buffered:
+            return self._buffer.write(s)
+        return self.stream.write(s)
+
+    def flush(self) -> None:
+        if not self.buffered:
+            self.stream.flush()
+
+    def getvalue(self) -> str:
+        return self._buffer.getvalue()
+
+
+def current_output() -> Optional[HostOutput]:
+    """Return the HostOutput for the host processed by the current thread, if any."""
+    return getattr(_local, "output", None)
+
+
+def set_current_output(output: Optional[HostOutput]) -> None:
+    """Set the HostOutput for the host processed by the current thread."""
+    _local.output = output
+
+
+class StdoutProxy:
+    """Route print() to the HostOutput of the current thread."""
+
+    def __init__(self, stdout):
+        self._stdout = stdout
+
+    def write(self, s: str) -> int:
+        output = current_output()
+        if output is None:
+            return self._stdout.write(s)
+        return output.write(s)
+
+    def flush(self) -> None:
+        output = current_output()
+        if output is None:
+            self._stdout.flush()
+        else:
+            output.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stdout, name)
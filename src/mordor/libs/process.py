@@ -0,0 +1,166 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from typing import Callable, List, Optional
+
+
+# seconds to wait for the output of a command after it is killed for a timeout
+READER_JOIN_TIMEOUT = 1.0
+
+
+class OutputBuffer:
+    """Keep the output of a command, up to max_size bytes
+
+    Once the output is bigger than max_size, only the last max_size bytes are kept.
+    """
+
+    max_size: Optional[int] # max number of bytes to keep, None for no limit
+    total_size: int         # number of bytes received
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size
+        self.total_size = 0
+        self._data = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self.total_size += len(data)
+        if self.max_size is None:
+            self._data.extend(data)
+            return
+        if self.max_size == 0:
+            return
+        self._data.extend(data[-self.max_size:])
+        if len(self._data) > self.max_size:
+            del self._data[:len(self._data) - self.max_size]
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_size > len(self._data)
+
+    def getvalue(self) -> bytes:
+        return bytes(self._data)
+
+
+class ProcessResult:
+    """The outcome of a command
+    """
+
+    exit_code: int          # the command exit code, negative if it is killed by a signal
+    stdout: bytes           # the kept stdout, see OutputBuffer
+    stderr: bytes           # the kept stderr, see OutputBuffer
+    stdout_size: int        # number of bytes the command wrote to stdout
+    stderr_size: int        # number of bytes the command wrote to stderr
+    timed_out: bool         # True if the command is killed because it ran out of time
+    duration: float         # wall clock time in seconds
+
+    def __init__(
+        self,
+        exit_code: int,
+        stdout: OutputBuffer,
+        stderr: OutputBuffer,
+        timed_out: bool,
+        duration: float
+    ):
+        self.exit_code = exit_code
+        self.stdout = stdout.getvalue()
+        self.stderr = stderr.getvalue()
+        self.stdout_size = stdout.total_size
+        self.stderr_size = stderr.total_size
+        self.timed_out = timed_out
+        self.duration = duration
+
+
+class LineSplitter:
+    """Turn the chunks of a command output into lines
+
+    Usage:
+        run_process(args, on_stdout=LineSplitter(lambda line: print(line)))
+    """
+
+    def __init__(self, on_line: Callable[[str], None]):
+        self.on_line = on_line
+        self._pending = b""
+
+    def __call__(self, data: bytes) -> None:
+        if not data:
+            # end of output, the last line may not have a line ending
+            if self._pending:
+                self.on_line(self._pending.rstrip(b"\r").decode("utf-8", errors="replace"))
+                self._pending = b""
+            return
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            self.on_line(line.rstrip(b"\r").decode("utf-8", errors="replace"))
+
+
+def run_process(
+    args: List[str],
+    stdin=None,
+    on_stdout: Optional[Callable[[bytes], None]] = None,
+    on_stderr: Optional[Callable[[bytes], None]] = None,
+    max_output: Optional[int] = None,
+    timeout: Optional[float] = None
+) -> ProcessResult:
+    """ Run a command, read its stdout and stderr concurrently
+
+    Output is passed to the callbacks in chunks as it arrives, so the command never blocks
+    on a full pipe and output of any size can be processed. At the end of output, the
+    callback is called with b"" once.
+
+    :param args: the command line
+    :param stdin: optional file object for stdin, default to no input
+    :param on_stdout: called with every chunk of stdout, from a reader thread
+    :param on_stderr: called with every chunk of stderr, from a reader thread
+    :param max_output: max number of bytes to keep for stdout and for stderr, the last bytes
+        are kept, None for no limit
+    :param timeout: if specified, the command and every process it started are killed if it runs
+        longer than timeout seconds, output still held open by processes that escaped is not
+        waited for more than READER_JOIN_TIMEOUT seconds
+    :return: ProcessResult
+    """
+    start_time = time.time()
+    stdout = OutputBuffer(max_output)
+    stderr = OutputBuffer(max_output)
+    p = subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL if stdin is None else stdin,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        # its own process group, so a timeout kills its children too (e.g., bash -c "sleep 10")
+        start_new_session=timeout is not None
+    )
+
+    def read(pipe, buffer: OutputBuffer, callback: Optional[Callable[[bytes], None]]) -> None:
+        with pipe:
+            while True:
+                data = pipe.read1(64*1024)
+                buffer.write(data)
+                if callback is not None:
+                    callback(data)
+                if not data:
+                    break
+
+    readers = [
+        threading.Thread(target=read, args=(p.stdout, stdout, on_stdout), daemon=True),
+        threading.Thread(target=read, args=(p.stderr, stderr, on_stderr), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    timed_out = False
+    try:
+        p.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        p.wait()
+    finally:
+        for reader in readers:
+            reader.join(READER_JOIN_TIMEOUT if timed_out else None)
+    return ProcessResult(p.returncode, stdout, stderr, timed_out, time.time() - start_time)
@@ -0,0 +1,60 @@
+from typing import Any
+
+
+class ReadOnlyDict(dict):
+    """A dict that cannot be modified, it is shared by every caller
+
+    dict(d) gives a mutable shallow copy, copy.deepcopy(d) gives a mutable deep copy.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("config is read only, use dict(config) or copy.deepcopy(config) to get a mutable copy")
+
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    __ior__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+
+    def copy(self) -> dict:
+        return dict(self)
+
+    def __copy__(self) -> dict:
+        return dict(self)
+
+    def __deepcopy__(self, memo) -> dict:
+        return thaw(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+def freeze(value: Any) -> Any:
+    """ Return a read only view of a parsed json or yaml value
+
+    dicts become ReadOnlyDict and lists become tuples, recursively.
+
+    :param value: the parsed value
+    :return: the read only value
+    """
+    if isinstance(value, dict):
+        return ReadOnlyDict((key, freeze(item)) for (key, item) in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """ Return a mutable deep copy of a value returned by freeze
+
+    :param value: the read only value
+    :return: the mutable copy, with dicts and lists
+    """
+    if isinstance(value, dict):
+        return {key: thaw(item) for (key, item) in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
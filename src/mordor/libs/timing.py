@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from .host_output import current_output
+
+
+class TraceEvent:
+    """A finished phase, e.g. uploading the application to a host
+    """
+
+    name: str                   # the phase name
+    host_name: Optional[str]    # the host the phase ran for, None if it is not host specific
+    start: float                # start time, seconds since epoch
+    duration: float             # wall clock time in seconds
+    bytes: Optional[int]        # number of bytes the phase transferred or produced, if known
+    succeeded: bool             # False if the phase raised an exception
+
+    def __init__(self, name: str, host_name: Optional[str], start: float):
+        self.name = name
+        self.host_name = host_name
+        self.start = start
+        self.duration = 0.0
+        self.bytes = None
+        self.succeeded = True
+
+    def add_bytes(self, count: int) -> None:
+        self.bytes = (self.bytes or 0) + count
+
+    def to_json(self) -> dict:
+        return {
+            "name": self.name,
+            "host": self.host_name,
+            "start": self.start,
+            "duration": self.duration,
+            "bytes": self.bytes,
+            "succeeded": self.succeeded,
+        }
+
+
+class CountingWriter:
+    """Wrap a binary file object, count the bytes written into a TraceEvent
+    """
+
+    def __init__(self, fileobj, event: TraceEvent):
+        self._fileobj = fileobj
+        self._event = event
+
+    def write(self, data) -> int:
+        self._event.add_bytes(len(data))
+        return self._fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+class Tracer:
+    """Collect the timing of every phase of a command
+
+    Listeners are called with every TraceEvent once its phase is finished, it lets a
+    program embedding mordor receive the events as they happen.
+    """
+
+    events: List[TraceEvent]                        # finished phases, in the order they finished
+    listeners: List[Callable[[TraceEvent], None]]   # called for every finished phase
+
+    def __init__(self):
+        self.events = []
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener: Callable[[TraceEvent], None]) -> None:
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[TraceEvent], None]) -> None:
+        self.listeners.remove(listener)
+
+    @contextmanager
+    def phase(self, name: str, host_name: Optional[str] = None):
+        """ Time a phase
+
+        Usage:
+            with tracer.phase("upload_application", host.name) as event:
+                event.add_bytes(len(data))
+
+        :param name: the phase name
+        :param host_name: the host the phase runs for, default to the host processed by the current thread
+        :return: a context manager, gives the TraceEvent of the phase
+        """
+        if host_name is None:
+            output = current_output()
+            host_name = None if output is None else output.host_name
+        event = TraceEvent(name, host_name, time.time())
+        try:
+            yield event
+        except BaseException:
+            event.succeeded = False
+            raise
+        finally:
+            event.duration = time.time() - event.start
+            with self._lock:
+                self.events.append(event)
+            for listener in list(self.listeners):
+                listener(event)
+
+    def print_summary(self) -> None:
+        """ Print a table with the duration and bytes of every phase, grouped by host
+
+        :return: Nothing
+        """
+        if not self.events:
+            return
+        with self._lock:
+            events = sorted(self.events, key=lambda event: (event.host_name or "", event.start))
+        host_width = max(len("host"), max(len(event.host_name or "-") for event in events))
+        name_width = max(len("phase"), max(len(event.name) for event in events))
+        print("Timings:")
+        print(f"    {'host':<{host_width}}  {'phase':<{name_width}}  duration        bytes")
+        for event in events:
+            byte_count = "" if event.bytes is None else str(event.bytes)
+            print(
+                f"    {event.host_name or '-':<{host_width}}  {event.name:<{name_width}}  "
+                f"{event.duration:7.2f}s  {byte_count:>11}"
+            )
+
+    def to_chrome_trace(self) -> dict:
+        """ Return the events in the chrome trace event format
+
+        Load the file in chrome://tracing or https://ui.perfetto.dev, every host is shown as a thread.
+
+        :return: the trace as a dict
+        """
+        with self._lock:
+            events = list(self.events)
+        thread_ids = {}     # host name -> thread id in the trace
+        trace_events = []
+        for event in events:
+            if event.host_name not in thread_ids:
+                thread_ids[event.host_name] = len(thread_ids)
+                trace_events.append({
+                    "name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread_ids[event.host_name],
+                    "args": {"name": event.host_name or "mordor"},
+                })
+            trace_events.append({
+                "name": event.name,
+                "cat": "mordor",
+                "ph": "X",
+                "ts": int(event.start * 1000000),
+                "dur": int(event.duration * 1000000),
+                "pid": os.getpid(),
+                "tid": thread_ids[event.host_name],
+                "args": event.to_json(),
+            })
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, filename: str) -> None:
+        """ Write the events to a file in the chrome trace event format
+
+        :param filename: the file location
+        :return: Nothing
+        """
+        with open(filename, "w") as f:
+            json.dump(self.to_chrome_trace(), f, indent=1)
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """Return the tracer shared by the process."""
+    return _tracer
+
+
+def phase(name: str, host_name: Optional[str] = None):
+    """ Time a phase with the shared tracer, see Tracer.phase
+
+    :param name: the phase name
+    :param host_name: the host the phase runs for, default to the host processed by the current thread
+    :return: a context manager, gives the TraceEvent of the phase
+    """
+    return _tracer.phase(name, host_name)
@@ -1,6 +1,11 @@
 import os
+import io
 import json
-import yaml
+import time
+from typing import Dict
+
+# heavier modules are imported where they are used, this module is imported by AppEnv
+# in every dispatched command
 
 
 def get_json(path: str):
@@ -9,8 +14,12 @@ def get_json(path: str):
 
 
 def get_yaml(path: str):
+    import yaml
+
+    # use the C accelerated loader from libyaml if it is available
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     with open(os.path.expanduser(path), "r") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=loader)
 
 
 def get_config(path: str):
@@ -19,3 +28,92 @@ def get_config(path: str):
     if path.endswith(".yaml"):
         return get_yaml(path)
     assert False, "Impossible"
+
+
+def get_config_cached(path: str):
+    """ Same as get_config, but the parsed config is cached on disk
+
+    The cache is keyed by the file location, mtime and size, it lives in the mordor cache
+    directory, see get_cache_dir.
+
+    :param path: the config file location
+    :return: the parsed config
+    """
+    import pickle
+    import hashlib
+    import tempfile
+
+    path = os.path.abspath(os.path.expanduser(path))
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    cache_filename = get_cache_dir("configs", hashlib.sha256(path.encode("utf-8")).hexdigest() + ".pickle")
+    try:
+        with open(cache_filename, "rb") as f:
+            cached_key, config = pickle.load(f)
+        if cached_key == key:
+            return config
+    except Exception:
+        # missing or broken cache entry
+        pass
+
+    config = get_config(path)
+    try:
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+        # write to a temp file then rename, so concurrent readers never see a partial entry
+        fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(cache_filename))
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((key, config), f)
+        os.replace(temp_filename, cache_filename)
+    except OSError:
+        # cache is best effort
+        pass
+    return config
+
+
+def file_digest(path: str) -> str:
+    """ Return the sha256 hex digest of a file
+
+    :param path: the file location
+    :return: sha256 hex digest
+    """
+    import hashlib
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024*1024)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_cache_dir(*args) -> str:
+    """ Return a location in the mordor cache directory on the controller
+
+    The cache directory is $MORDOR_CACHE_DIR, default to ~/.cache/mordor
+
+    :param args: path components inside the cache directory
+    :return: the location
+    """
+    cache_dir = os.environ.get("MORDOR_CACHE_DIR", os.path.join("~", ".cache", "mordor"))
+    return os.path.join(os.path.expanduser(cache_dir), *args)
+
+
+def write_tar(fileobj, files: Dict[str, bytes]) -> None:
+    """ Write an uncompressed tar stream with the given files
+
+    :param fileobj: binary file object to write to, it can be a pipe
+    :param files: key is the filename, value is the file content
+    :return: Nothing
+    """
+    import tarfile
+
+    now = int(time.time())
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+        for (filename, content) in files.items():
+            tar_info = tarfile.TarInfo(filename)
+            tar_info.size = len(content)
+            tar_info.mtime = now
+            tar_info.mode = 0o644
+            tar.addfile(tar_info, io.BytesIO(content))
@@ -0,0 +1,238 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Callable, List, Optional
+
+from .bandwidth import get_global_bwlimit
+
+
+# how long (seconds) an idle master connection stays alive if we fail to close it
+SSH_CONTROL_PERSIST = 60
+
+# ssh_host values that mean the machine mordor runs on
+LOCAL_HOSTS = ["localhost", "127.0.0.1", "::1"]
+
+_control_dir = None
+_control_dir_lock = threading.Lock()
+
+
+def get_control_dir() -> str:
+    """Return the directory holding ssh control sockets for this process, create it if needed."""
+    global _control_dir
+    with _control_dir_lock:
+        if _control_dir is None:
+            # unix socket path is limited to ~100 chars, avoid long $TMPDIR (e.g. on macOS)
+            _control_dir = tempfile.mkdtemp(prefix="mordor-", dir="/tmp" if os.path.isdir("/tmp") else None)
+        return _control_dir
+
+
+def remove_control_dir() -> None:
+    """Remove the directory holding ssh control sockets, if we created one."""
+    global _control_dir
+    with _control_dir_lock:
+        if _control_dir is not None:
+            shutil.rmtree(_control_dir, ignore_errors=True)
+            _control_dir = None
+
+
+def expand_path(path: str) -> str:
+    """ Expand a path on the host the way the shell does, e.g. env_home "$HOME/mordor"
+
+    Paths on host go through the shell of the host, except for the local transport, which
+    works on them in process, it must expand them first.
+
+    :param path: the path, may have ~ and environment variables
+    :return: the expanded path
+    """
+    return os.path.expanduser(os.path.expandvars(path))
+
+
+class Transport:
+    """How mordor reaches a host: run shell commands on it and copy files to it
+    """
+
+    name: str   # the transport name used in host config, "ssh" or "local"
+
+    def shell_args(self, command: Optional[str] = None, tty: bool = False) -> List[str]:
+        """ Return the command line to run a shell command on the host
+
+        :param command: the shell command line, if not specified, the shell reads the script from stdin
+        :param tty: attach a terminal if the transport needs it for interactive output
+        :return: list of args
+        """
+        raise NotImplementedError()
+
+    def upload(self, local_path: str, remote_path: str, recursive: bool, run: Callable[[List[str]], None]) -> None:
+        """ Copy a file or directory to the host
+
+        :param local_path: the file or directory on the controller
+        :param remote_path: the destination on the host
+        :param recursive: True if local_path is a directory
+        :param run: runs a local command line for the host, e.g. HostConfig._run
+        :return: Nothing
+        """
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class SshTransport(Transport):
+    """Reach a host with ssh and scp, one shared ssh connection per host if ssh_multiplex is on
+    """
+
+    name = "ssh"
+
+    ssh_host: str               # the ssh hostname
+    multiplex: bool             # reuse one ssh connection for all ssh and scp commands
+    bwlimit: Optional[int]      # max KB per second for scp, None for no limit
+
+    def __init__(self, ssh_host: str, multiplex: bool = True, bwlimit: Optional[int] = None):
+        self.ssh_host = ssh_host
+        self.multiplex = multiplex
+        self.bwlimit = bwlimit
+        self._master_lock = threading.Lock()
+        self._master_started = False
+        self._master_failed = False
+
+    @property
+    def control_path(self) -> str:
+        # %C is a hash of local host, remote host, port and user, it keeps the path short
+        return os.path.join(get_control_dir(), "%C")
+
+    def _ensure_master(self) -> bool:
+        """ Start the shared master connection to this host if it is not started yet
+
+        :return: True if the master connection is available
+        """
+        if not self.multiplex:
+            return False
+        with self._master_lock:
+            if not self._master_started and not self._master_failed:
+                # -f -N: go to background once authenticated, no command
+                # the master runs with stdio on /dev/null, so it never holds our pipes open
+                ret = subprocess.call(
+                    [
+                        "ssh", "-q", "-f", "-N",
+                        "-o", "ControlMaster=yes",
+                        "-o", f"ControlPath={self.control_path}",
+                        "-o", f"ControlPersist={SSH_CONTROL_PERSIST}",
+                        self.ssh_host
+                    ],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                )
+                if ret == 0:
+                    self._master_started = True
+                else:
+                    # fall back to one connection per command
+                    self._master_failed = True
+            return self._master_started
+
+    def ssh_options(self) -> List[str]:
+        """ Return ssh/scp options to reuse the master connection for this host
+
+        :return: list of options, empty if multiplexing is disabled or not available
+        """
+        if not self._ensure_master():
+            return []
+        return [
+            "-o", "ControlMaster=no",
+            "-o", f"ControlPath={self.control_path}",
+        ]
+
+    def shell_args(self, command: Optional[str] = None, tty: bool = False) -> List[str]:
+        args = ["ssh", "-q"]
+        if tty:
+            args.append("-t")
+        args.extend(self.ssh_options())
+        args.append(self.ssh_host)
+        if command is not None:
+            args.append(command)
+        return args
+
+    def upload(self, local_path: str, remote_path: str, recursive: bool, run: Callable[[List[str]], None]) -> None:
+        scp_options = os.environ.get('SCP_OPTIONS','').strip()
+        options = scp_options.split(" ") if scp_options else []
+        # scp cannot share the global limit with other uploads, it gets all of it at most
+        bwlimits = [limit for limit in [self.bwlimit, get_global_bwlimit()] if limit is not None]
+        if bwlimits:
+            # in Kbit/s
+            options.extend(["-l", str(min(bwlimits) * 8)])
+        args = ["scp"] + options + self.ssh_options() + (["-r", "-q"] if recursive else ["-q"]) + [
+            local_path,
+            "{}:{}".format(self.ssh_host, remote_path)
+        ]
+        run(args)
+
+    def close(self) -> None:
+        """ Close the master connection for this host, if any
+
+        :return: Nothing
+        """
+        with self._master_lock:
+            if not self._master_started:
+                return
+            subprocess.call(
+                [
+                    "ssh", "-q", "-O", "exit",
+                    "-o", f"ControlPath={self.control_path}",
+                    self.ssh_host
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+            self._master_started = False
+
+
+class LocalTransport(Transport):
+    """Reach the machine mordor runs on directly, without ssh and scp
+
+    Commands run with bash as the current user, files are copied in process.
+    """
+
+    name = "local"
+
+    def shell_args(self, command: Optional[str] = None, tty: bool = False) -> List[str]:
+        # the local terminal, if any, is inherited, no tty to allocate
+        if command is None:
+            return ["bash"]
+        return ["bash", "-c", command]
+
+    def upload(self, local_path: str, remote_path: str, recursive: bool, run: Callable[[List[str]], None]) -> None:
+        remote_path = expand_path(remote_path)
+        # same semantic as scp: copy into remote_path if it is an existing directory
+        if os.path.isdir(remote_path):
+            remote_path = os.path.join(remote_path, os.path.basename(local_path.rstrip(os.sep)))
+        if recursive:
+            if os.path.isdir(remote_path):
+                run(["cp", "-R", os.path.join(local_path, "."), remote_path])
+            else:
+                shutil.copytree(local_path, remote_path, symlinks=True)
+        else:
+            shutil.copy2(local_path, remote_path)
+
+
+def create_transport(
+    transport_name: Optional[str], ssh_host: str, multiplex: bool = True, bwlimit: Optional[int] = None
+) -> Transport:
+    """ Create the transport for a host
+
+    :param transport_name: "ssh" or "local", if not specified, hosts with ssh_host localhost,
+        127.0.0.1 or ::1 use local, others use ssh
+    :param ssh_host: the ssh hostname
+    :param multiplex: for ssh, reuse one ssh connection for all ssh and scp commands
+    :param bwlimit: for ssh, max KB per second for scp
+    :return: the transport
+    """
+    if transport_name is None:
+        transport_name = "local" if ssh_host in LOCAL_HOSTS else "ssh"
+    if transport_name == "local":
+        return LocalTransport()
+    if transport_name == "ssh":
+        return SshTransport(ssh_host, multiplex=multiplex, bwlimit=bwlimit)
+    raise Exception(f"Unknown transport {transport_name}, must be ssh or local")
@@ -1,37 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
 import argparse
 import os
 import sys
-import tempfile
 import shutil
+import shlex
 import base64
-from enum import Enum
 import json
+import hashlib
+
+from .libs import Config, get_config_cached, AppConfig, HostConfig, HostResult, run_on_hosts, print_results, \
+    RunResult, run_commands, print_run_results
+from .libs.compression import ArchiveCodec, CODEC_NAMES
+from .libs.app_config import FILE_MANIFEST_FILENAME, get_changed_names, get_file_manifest_digest
+from .libs.deploy_state import DeployState, HostState
+from .libs.tools import write_tar
+from .libs.artifact_cache import get_artifact_digest
+from .libs.distribution import distribute_artifact
+from .libs.timing import phase, get_tracer, CountingWriter
+from .libs.bandwidth import set_global_bwlimit
+from .libs.config_renderer import ConfigRenderer, CONFIG_DIGESTS_FILENAME, \
+    get_config_digests, get_remote_config_digests
+
+def init_hosts(base_dir: str, config: Config, host_names: List[str], parallel: int = 1) -> List[HostResult]:
+    """ Initialize many hosts for mordor
 
-from jinja2 import Template
-
-from .libs import Config, get_config, AppConfig, HostConfig
-
-class ConfigDeployType(Enum):
-    COPY        = "copy"
-    CONVERT     = "convert"
-    TEMPLATE    = "template"
-
-def init_hosts(base_dir: str, config: Config, host_names: List[str]) -> None:
-    host_dict = {}
+    :param base_dir: name of the directory contains mordor.py
+    :param config: overall config
+    :param host_names: list of host names to initialize
+    :param parallel: max number of hosts to initialize concurrently
+    :return: list of HostResult, one per host
+    """
+    hosts = []
     for host_name in host_names:
         host = config.get_host(host_name)
         if host is None:
             print(f"Host {host_name} does not exist.")
             sys.exit(1)
-        else:
-            host_dict[host_name] = host
+        hosts.append(host)
 
-    for host_name in host_names:
-        init_host(base_dir, config, host_dict[host_name])
+    results = run_on_hosts(
+        hosts,
+        lambda host: init_host(base_dir, config, host),
+        parallel=parallel
+    )
+    print_results(results)
+    return results
 
 
 def init_host(base_dir: str, config: Config, host: HostConfig) -> None:
@@ -55,23 +71,28 @@ def init_host(base_dir: str, config: Config, host: HostConfig) -> None:
         host.path("data"),
         host.path("temp"),
     ]:
-        host.execute("mkdir", "-p", dir_name)
+        with phase("create_dirs"):
+            host.execute("mkdir", "-p", dir_name)
 
     cmds = [
         "install_packages.sh",
         "run_dispatcher.sh",
+        "warm_dispatcher.py",
         "init_host.sh",
         "host_tools.txt",
     ]
     for cmd in cmds:
-        host.upload(
-            os.path.join(base_dir, "bin", cmd),
-            host.path("bin", cmd)
-        )
-        if cmd.endswith(".sh"):
-            host.execute("chmod", "+x", host.path("bin", cmd))
+        with phase("upload_tools") as event:
+            host.upload(
+                os.path.join(base_dir, "bin", cmd),
+                host.path("bin", cmd)
+            )
+            event.add_bytes(os.path.getsize(os.path.join(base_dir, "bin", cmd)))
+            if cmd.endswith(".sh") or cmd.endswith(".py"):
+                host.execute("chmod", "+x", host.path("bin", cmd))
 
-    host.execute(host.path("bin", "init_host.sh"), host.env_home)
+    with phase("init_host_script"):
+        host.execute(host.path("bin", "init_host.sh"), host.env_home)
     print(f"Done!")
 
 
@@ -81,8 +102,15 @@ def stage_app(
     update_venv: bool,
     config_only: bool,
     stage: str = '',
-    host_names: Optional[List[str]] = None
-) -> None:
+    host_names: Optional[List[str]] = None,
+    parallel: int = 1,
+    delta: bool = False,
+    archive_codec: Optional[ArchiveCodec] = None,
+    relay_fanout: int = 0,
+    wheelhouse: bool = False,
+    hardlink: bool = True,
+    force: bool = False
+) -> List[HostResult]:
     """ Stage an application on the fleet for a stage
 
     :param base_dir: name of the directory contains mordor.py
@@ -92,7 +120,15 @@ def stage_app(
     :param config_only: update config only or not
     :param stage: application stage, e.g., "beta", "prod", etc.
     :param host_names: if specified, we only stage to this list of hosts, otherwise, we stage to all hosts for the stage
-    :return: Nothing
+    :param parallel: max number of hosts to stage concurrently
+    :param delta: only upload files changed since the current version on each host
+    :param archive_codec: if specified, overrides the archive codec from the application manifest
+    :param relay_fanout: if not 0, the archive is copied to hosts through a fan-out tree, the controller
+        and every host that has the archive sends it to relay_fanout hosts at a time
+    :param wheelhouse: build wheels for all requirements once, hosts install from them without package index
+    :param hardlink: build the new version from hardlinks to the unchanged files of the current version on host
+    :param force: stage everything, even for hosts the state database says are up to date
+    :return: list of HostResult, one per host
     """
     app = config.get_app(app_name, stage)
     if app is None:
@@ -101,13 +137,29 @@ def stage_app(
     if not app.use_python3:
         print(f"Application {app_name} with stage {stage} does not support python3.")
         sys.exit(1)
+    if archive_codec is not None:
+        app.archive_codec = archive_codec
 
-    # archive the entire app and send it to host
-    # tar -czf /tmp/a.tar.gz -C $PWD *
+    # archive the entire app and send it to host, the archive is reused from
+    # the artifact cache if the app did not change
     if not config_only:
-        archive_filename = app.create_archive()
+        with phase("create_file_manifest"):
+            file_manifest = app.create_file_manifest()
+        with phase("create_archive") as event:
+            archive_filename = app.create_archive(config.artifact_cache, file_manifest)
+            event.add_bytes(os.path.getsize(archive_filename))
     else:
         archive_filename = None
+        file_manifest = None
+
+    if wheelhouse and update_venv:
+        print("Build wheelhouse ... ", end="", flush=True)
+        with phase("create_wheelhouse") as event:
+            wheelhouse_filename = app.create_wheelhouse(config.artifact_cache, python=app.wheel_python)
+            event.add_bytes(os.path.getsize(wheelhouse_filename))
+        print("Done!")
+    else:
+        wheelhouse_filename = None
 
     if host_names is not None:
         deploy_to = host_names
@@ -115,15 +167,64 @@ def stage_app(
         deploy_to = app.deploy_to
 
     # do a check first
+    hosts = []
     for host_name in deploy_to:
         host = config.get_host(host_name)
         if host is None:
             print(f"Host {host_name} does not exist.")
             sys.exit(1)
-
-    for host_name in deploy_to:
-        host = config.get_host(host_name)
-        stage_app_on_host(config, app, host, archive_filename, update_venv, config_only, stage=stage)
+        hosts.append(host)
+
+    # hosts that got the archive through the fan-out tree
+    relayed_hosts = set()
+    if relay_fanout > 0 and not config_only and not delta:
+        relay_to = hosts
+        if config.deploy_state is not None and not force:
+            # hosts which already have this version get nothing relayed
+            from concurrent.futures import ThreadPoolExecutor
+
+            files_digest = get_file_manifest_digest(file_manifest)
+            with phase("check_state"), ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+                host_states = list(executor.map(
+                    lambda host: get_verified_host_state(config.deploy_state, app, host), hosts
+                ))
+            relay_to = [
+                host for (host, host_state) in zip(hosts, host_states)
+                if not has_app_files(host_state, app, files_digest)
+            ]
+        if relay_to:
+            with phase("distribute_archive") as event:
+                status = distribute_artifact(
+                    relay_to,
+                    archive_filename,
+                    get_artifact_digest(archive_filename),
+                    lambda host: host.path("temp", app.archive_filename),
+                    fanout=relay_fanout
+                )
+                event.add_bytes(os.path.getsize(archive_filename) * len(relay_to))
+            relayed_hosts = set(host_name for (host_name, has_archive) in status.items() if has_archive)
+
+    # config lookup and template compilation are shared by all hosts
+    config_renderer = ConfigRenderer(config.config_dir, app, stage)
+
+    results = run_on_hosts(
+        hosts,
+        lambda host: stage_app_on_host(
+            config, app, host, archive_filename, update_venv, config_only,
+            stage=stage,
+            file_manifest=file_manifest,
+            delta=delta,
+            remote_archive_filename=host.path("temp", app.archive_filename) if host.name in relayed_hosts else None,
+            wheelhouse_filename=wheelhouse_filename,
+            config_renderer=config_renderer,
+            hardlink=hardlink,
+            deploy_state=config.deploy_state,
+            force=force
+        ),
+        parallel=parallel
+    )
+    print_results(results)
+    return results
 
 
 def stage_app_on_host(
@@ -133,7 +234,15 @@ def stage_app_on_host(
     archive_filename: str,
     update_venv: bool,
     config_only: bool,
-    stage: str = ''
+    stage: str = '',
+    file_manifest: Optional[Dict[str, str]] = None,
+    delta: bool = False,
+    remote_archive_filename: Optional[str] = None,
+    wheelhouse_filename: Optional[str] = None,
+    config_renderer: Optional[ConfigRenderer] = None,
+    hardlink: bool = True,
+    deploy_state: Optional[DeployState] = None,
+    force: bool = False
 ) -> None:
     """ Stage an application on target host
 
@@ -144,157 +253,379 @@ def stage_app_on_host(
     :param update_venv: create virtual environment or not
     :param config_only: update config only or not
     :param stage: application stage, e.g., "beta", "prod", etc.
+    :param file_manifest: per file manifest of the application, from AppConfig.create_file_manifest
+    :param delta: only upload files changed since the current version on the host
+    :param remote_archive_filename: if specified, the archive is already on the host at this location
+    :param wheelhouse_filename: if specified, a tar of wheels, packages are installed from it without package index
+    :param config_renderer: if specified, renders the config files, so it can be shared by hosts
+    :param hardlink: build the new version from hardlinks to the unchanged files of the current version on host
+    :param deploy_state: if specified, what the host has is looked up in it, and only what is missing is
+        staged, what is staged is recorded in it
+    :param force: stage everything, even if deploy_state says the host has it
     :return: Nothing
     """
     print(f"Stage application {app.name} for stage {app.stage} on host {host.name}.")
-    # allow user to have different configs for different stages
-    config_base_dir = os.path.join(config.config_dir, "configs", app.name)
-    app_config_dirs = []
-
-    def add_dir_to_config_dirs(dir_name: str) -> None:
-        if os.path.isdir(dir_name) and dir_name not in app_config_dirs:
-            app_config_dirs.append(dir_name)
-
-    add_dir_to_config_dirs(os.path.join(config_base_dir, stage, host.name))
-    add_dir_to_config_dirs(os.path.join(config_base_dir, stage))
-    add_dir_to_config_dirs(config_base_dir)
-
-    def find_config_filename(name: str) -> str:
-        for prefix in app_config_dirs:
-            full_name = os.path.join(prefix, name)
-            if os.path.isfile(full_name):
-                return full_name
-        print(f"Config file {name} does not exist.")
-        sys.exit(1)
-
-    # creating local staging area for upload file via scp
-    temp_dir = tempfile.mkdtemp()
-    local_stage_dir = os.path.join(temp_dir, app.name)
-    os.makedirs(local_stage_dir)
-    if not config_only:
-        shutil.copyfile(archive_filename, os.path.join(local_stage_dir, app.archive_filename))
-    # generate metadata.json
-    metadata_filename = os.path.join(local_stage_dir, "_deployment.json")
-    with open(metadata_filename, "wt") as f:
-        json.dump(
-            {
-                "host": host.to_json(),
-                "app": app.to_json(),
-            },
-            f,
-            indent=4
-        )
-    for (filename, deploy_type) in app.config.items():
-        if deploy_type == ConfigDeployType.COPY.value:
-            shutil.copyfile(
-                find_config_filename(filename),
-                os.path.join(local_stage_dir, filename)
-            )
-            continue
-        if deploy_type == ConfigDeployType.CONVERT.value:
-            with open(find_config_filename(filename), "r") as f:
-                content = f.read()
-            config_dir = os.path.join(host.env_home, "configs", app.name)
-            content = content.format(
-                config_dir=config_dir,
-                env_home=host.env_home,
-                app_name=app.name
-            )
-            with open(os.path.join(local_stage_dir, filename), "w") as sf:
-                sf.write(content)
-            continue
-        if deploy_type == ConfigDeployType.TEMPLATE.value:
-            with open(find_config_filename(filename), "rt") as f:
-                template = Template(f.read())
-                context = {
-                    "host_name": host.name,
-                    "config_dir": os.path.join(host.env_home, "configs", app.name),
-                    "log_dir": os.path.join(host.env_home, "logs", app.name),
-                    "data_dir": os.path.join(host.env_home, "data", app.name),
-                    "pid_dir": os.path.join(host.env_home, "pids", app.name),
-                    "env_home": host.env_home,
-                    "app_name": app.name
-                }
-            with open(os.path.join(local_stage_dir, filename), "wt") as sf:
-                sf.write(template.render(context))
-            continue
-
-    if not config_only:
-        print("    Upload application and configuration ... ", end="", flush=True)
-    else:
-        print("    Upload configuration ... ", end="", flush=True)
-    host.upload_batch(local_stage_dir, host.path("temp"))
+    # config files and metadata to upload, rendered in memory
+    if config_renderer is None:
+        config_renderer = ConfigRenderer(config.config_dir, app, stage)
+    with phase("render_configs"):
+        files = config_renderer.render(host)
+        config_digests = get_config_digests(files)
+    files_digest = None if config_only else get_file_manifest_digest(file_manifest)
+
+    # what the host has, only trusted if the host still looks the same as when it was recorded
+    host_state = None
+    if deploy_state is not None and not force:
+        with phase("check_state"):
+            host_state = get_verified_host_state(deploy_state, app, host)
+    # the application is only staged if the host does not have this version with the same files
+    update_app = not config_only and not has_app_files(host_state, app, files_digest)
+    if update_venv and not update_app and host_state is not None and \
+            (host_state.version, host_state.venv_digest) == (app.manifest.version, app.get_venv_digest()):
+        update_venv = False
+
+    if not update_app and remote_archive_filename is not None:
+        # relayed to the host before we knew it has this version
+        host.execute_batch([f"rm -f {remote_archive_filename}"])
+
+    if not update_app:
+        # only push config files changed since the previous stage
+        if host_state is not None:
+            remote_config_digests = host_state.config_digests
+        else:
+            with phase("get_config_digests"):
+                remote_config_digests = get_remote_config_digests(app, host)
+        files = {
+            filename: content for (filename, content) in files.items()
+            if remote_config_digests.get(filename) != config_digests[filename]
+        }
+        if not files and not update_venv:
+            print("    Configuration is unchanged, skipped." if config_only else "    Already up to date, skipped.")
+            print("")
+            return
+        if not config_only:
+            print(f"    Application: version {app.manifest.version} is already staged")
+        print(f"    Configuration: {len(files)} changed, {len(config_digests) - len(files)} unchanged")
+    config_filenames = list(files.keys())
+    files["_digests.json"] = json.dumps(config_digests).encode("utf-8")
+
+    # previous version directory on host, the new version starts from a hardlinked copy of it
+    prev_app_dir = None
+    if update_app:
+        if delta or hardlink:
+            with phase("get_file_manifest"):
+                prev_app_dir, prev_file_manifest = get_current_file_manifest(app, host)
+        # cp -al and tar --skip-old-files are GNU only, e.g. not on darwin
+        if prev_app_dir is not None and hardlink:
+            with phase("check_gnu_tools"):
+                hardlink = has_gnu_tools(host)
+        if prev_app_dir is not None and not delta and not hardlink:
+            # extract the full archive into an empty directory
+            prev_app_dir = None
+        if prev_app_dir is not None:
+            names_to_add = [
+                name for (name, digest) in file_manifest.items() if prev_file_manifest.get(name) != digest
+            ]
+            # changed entries are removed first, so a file can replace a directory and vice versa, new
+            # entries too, in case the previous version has files it did not ship (e.g., created at runtime)
+            names_to_remove = get_changed_names(prev_file_manifest, file_manifest)
+            print(f"    Delta: {len(names_to_add)} changed, {len(file_manifest) - len(names_to_add)} unchanged")
+        # keep the per file manifest, so next stage can upload delta only
+        files["_files.json"] = json.dumps(file_manifest).encode("utf-8")
+
+    # configs are streamed as a tar into the staging area in temp
+    print("    Upload configuration ... ", end="", flush=True)
+    with phase("upload_configs") as event, host.open_stream(
+        f"mkdir -p {host.path('temp', app.name)} && tar -xf - -C {host.path('temp', app.name)}"
+    ) as stdin:
+        write_tar(CountingWriter(stdin, event), files)
     print("Done!")
 
-    # copy app archive to remote host
+    # the app archive is streamed straight into tar on the host, nothing is written to disk
+    # but the new version, which is assembled in a staging directory
+    staging_dir = host.path('apps', app.name, f".{app.manifest.version}.staging")
+    if update_app:
+        lines = [
+            f"mkdir -p {host.path('apps', app.name)}",
+            f"rm -rf {staging_dir}",
+            f"mkdir -p {staging_dir}",
+        ]
+        if prev_app_dir is not None:
+            # start from the previous version, with hardlink, unchanged files cost no disk
+            # writes nor space, changed files are removed and extracted as new files
+            lines.append(f"cp -a{'l' if hardlink else ''} {prev_app_dir}/. {staging_dir}/")
+            for name in names_to_remove:
+                lines.append(f"rm -rf {staging_dir}/{shlex.quote(name)}")
+            # one command, so a failed copy fails the stage
+            with phase("link_previous_version" if hardlink else "copy_previous_version"):
+                host.execute_batch([" && ".join(lines)])
+            lines = []
+        # with the full archive, files linked from the previous version are kept
+        skip_old_files = prev_app_dir is not None and not delta
+
+        if remote_archive_filename is None and (prev_app_dir is None or not delta) and host.is_local:
+            # the archive is hardlinked from the artifact cache instead of being copied
+            remote_archive_filename = host.path("temp", app.archive_filename)
+            with phase("put_archive"):
+                host.put_file(archive_filename, remote_archive_filename)
+
+        if remote_archive_filename is not None:
+            print("    Extract application ... ", end="", flush=True)
+            # one command, so a failed extract fails the stage instead of being hidden by rm
+            with phase("extract_application"):
+                host.execute_batch([" && ".join(lines + [
+                    app.archive_codec.extract_command(
+                        staging_dir, archive_filename=remote_archive_filename, skip_old_files=skip_old_files
+                    ),
+                    f"rm -f {remote_archive_filename}",
+                ])])
+        else:
+            print("    Upload application ... ", end="", flush=True)
+            with phase("upload_application") as event, \
+                    host.open_stream(" && ".join(
+                        lines + [app.archive_codec.extract_command(staging_dir, skip_old_files=skip_old_files)]
+                    ), size=os.path.getsize(archive_filename) if prev_app_dir is None or not delta else None) as stdin:
+                stdin = CountingWriter(stdin, event)
+                if prev_app_dir is None or not delta:
+                    with open(archive_filename, "rb") as f:
+                        shutil.copyfileobj(f, stdin, 1024*1024)
+                else:
+                    app.write_archive(stdin, file_manifest, names=names_to_add)
+        print("Done!")
+
+    if wheelhouse_filename is not None and update_venv:
+        print("    Upload wheelhouse ... ", end="", flush=True)
+        wheelhouse_dir = host.path('temp', app.name, '_wheelhouse')
+        if host.is_local:
+            # extract straight from the artifact cache
+            with phase("extract_wheelhouse"):
+                host.execute_batch([f"mkdir -p {wheelhouse_dir}", f"tar -xf {wheelhouse_filename} -C {wheelhouse_dir}"])
+        else:
+            with phase("upload_wheelhouse") as event, \
+                    host.open_stream(
+                        f"mkdir -p {wheelhouse_dir} && tar -xf - -C {wheelhouse_dir}",
+                        size=os.path.getsize(wheelhouse_filename)
+                    ) as stdin:
+                with open(wheelhouse_filename, "rb") as f:
+                    shutil.copyfileobj(f, CountingWriter(stdin, event), 1024*1024)
+        print("Done!")
+
     lines = []
-    if not config_only:
+    if update_app:
         # create directories
         lines.extend([
-            f"mkdir -p {host.path('apps', app.name)}",
-            f"mkdir -p {host.path('apps', app.name, app.manifest.version)}",
-            f"rm -rf {host.path('apps', app.name, app.manifest.version, '*')}",
             f"mkdir -p {host.path('logs', app.name)}",
             f"mkdir -p {host.path('configs', app.name)}",
             f"mkdir -p {host.path('data', app.name)}",
             f"mkdir -p {host.path('pids', app.name)}",
+            # replace the version with the staging directory
+            f"rm -rf {host.path('apps', app.name, app.manifest.version)}",
+            f"mv {staging_dir} {host.path('apps', app.name, app.manifest.version)}",
+            f"mv {host.path('temp', app.name, '_files.json')} {host.path('apps', app.name, app.manifest.version, FILE_MANIFEST_FILENAME)}",
             # remove and re-create the sym link point to the current version of the app
             f"rm -f {host.path('apps', app.name, 'current')}",
             f"ln -s {host.path('apps', app.name, app.manifest.version)} {host.path('apps', app.name, 'current')}",
-            # extract app archive
-            f"tar -xzf {host.path('temp', app.name, app.archive_filename)} -C {host.path('apps', app.name, app.manifest.version)}",
         ])
     # move config file from temp dir
-    for filename in list(app.config.keys()) + ['_deployment.json']:
+    for filename in config_filenames:
         lines.append(f"mv {host.path('temp', app.name, filename)} {host.path('configs', app.name, filename)}")
-    if not config_only:
-        # finally, let's remove the archive_filename and staging area in temp
-        lines.append(f"rm {host.path('temp', app.name, app.archive_filename)}")
-    lines.append(f"rmdir {host.path('temp', app.name)}")
-
-    if not config_only:
-        # recreate venv since dependencies may have changed
-        if update_venv:
-            lines.append(f"rm -rf {host.path('venvs', app.venv_name)}")
-            if app.use_python3:
-                lines.append(f"{host.python3} -m venv {host.path('venvs', app.venv_name)}")
-            else:
-                lines.append(f"{host.virtualenv} {host.path('venvs', app.venv_name)}")
-            lines.append(
-                f"{host.path('bin', 'install_packages.sh')} {host.env_home} {app.name} {app.manifest.version} {app.requirements}")
-            lines.append(f"rm -f {host.path('venvs', app.name)}")
-            # create a symlink
-            lines.append(f"ln -s {host.path('venvs', app.venv_name)} {host.path('venvs', app.name)}")
-            print("    Update application, configuration and virtual environment ... ", end="", flush=True)
+    lines.append(
+        f"mv {host.path('temp', app.name, '_digests.json')} {host.path('configs', app.name, CONFIG_DIGESTS_FILENAME)}"
+    )
+    # the virtual environment is set up in its own batch, so it is timed on its own
+    venv_lines = []
+    if not config_only and update_venv:
+        # virtual environments are shared by versions with the same requirements and python
+        # interpreter, only create one if there is no such virtual environment yet, unless forced
+        if wheelhouse_filename is None:
+            venv_lines.extend(get_venv_lines(app, host, rebuild=force))
         else:
-            print("    Update application and configuration ... ", end="", flush=True)
+            venv_lines.extend(get_venv_lines(
+                app, host, wheelhouse_dir=host.path('temp', app.name, '_wheelhouse'), rebuild=force
+            ))
+            venv_lines.append(f"rm -rf {host.path('temp', app.name, '_wheelhouse')}")
+    if update_app and venv_lines:
+        print("    Update application, configuration and virtual environment ... ", end="", flush=True)
+    elif update_app:
+        print("    Update application and configuration ... ", end="", flush=True)
+    elif venv_lines:
+        print("    Update configuration and virtual environment ... ", end="", flush=True)
     else:
         print("    Update configuration ... ", end="", flush=True)
+    rmdir_line = f"rmdir {host.path('temp', app.name)}"
 
-    host.execute_batch(lines)
+    with phase("finalize"):
+        host.execute_batch(lines if venv_lines else lines + [rmdir_line])
+    if venv_lines:
+        with phase("update_venv"):
+            host.execute_batch(venv_lines + [rmdir_line])
     print("Done!")
 
     if app.manifest.on_stage is not None:
-        run_app_on_host(app, host, app.manifest.on_stage, prefix="    ")
+        with phase("on_stage"):
+            run_app_on_host(app, host, app.manifest.on_stage, prefix="    ")
+
+    # only recorded once the whole stage succeeded, a failed stage is redone next time
+    if deploy_state is not None:
+        if update_app:
+            version, venv_digest = app.manifest.version, None
+        elif host_state is not None:
+            version, files_digest, venv_digest = host_state.version, host_state.files_digest, host_state.venv_digest
+        else:
+            # config only, we do not know what else the host has
+            version, files_digest, venv_digest = None, None, None
+        if venv_lines:
+            venv_digest = app.get_venv_digest()
+        with phase("record_state"):
+            fingerprint = get_host_fingerprint(app, host)
+            if fingerprint is not None:
+                deploy_state.put(HostState(
+                    host.name, app.name, version, files_digest, venv_digest, config_digests, fingerprint
+                ))
     print("Done!")
     print("")
 
 
+def get_venv_lines(
+    app: AppConfig,
+    host: HostConfig,
+    wheelhouse_dir: Optional[str] = None,
+    rebuild: bool = False
+) -> List[str]:
+    """ Get the shell lines to set up the virtual environment for an application version
+
+    venvs/<app>-<version> is a symlink to venvs/<app>-<digest>, the digest covers the requirements
+    files and the python interpreter on host, the virtual environment is only created and packages
+    are only installed if it does not exist yet.
+
+    :param app: application config
+    :param host: host config
+    :param wheelhouse_dir: if specified, install packages from this directory on host, without package index
+    :param rebuild: remove the virtual environment first, so it is created and packages are installed again
+    :return: list of shell lines
+    """
+    venv_version_dir = host.path('venvs', app.venv_name)
+    # short hash of the interpreter path and version, computed on host
+    python_digest = f"$({host.python3} -c 'import sys; print(sys.executable, sys.version)' | cksum | cut -d ' ' -f 1)"
+    return [
+        f"VENV_DIR={host.path('venvs', app.name)}-{app.get_venv_digest()[:16]}-{python_digest}",
+    ] + (["rm -rf $VENV_DIR"] if rebuild else []) + [
+        f"rm -rf {venv_version_dir}",
+        f"ln -s $VENV_DIR {venv_version_dir}",
+        "if [ ! -e $VENV_DIR/.mordor_complete ]",
+        "then",
+        "    rm -rf $VENV_DIR",
+        f"    {host.python3} -m venv $VENV_DIR",
+        f"    {host.path('bin', 'install_packages.sh')} {host.env_home} {app.name} {app.manifest.version} {app.requirements} {wheelhouse_dir or ''} && touch $VENV_DIR/.mordor_complete || exit 1",
+        "fi",
+        f"rm -f {host.path('venvs', app.name)}",
+        # create a symlink
+        f"ln -s {venv_version_dir} {host.path('venvs', app.name)}",
+    ]
+
+
+def get_verified_host_state(deploy_state: DeployState, app: AppConfig, host: HostConfig) -> Optional[HostState]:
+    """ Get what the state database says an application has on a host, if the host still matches it
+
+    :param deploy_state: the state database
+    :param app: application config
+    :param host: host config
+    :return: the record, None if there is none or the fingerprint of the host changed since
+    """
+    host_state = deploy_state.get(host.name, app.name)
+    if host_state is not None and host_state.fingerprint != get_host_fingerprint(app, host):
+        return None
+    return host_state
+
+
+def has_app_files(host_state: Optional[HostState], app: AppConfig, files_digest: Optional[str]) -> bool:
+    """ Check if a host has the version of the application being staged, with the same files
+
+    :param host_state: the record for the host, from get_verified_host_state
+    :param app: application config
+    :param files_digest: digest of the per file manifest being staged
+    :return: True if the application does not need to be staged on the host
+    """
+    return host_state is not None and \
+        (host_state.version, host_state.files_digest) == (app.manifest.version, files_digest)
+
+
+def get_host_fingerprint(app: AppConfig, host: HostConfig) -> Optional[str]:
+    """ Get a fingerprint of what an application has on a host, with one command
+
+    It covers the current version, its per file manifest, the config digests and the virtual
+    environment the application points to, so it changes whenever a stage changes the host.
+
+    :param app: application config
+    :param host: host config
+    :return: sha256 hex digest, None if the host cannot be reached
+    """
+    current_dir = host.path('apps', app.name, 'current')
+    venv_dir = host.path('venvs', app.name)
+    output, exit_code = host.capture("{ " + "; ".join([
+        f"readlink {current_dir}",
+        f"cksum < {current_dir}/{FILE_MANIFEST_FILENAME}",
+        f"cksum < {host.path('configs', app.name, CONFIG_DIGESTS_FILENAME)}",
+        f"readlink {venv_dir}",
+        f"readlink $(readlink {venv_dir})",
+        f"ls {venv_dir}/.mordor_complete",
+    ]) + "; } 2>/dev/null; true")
+    if exit_code != 0:
+        return None
+    return hashlib.sha256(output).hexdigest()
+
+
+def has_gnu_tools(host: HostConfig) -> bool:
+    """ Check if the host has GNU cp and tar, hardlinking the previous version needs them
+
+    :param host: host config
+    :return: True if both cp and tar are GNU
+    """
+    _, exit_code = host.capture("cp --version 2>/dev/null | grep -q GNU && tar --version 2>/dev/null | grep -q GNU")
+    return exit_code == 0
+
+
+def get_current_file_manifest(app: AppConfig, host: HostConfig) -> Tuple[Optional[str], Optional[Dict[str, str]]]:
+    """ Get the per file manifest for the current version of the application on the host
+
+    :param app: application config
+    :param host: host config
+    :return: tuple, the current version directory on host and its per file manifest,
+        (None, None) if the host does not have it
+    """
+    current_dir = host.path('apps', app.name, 'current')
+    output, exit_code = host.capture(f"readlink {current_dir} && cat {current_dir}/{FILE_MANIFEST_FILENAME}")
+    if exit_code != 0:
+        return None, None
+    prev_app_dir, _, content = output.decode("utf-8").partition("\n")
+    if not prev_app_dir.startswith("/"):
+        prev_app_dir = host.path('apps', app.name, prev_app_dir)
+    return prev_app_dir, json.loads(content)
+
+
 def run_app(
     config: Config,
     app_name: str,
     stage:str = '',
     host_names: Optional[List[str]] = None,
-    cmd:str = ""
-) -> None:
+    cmd:str = "",
+    parallel: Optional[int] = None,
+    json_output: bool = False,
+    warm: bool = False
+) -> List[RunResult]:
     """Run an application on the fleet for a stage
 
+    Output of every host is streamed line by line, prefixed with the host name.
+
     :param config: overall config
     :param app_name: application name
     :param stage: application stage, e.g., "beta", "prod", etc.
     :param host_names: if specified, we only stage to this list of hosts, otherwise, we stage to all hosts for the stage
     :param cmd: the command to run
-    :return: Nothing
+    :param parallel: max number of hosts to run on concurrently, default to all hosts
+    :param json_output: print the results as json instead of a summary, output lines go to stderr
+    :param warm: run the command with the resident dispatcher of the application on each host
+    :return: list of RunResult, one per host
     """
     app = config.get_app(app_name, stage)
     if app is None:
@@ -305,20 +636,59 @@ def run_app(
         sys.exit(1)
 
     if host_names is not None:
-        run_on = [host_names]
+        run_on = host_names
     else:
         run_on = app.deploy_to
 
     # do a check first
+    hosts = []
     for host_name in run_on:
         host = config.get_host(host_name)
         if host is None:
             print(f"Host {host_name} does not exist.")
             sys.exit(1)
+        hosts.append(host)
+
+    results = run_commands(
+        hosts,
+        # not quoted, env_home may refer to variables of the host, e.g. $HOME, the cmd is base64 encoded
+        lambda host: " ".join(get_dispatcher_args(app, host, cmd, warm=warm)),
+        parallel=len(hosts) if parallel is None else parallel,
+        stream=sys.stderr if json_output else None
+    )
+    if json_output:
+        print(json.dumps([result.to_json() for result in results], indent=4))
+    else:
+        print_run_results(results)
+    return results
 
-    for host_name in run_on:
-        host = config.get_host(host_name)
-        run_app_on_host(app, host, cmd)
+
+def get_dispatcher_args(app: AppConfig, host: HostConfig, cmd: str, warm: bool = False) -> List[str]:
+    """ Get the command line to run an application command on host
+
+    :param app: application config
+    :param host: host config
+    :param cmd: command to run
+    :param warm: run the command with the resident dispatcher of the application, which keeps
+        dispatch.py loaded, it is started if it is not running
+    :return: list of args
+    """
+    cmd_to_send = base64.b64encode(cmd.encode('utf-8')).decode('utf-8')
+    if warm:
+        return [
+            host.path("venvs", app.name, "bin", "python"),
+            host.path("bin", "warm_dispatcher.py"),
+            "run",
+            host.env_home,
+            app.name,
+            cmd_to_send
+        ]
+    return [
+        host.path("bin", "run_dispatcher.sh"),
+        host.env_home,
+        app.name,
+        cmd_to_send
+    ]
 
 
 def run_app_on_host(
@@ -335,15 +705,7 @@ def run_app_on_host(
     :return: Nothing
     """
     print(f"{prefix}Running application {app.name} on host {host.name}, cmd: \"{cmd}\".")
-
-    cmd_to_send = base64.b64encode(cmd.encode('utf-8')).decode('utf-8')
-
-    host.execute(
-        host.path("bin", "run_dispatcher.sh"),
-        host.env_home,
-        app.name,
-        cmd_to_send
-    )
+    host.execute(*get_dispatcher_args(app, host, cmd))
 
 def main() -> None:
     parser = argparse.ArgumentParser(
@@ -378,6 +740,63 @@ def main() -> None:
         action="store_true",
         help="Specify if you want to stage configuration only",
     )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Specify if you want to upload only files changed since the current version on host",
+    )
+    parser.add_argument(
+        "--codec", type=str, required=False, choices=CODEC_NAMES,
+        help="Compression for the application archive, overrides archive_codec in application manifest"
+    )
+    parser.add_argument(
+        "--codec-level", type=int, required=False,
+        help="Compression level for the application archive, overrides archive_level in application manifest"
+    )
+    parser.add_argument(
+        "--wheelhouse",
+        action="store_true",
+        help="With --update-venv, build wheels once locally, hosts install them without package index",
+    )
+    parser.add_argument(
+        "--no-hardlink",
+        action="store_true",
+        help="Write every file of the new version, instead of hardlinking unchanged files from the current version",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="For stage, stage everything even if the state database says the host is up to date, "
+             "with --update-venv, rebuild the virtual environment",
+    )
+    parser.add_argument(
+        "--relay-fanout", type=int, default=0,
+        help="Copy the application archive to hosts through a fan-out tree, hosts relay to N other hosts at a time"
+    )
+    parser.add_argument(
+        "--parallel", type=int, default=None,
+        help="Max number of hosts to work on concurrently, default to 1, for run default to all hosts"
+    )
+    parser.add_argument(
+        "--bwlimit", type=int, default=None,
+        help="Max KB per second for all uploads together, shared fairly by the hosts",
+    )
+    parser.add_argument(
+        "--json", action="store_true", dest="json_output",
+        help="For run, print the results as json, output of hosts goes to stderr"
+    )
+    parser.add_argument(
+        "--warm", action="store_true",
+        help="For run, use the resident dispatcher of the application on each host, it keeps dispatch.py loaded"
+    )
+    parser.add_argument(
+        "--timings", action="store_true",
+        help="Print the duration and bytes of every phase on every host at the end"
+    )
+    parser.add_argument(
+        "--trace-file", type=str, required=False,
+        help="Write the duration of every phase on every host to this file, in chrome trace format"
+    )
     parser.add_argument(
         "-c", "--config-dir", type=str, required=False, help="Configuration directory",
         default=os.environ.get("MORDOR_CONFIG_DIR", os.path.expanduser("~/.mordor"))
@@ -390,6 +809,22 @@ def main() -> None:
     if args.update_venv and args.config_only:
         print("You cannot specify both --update-venv and --config-only")
         sys.exit(1)
+    if args.codec_level is not None and args.codec is None:
+        print("--codec-level requires --codec")
+        sys.exit(1)
+    if args.wheelhouse and not args.update_venv:
+        print("--wheelhouse requires --update-venv")
+        sys.exit(1)
+    if args.relay_fanout and args.delta:
+        print("You cannot specify both --relay-fanout and --delta")
+        sys.exit(1)
+    if args.parallel is not None and args.parallel < 1:
+        print("--parallel must be at least 1")
+        sys.exit(1)
+    if args.bwlimit is not None and args.bwlimit < 1:
+        print("--bwlimit must be at least 1")
+        sys.exit(1)
+    set_global_bwlimit(args.bwlimit)
 
     base_dir = os.path.abspath(os.path.dirname(__file__))
 
@@ -406,33 +841,60 @@ def main() -> None:
         print(f"Missing config file in directory {args.config_dir}")
         sys.exit(1)
 
-    config = Config(get_config(filename), config_dir)
+    config = Config(get_config_cached(filename), config_dir)
+    try:
+        do_action(action, args, base_dir, config)
+    finally:
+        # close shared ssh connections
+        config.close()
+        if args.timings:
+            get_tracer().print_summary()
+        if args.trace_file:
+            get_tracer().write_chrome_trace(args.trace_file)
 
+
+def do_action(action: str, args: argparse.Namespace, base_dir: str, config: Config) -> None:
     if action == "init-host":
         if not args.host_names:
             print("--host-names must be specified.")
             sys.exit(1)
-        init_hosts(base_dir, config, args.host_names)
+        results = init_hosts(base_dir, config, args.host_names, parallel=args.parallel or 1)
+        if not all(result.succeeded for result in results):
+            sys.exit(1)
         return
 
     if action == "stage":
         if not args.app_name:
             print("--app-name must be specified.")
             sys.exit(1)
-        stage_app(
+        results = stage_app(
             config, args.app_name, args.update_venv, args.config_only,
             stage=args.stage,
-            host_names=args.host_names
+            host_names=args.host_names,
+            parallel=args.parallel or 1,
+            delta=args.delta,
+            archive_codec=None if args.codec is None else ArchiveCodec(args.codec, args.codec_level),
+            relay_fanout=args.relay_fanout,
+            wheelhouse=args.wheelhouse,
+            hardlink=not args.no_hardlink,
+            force=args.force
         )
+        if not all(result.succeeded for result in results):
+            sys.exit(1)
         return
 
     if action == "run":
-        run_app(
+        results = run_app(
             config, args.app_name,
             stage = args.stage,
             host_names = args.host_names,
-            cmd = args.cmd
+            cmd = args.cmd,
+            parallel = args.parallel,
+            json_output = args.json_output,
+            warm = args.warm
         )
+        if not all(result.succeeded for result in results):
+            sys.exit(1)
         return
 
 if __name__ == '__main__':
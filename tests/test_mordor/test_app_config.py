@@ -0,0 +1,105 @@
+import os
+import shutil
+import tarfile
+import subprocess
+
+import pytest
+
+from mordor.libs import AppConfig
+from mordor.libs.app_config import is_excluded, get_changed_names
+from mordor.libs.compression import ArchiveCodec
+from mordor.libs.artifact_cache import ArtifactCache, get_artifact_digest
+from mordor.libs.tools import file_digest
+
+
+def _create_app(tmp_path, manifest="version: 0.0.1\nexclude_dirs:\n  - dir_ignore\n"):
+    home_dir = tmp_path / "src"
+    home_dir.mkdir()
+    (home_dir / "manifest.yaml").write_text(manifest)
+    (home_dir / "main.py").write_text("print('hello')\n")
+    (home_dir / "sub").mkdir()
+    (home_dir / "sub" / "a.txt").write_text("a\n")
+    (home_dir / "sub" / "dir_ignore").mkdir()
+    (home_dir / "sub" / "dir_ignore" / "b.txt").write_text("b\n")
+    (home_dir / ".hidden").write_text("hidden\n")
+    return AppConfig("sample", {"home_dir": str(home_dir), "deploy_to": []})
+
+
+def test_is_excluded():
+    assert is_excluded("dir_ignore", ["dir_ignore"])
+    assert is_excluded("a/dir_ignore", ["dir_ignore"])
+    assert is_excluded("a/b.pyc", ["*.pyc"])
+    assert not is_excluded("a/dir_ignore2", ["dir_ignore"])
+
+
+def test_get_changed_names():
+    prev_file_manifest = {"a": "1", "b": "dir", "b/c": "2", "d": "dir", "d/e": "3", "f": "4"}
+    file_manifest = {"a": "1", "b": "5", "d": "dir", "d/e": "6", "g": "dir", "g/h": "7"}
+    # b turns from a directory into a file, its content goes with it
+    assert get_changed_names(prev_file_manifest, file_manifest) == ["b", "d/e", "f", "g"]
+
+
+def test_create_file_manifest(tmp_path):
+    app = _create_app(tmp_path)
+    manifest = app.create_file_manifest()
+    assert list(manifest.keys()) == ["main.py", "manifest.yaml", "sub", "sub/a.txt"]
+    assert manifest["sub"] == "dir"
+
+    os.symlink("a.txt", app.path("sub", "link"))
+    (tmp_path / "src" / "main.py").write_text("print('bye')\n")
+    new_manifest = app.create_file_manifest()
+    assert new_manifest["sub/link"] == "symlink:a.txt"
+    assert new_manifest["main.py"] != manifest["main.py"]
+    assert new_manifest["sub/a.txt"] == manifest["sub/a.txt"]
+
+
+def test_create_archive_reproducible(tmp_path):
+    app = _create_app(tmp_path)
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    archive_filename = app.create_archive(cache)
+    with open(archive_filename, "rb") as f:
+        content = f.read()
+
+    # a fresh build of the same tree gives the same bytes, even with different mtimes
+    os.utime(app.path("main.py"), (0, 12345))
+    rebuilt_filename = str(tmp_path / "rebuilt.tar.gz")
+    with open(rebuilt_filename, "wb") as f:
+        app.write_archive(f, app.create_file_manifest())
+    with open(rebuilt_filename, "rb") as f:
+        assert f.read() == content
+
+    with tarfile.open(archive_filename) as tar:
+        assert tar.getnames() == ["main.py", "manifest.yaml", "sub", "sub/a.txt"]
+        assert all(member.mtime == 0 and member.uid == 0 for member in tar.getmembers())
+
+
+def test_create_archive_cached(tmp_path):
+    app = _create_app(tmp_path)
+    cache = ArtifactCache(str(tmp_path / "cache"), max_entries=1)
+    archive_filename = app.create_archive(cache)
+    assert app.create_archive(cache) == archive_filename
+    assert get_artifact_digest(archive_filename) == file_digest(archive_filename)
+
+    (tmp_path / "src" / "main.py").write_text("print('bye')\n")
+    new_archive_filename = app.create_archive(cache)
+    assert new_archive_filename != archive_filename
+    # only one entry is allowed, the least recently used one is evicted
+    assert not os.path.exists(archive_filename)
+    assert os.path.exists(new_archive_filename)
+
+
+@pytest.mark.parametrize("codec_name", ["gzip", "zstd", "none"])
+def test_archive_codec(tmp_path, codec_name):
+    if codec_name == "zstd" and shutil.which("zstd") is None:
+        pytest.skip("zstd is not installed")
+    app = _create_app(tmp_path)
+    app.archive_codec = ArchiveCodec(codec_name)
+    assert app.archive_filename == "sample-0.0.1" + app.archive_codec.extension
+    archive_filename = app.create_archive(ArtifactCache(str(tmp_path / "cache")))
+
+    dest_dir = tmp_path / "dest"
+    dest_dir.mkdir()
+    subprocess.check_call(
+        ["bash", "-c", app.archive_codec.extract_command(str(dest_dir), archive_filename=archive_filename)]
+    )
+    assert (dest_dir / "sub" / "a.txt").read_text() == "a\n"
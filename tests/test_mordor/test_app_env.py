@@ -0,0 +1,99 @@
+import copy
+import json
+import os
+
+import pytest
+
+from mordor import AppEnv
+from mordor.app_env import get_tree_digest, process_templates, sync_tree
+
+
+def _stage(env_home, version, config):
+    app_dir = env_home / "apps" / "sample" / version
+    app_dir.mkdir(parents=True)
+    (app_dir / "manifest.json").write_text(json.dumps({"version": version}))
+    current = env_home / "apps" / "sample" / "current"
+    if os.path.lexists(current):
+        current.unlink()
+    current.symlink_to(app_dir)
+    config_dir = env_home / "configs" / "sample"
+    config_dir.mkdir(parents=True, exist_ok=True)
+    # write to a new file then rename, as a stage does
+    (config_dir / "app.json.new").write_text(json.dumps(config))
+    os.replace(config_dir / "app.json.new", config_dir / "app.json")
+
+
+def test_app_env_cache(tmp_path):
+    _stage(tmp_path, "1.0", {"servers": ["a"], "db": {"port": 1}})
+    app_env = AppEnv("sample", env_home=str(tmp_path))
+    assert app_env.version == "1.0"
+    config = app_env.get_config("app.json")
+    assert config == {"servers": ("a",), "db": {"port": 1}}
+    # parsed once, shared by every caller
+    assert AppEnv("sample", env_home=str(tmp_path)).get_config("app.json") is config
+
+    with pytest.raises(TypeError):
+        config["db"]["port"] = 2
+    with pytest.raises(TypeError):
+        config.update({"x": 1})
+    mutable = copy.deepcopy(config)
+    mutable["db"]["port"] = 2
+    mutable["servers"].append("b")
+    assert dict(config)["db"] == {"port": 1}
+
+    # a new stage flips current and replaces the config
+    _stage(tmp_path, "2.0", {"servers": ["b"]})
+    app_env = AppEnv("sample", env_home=str(tmp_path))
+    assert app_env.version == "2.0"
+    assert app_env.get_config("app.json") == {"servers": ("b",)}
+
+
+def test_sync_tree(tmp_path):
+    src = tmp_path / "src"
+    (src / "docker").mkdir(parents=True)
+    (src / "pkg").mkdir()
+    (src / "pkg" / "a.py").write_text("a")
+    (src / "b.py").write_text("b")
+    (src / "docker" / "Dockerfile").write_text("FROM x")
+    (src / "link").symlink_to("b.py")
+    dst = tmp_path / "dst"
+    sync_tree(str(src), str(dst), exclude=["docker"])
+    assert sorted(os.listdir(dst)) == ["b.py", "link", "pkg"]
+    assert os.readlink(dst / "link") == "b.py"
+    digest = get_tree_digest(str(dst), str(tmp_path / "digests.json"))
+
+    mtime = os.stat(dst / "b.py").st_mtime_ns
+    (src / "pkg" / "a.py").unlink()
+    (src / "pkg" / "c.py").write_text("c")
+    sync_tree(str(src), str(dst), exclude=["docker"])
+    assert sorted(os.listdir(dst / "pkg")) == ["c.py"]
+    # unchanged files are not touched
+    assert os.stat(dst / "b.py").st_mtime_ns == mtime
+    assert get_tree_digest(str(dst), str(tmp_path / "digests.json")) != digest
+
+
+def test_process_templates(tmp_path, monkeypatch):
+    _stage(tmp_path, "1.0", {})
+    app_dir = tmp_path / "apps" / "sample" / "1.0"
+    (app_dir / "tpl" / "sub").mkdir(parents=True)
+    (app_dir / "tpl" / "a.txt.template").write_text("{{ name }}")
+    (app_dir / "tpl" / "static.txt").write_text("static")
+    (app_dir / "tpl" / "sub" / "b.txt.template").write_text("{{ app_env.app_name }}")
+    monkeypatch.setenv("ENV_HOME", str(tmp_path))
+    app_env = AppEnv("sample")
+    out_dir = tmp_path / "data" / "sample" / "tpl"
+
+    process_templates("sample", "tpl", {"name": "x", "app_env": app_env})
+    assert (out_dir / "a.txt").read_text() == "x"
+    assert (out_dir / "static.txt").read_text() == "static"
+    assert (out_dir / "sub" / "b.txt").read_text() == "sample"
+
+    # same context, nothing is rendered again
+    stat_a = os.stat(out_dir / "a.txt")
+    process_templates("sample", "tpl", {"name": "x", "app_env": AppEnv("sample")})
+    assert os.stat(out_dir / "a.txt").st_mtime_ns == stat_a.st_mtime_ns
+
+    (app_dir / "tpl" / "static.txt").unlink()
+    process_templates("sample", "tpl", {"name": "y", "app_env": app_env})
+    assert (out_dir / "a.txt").read_text() == "y"
+    assert sorted(os.listdir(out_dir)) == ["a.txt", "sub"]
@@ -0,0 +1,37 @@
+import io
+import threading
+import time
+
+from mordor.libs.bandwidth import ThrottledWriter, TokenBucket, TransferMonitor
+
+
+def test_throttled_writer_shares_bucket_fairly():
+    # 2 MB/s for both writers together, 64 KB burst
+    bucket = TokenBucket(2*1024*1024, burst=64*1024)
+    outputs = [io.BytesIO(), io.BytesIO()]
+    finish_times = []
+
+    def write(output):
+        ThrottledWriter(output, [bucket]).write(b"x" * 512*1024)
+        finish_times.append(time.monotonic())
+
+    start_time = time.monotonic()
+    threads = [threading.Thread(target=write, args=(output,)) for output in outputs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [len(output.getvalue()) for output in outputs] == [512*1024, 512*1024]
+    # 1 MB at 2 MB/s
+    assert min(finish_times) - start_time > 0.35
+    # they take turns, so they finish at about the same time
+    assert max(finish_times) - min(finish_times) < 0.2
+
+
+def test_transfer_monitor_status():
+    monitor = TransferMonitor(out=io.StringIO())
+    transfer = monitor.start("h1", size=4*1024*1024)
+    ThrottledWriter(io.BytesIO(), [], transfer).write(b"x" * 1024*1024)
+    assert monitor.get_status(1024*1024) == "uploading to 1 host(s), 1.0 MB, 1.0 MB/s of 4.0 MB, ETA 3s"
+    transfer.close()
@@ -0,0 +1,62 @@
+import json
+
+from mordor.libs import AppConfig, HostConfig
+from mordor.libs.config_renderer import ConfigRenderer, get_config_digests, get_remote_config_digests
+
+
+class FakeHost:
+    def __init__(self, stdout, exit_code):
+        self.stdout = stdout
+        self.exit_code = exit_code
+
+    def path(self, *args):
+        return "/env/" + "/".join(args)
+
+    def capture(self, command):
+        return self.stdout, self.exit_code
+
+
+def test_render(tmp_path, monkeypatch):
+    monkeypatch.setenv("MORDOR_CACHE_DIR", str(tmp_path / "cache"))
+    home_dir = tmp_path / "src"
+    home_dir.mkdir()
+    (home_dir / "manifest.yaml").write_text("version: 0.0.1\n")
+    config_base_dir = tmp_path / "config" / "configs" / "sample"
+    (config_base_dir / "beta" / "h2").mkdir(parents=True)
+    (config_base_dir / "a.txt").write_text("base\n")
+    (config_base_dir / "beta" / "a.txt").write_text("beta\n")
+    (config_base_dir / "beta" / "h2" / "a.txt").write_text("h2\n")
+    (config_base_dir / "b.txt").write_text("{env_home}/{app_name}\n")
+    (config_base_dir / "c.txt").write_text("{{ host_name }}:{{ log_dir }}")
+
+    app = AppConfig("sample_beta", {
+        "name": "sample",
+        "stage": "beta",
+        "home_dir": str(home_dir),
+        "deploy_to": ["h1", "h2"],
+        "config": {"a.txt": "copy", "b.txt": "convert", "c.txt": "template"},
+    })
+    renderer = ConfigRenderer(str(tmp_path / "config"), app, "beta")
+    h1 = HostConfig("h1", {"env_home": "/env/h1"})
+    h2 = HostConfig("h2", {"env_home": "/env/h2"})
+
+    files = renderer.render(h1)
+    assert files["a.txt"] == b"beta\n"
+    assert files["b.txt"] == b"/env/h1/sample\n"
+    assert files["c.txt"] == b"h1:/env/h1/logs/sample"
+    assert json.loads(files["_deployment.json"])["host"]["name"] == "h1"
+
+    # host specific config first, the template is compiled once and rendered per host
+    files = renderer.render(h2)
+    assert files["a.txt"] == b"h2\n"
+    assert files["c.txt"] == b"h2:/env/h2/logs/sample"
+
+
+def test_remote_config_digests():
+    app = AppConfig("sample", {"home_dir": "/tmp", "deploy_to": []})
+    digests = get_config_digests({"a.txt": b"a"})
+    assert digests == {"a.txt": "ca978112ca1bbdcafac231b39a23dc4da786eff8147c4e72b9807785afee48bb"}
+    assert get_remote_config_digests(app, FakeHost(json.dumps(digests).encode("utf-8"), 0)) == digests
+    # never pushed, or broken digests, every config is pushed
+    assert get_remote_config_digests(app, FakeHost(b"", 1)) == {}
+    assert get_remote_config_digests(app, FakeHost(b"{broken", 0)) == {}
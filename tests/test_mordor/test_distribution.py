@@ -0,0 +1,40 @@
+from contextlib import contextmanager
+import io
+
+from mordor.libs.distribution import distribute_artifact
+
+
+class FakeHost:
+    def __init__(self, name, log):
+        self.name = name
+        self.relay_host = name
+        self.log = log
+
+    @contextmanager
+    def open_stream(self, command, size=None):
+        self.log.append(("controller", self.name))
+        yield io.BytesIO()
+
+    def capture(self, command):
+        dst = command.split(" ssh -q -o BatchMode=yes ")[1].split()[0]
+        self.log.append((self.name, dst))
+        return b"", 1 if dst == "h5" else 0
+
+
+def test_distribute_artifact(tmp_path):
+    artifact = tmp_path / "a.tar.gz"
+    artifact.write_bytes(b"x" * 10)
+    log = []
+    hosts = [FakeHost(f"h{i}", log) for i in range(10)]
+    status = distribute_artifact(hosts, str(artifact), "0" * 64, lambda host: f"/tmp/{host.name}/a.tar.gz", fanout=2)
+
+    # controller only sends to the seeds
+    assert sorted(dst for (src, dst) in log if src == "controller") == ["h0", "h1"]
+    # every host receives exactly once
+    assert sorted(dst for (_, dst) in log) == sorted(host.name for host in hosts)
+    # a host only relays after it has the artifact
+    received = {"controller"}
+    for (src, dst) in log:
+        assert src in received
+        received.add(dst)
+    assert [name for (name, ok) in status.items() if not ok] == ["h5"]
@@ -0,0 +1,138 @@
+import json
+import os
+import subprocess
+import sys
+
+# stand-ins for ssh and scp, every host is a local directory
+FAKE_FLEET_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "benchmarks", "fake_fleet")
+
+
+def _mordor(tmp_path, *args):
+    env = dict(os.environ)
+    env["PATH"] = os.path.abspath(FAKE_FLEET_DIR) + os.pathsep + env["PATH"]
+    env["HOME"] = str(tmp_path / "home")
+    env["MORDOR_CACHE_DIR"] = str(tmp_path / "cache")
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    return subprocess.run(
+        [sys.executable, "-m", "mordor.mordor"] + list(args) + ["-c", str(tmp_path / "config")],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+
+def test_stage_and_run(tmp_path):
+    (tmp_path / "home").mkdir()
+    home_dir = tmp_path / "app"
+    home_dir.mkdir()
+    (home_dir / "manifest.yaml").write_text("version: 0.0.1\n")
+    (home_dir / "dispatch.py").write_text("import sys\nprint('hello', *sys.argv[1:])\n")
+    (tmp_path / "config" / "configs" / "sample").mkdir(parents=True)
+    (tmp_path / "config" / "configs" / "sample" / "app.json").write_text('{"host": "{{ host_name }}"}')
+    (tmp_path / "config" / "config.json").write_text(json.dumps({
+        "hosts": {name: {"env_home": str(tmp_path / "fleet" / name)} for name in ["h1", "h2"]},
+        "deployments": {
+            "sample_beta": {
+                "name": "sample",
+                "stage": "beta",
+                "home_dir": str(home_dir),
+                "deploy_to": ["h1", "h2"],
+                "config": {"app.json": "template"},
+            }
+        }
+    }))
+
+    assert _mordor(tmp_path, "init-host", "-o", "h1", "h2", "--parallel", "2").returncode == 0
+    assert _mordor(tmp_path, "stage", "-p", "sample", "-s", "beta", "--parallel", "2", "--bwlimit", "10000").returncode == 0
+    for name in ["h1", "h2"]:
+        app_json = tmp_path / "fleet" / name / "configs" / "sample" / "app.json"
+        assert json.loads(app_json.read_text()) == {"host": name}
+        assert (tmp_path / "fleet" / name / "apps" / "sample" / "current" / "dispatch.py").is_file()
+
+    # the state database knows the hosts have it
+    p = _mordor(tmp_path, "stage", "-p", "sample", "-s", "beta")
+    assert p.returncode == 0
+    assert p.stdout.decode().count("Already up to date, skipped.") == 2
+    # unless a host changed behind its back
+    (tmp_path / "fleet" / "h1" / "configs" / "sample" / "app.json").write_text("{}")
+    (tmp_path / "fleet" / "h1" / "configs" / "sample" / ".mordor_digests.json").write_text("{}")
+    p = _mordor(tmp_path, "stage", "-p", "sample", "-s", "beta")
+    assert p.stdout.decode().count("Already up to date, skipped.") == 1
+    assert json.loads((tmp_path / "fleet" / "h1" / "configs" / "sample" / "app.json").read_text()) == {"host": "h1"}
+
+    p = _mordor(tmp_path, "run", "-p", "sample", "-s", "beta", "--cmd", "world", "--json")
+    assert p.returncode == 0
+    results = json.loads(p.stdout)
+    # no virtual environment was created, the dispatcher complains about it on stderr
+    assert [(result["host"], result["exit_code"], result["tail"][-1]) for result in results] == [
+        ("h1", 0, "hello world"),
+        ("h2", 0, "hello world"),
+    ]
+
+
+def test_stage_state_recorded_on_success(tmp_path):
+    (tmp_path / "home").mkdir()
+    home_dir = tmp_path / "app"
+    home_dir.mkdir()
+    (home_dir / "manifest.yaml").write_text("version: 0.0.1\non_stage: check\n")
+    # on_stage fails as long as the flag file exists
+    flag = tmp_path / "fail"
+    (home_dir / "dispatch.py").write_text(f"import os, sys\nsys.exit(1 if os.path.exists({str(flag)!r}) else 0)\n")
+    (tmp_path / "config").mkdir()
+    (tmp_path / "config" / "config.json").write_text(json.dumps({
+        "hosts": {name: {"env_home": str(tmp_path / "fleet" / name)} for name in ["h1", "h2"]},
+        "deployments": {
+            "sample_beta": {
+                "name": "sample",
+                "stage": "beta",
+                "home_dir": str(home_dir),
+                "deploy_to": ["h1", "h2"],
+                "config": {},
+            }
+        }
+    }))
+    assert _mordor(tmp_path, "init-host", "-o", "h1", "h2").returncode == 0
+
+    flag.write_text("")
+    assert _mordor(tmp_path, "stage", "-p", "sample", "-s", "beta").returncode != 0
+    # nothing was recorded for the failed stage
+    flag.unlink()
+    p = _mordor(tmp_path, "stage", "-p", "sample", "-s", "beta", "--relay-fanout", "2")
+    assert p.returncode == 0
+    assert "Already up to date, skipped." not in p.stdout.decode()
+    assert "Distribute artifact to" in p.stdout.decode()
+
+    # nothing is relayed to hosts which are up to date
+    p = _mordor(tmp_path, "stage", "-p", "sample", "-s", "beta", "--relay-fanout", "2")
+    assert p.returncode == 0
+    assert p.stdout.decode().count("Already up to date, skipped.") == 2
+    assert "Distribute artifact to" not in p.stdout.decode()
+
+
+def test_run_env_home_with_variables(tmp_path):
+    # as in the samples, env_home is expanded by the shell of the host
+    (tmp_path / "home").mkdir()
+    home_dir = tmp_path / "app"
+    home_dir.mkdir()
+    (home_dir / "manifest.yaml").write_text("version: 0.0.1\n")
+    (home_dir / "dispatch.py").write_text("import sys\nprint('hello', *sys.argv[1:])\n")
+    (tmp_path / "config").mkdir()
+    (tmp_path / "config" / "config.json").write_text(json.dumps({
+        "hosts": {"h1": {"env_home": "$HOME/mordor"}},
+        "deployments": {
+            "sample_beta": {
+                "name": "sample",
+                "stage": "beta",
+                "home_dir": str(home_dir),
+                "deploy_to": ["h1"],
+                "config": {},
+            }
+        }
+    }))
+
+    assert _mordor(tmp_path, "init-host", "-o", "h1").returncode == 0
+    assert _mordor(tmp_path, "stage", "-p", "sample", "-s", "beta").returncode == 0
+    assert (tmp_path / "home" / "mordor" / "apps" / "sample" / "current" / "dispatch.py").is_file()
+    p = _mordor(tmp_path, "run", "-p", "sample", "-s", "beta", "--cmd", "world", "--json")
+    assert p.returncode == 0
+    assert [(result["exit_code"], result["tail"][-1]) for result in json.loads(p.stdout)] == [(0, "hello world")]
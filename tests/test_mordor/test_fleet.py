@@ -0,0 +1,70 @@
+import threading
+import time
+
+from mordor.libs import HostConfig, run_on_hosts, run_commands
+
+
+def _hosts(count):
+    return [HostConfig(f"host{i}", {"env_home": "/tmp/mordor"}) for i in range(count)]
+
+
+def test_run_on_hosts_parallel():
+    lock = threading.Lock()
+    active = [0, 0]  # current, max
+
+    def action(host):
+        with lock:
+            active[0] += 1
+            active[1] = max(active[1], active[0])
+        print(f"begin {host.name}")
+        time.sleep(0.05)
+        print(f"end {host.name}")
+        with lock:
+            active[0] -= 1
+
+    results = run_on_hosts(_hosts(6), action, parallel=3)
+    assert [result.host_name for result in results] == [f"host{i}" for i in range(6)]
+    assert all(result.succeeded for result in results)
+    assert active[1] == 3
+
+
+def test_run_on_hosts_output_not_interleaved(capsys):
+    def action(host):
+        print(f"begin {host.name}")
+        time.sleep(0.02)
+        print(f"end {host.name}")
+
+    run_on_hosts(_hosts(4), action, parallel=4)
+    lines = capsys.readouterr().out.splitlines()
+    for i in range(0, len(lines), 2):
+        assert lines[i].replace("begin", "end") == lines[i + 1]
+
+
+def test_run_on_hosts_failure_does_not_stop_others():
+    def action(host):
+        if host.name == "host1":
+            raise Exception("boom")
+
+    results = run_on_hosts(_hosts(3), action, parallel=2)
+    assert [result.succeeded for result in results] == [True, False, True]
+    assert results[1].error == "boom"
+
+
+class FakeHost(HostConfig):
+    def stream_output(self, command, on_output):
+        for i in range(7):
+            on_output("stdout", f"{command} {i}")
+        on_output("stderr", "done")
+        return 2 if self.name == "host1" else 0
+
+
+def test_run_commands(capsys):
+    hosts = [FakeHost(f"host{i}", {"env_home": "/tmp/mordor"}) for i in range(3)]
+    results = run_commands(hosts, lambda host: f"echo {host.name}", parallel=3, tail_lines=3)
+    assert [result.exit_code for result in results] == [0, 2, 0]
+    assert [result.succeeded for result in results] == [True, False, True]
+    assert results[1].tail == ["echo host1 5", "echo host1 6", "done"]
+
+    captured = capsys.readouterr()
+    assert "host1 | echo host1 0" in captured.out.splitlines()
+    assert sorted(captured.err.splitlines()) == ["host0 | done", "host1 | done", "host2 | done"]
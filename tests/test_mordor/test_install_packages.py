@@ -0,0 +1,126 @@
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import zipfile
+
+from mordor.libs import AppConfig, HostConfig
+from mordor.libs.artifact_cache import ArtifactCache
+from mordor.mordor import get_venv_lines
+
+INSTALL_PACKAGES = os.path.join(
+    os.path.dirname(__file__), "..", "..", "src", "mordor", "bin", "install_packages.sh"
+)
+
+
+def _install(env_home, wheelhouse_dir):
+    return subprocess.run(
+        ["bash", INSTALL_PACKAGES, str(env_home), "sample", "1.0", "requirements.txt", str(wheelhouse_dir)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    ).returncode
+
+
+def _write_wheel(dir_path):
+    # a pure python package without dependencies, pip needs no package index for it
+    filename = dir_path / "mordor_sample-1.0-py3-none-any.whl"
+    with zipfile.ZipFile(filename, "w") as f:
+        f.writestr("mordor_sample.py", "VALUE = 42\n")
+        f.writestr("mordor_sample-1.0.dist-info/METADATA", "Metadata-Version: 2.1\nName: mordor-sample\nVersion: 1.0\n")
+        f.writestr(
+            "mordor_sample-1.0.dist-info/WHEEL",
+            "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n"
+        )
+        f.writestr(
+            "mordor_sample-1.0.dist-info/RECORD",
+            "mordor_sample.py,,\nmordor_sample-1.0.dist-info/METADATA,,\n"
+            "mordor_sample-1.0.dist-info/WHEEL,,\nmordor_sample-1.0.dist-info/RECORD,,\n"
+        )
+    return filename
+
+
+def _create_venv(env_home):
+    # pip of the test interpreter, no package index needed
+    subprocess.check_call(
+        [sys.executable, "-m", "venv", "--without-pip", "--system-site-packages", str(env_home / "venvs" / "sample-1.0")]
+    )
+
+
+def test_install_packages_fails_on_pip_failure(tmp_path):
+    app_dir = tmp_path / "apps" / "sample" / "1.0"
+    app_dir.mkdir(parents=True)
+    (tmp_path / "wheelhouse").mkdir()
+    _create_venv(tmp_path)
+    assert _install(tmp_path, tmp_path / "wheelhouse") == 0
+
+    # the package is not in the wheelhouse
+    (app_dir / "requirements.txt").write_text("mordor-no-such-package\n")
+    assert _install(tmp_path, tmp_path / "wheelhouse") != 0
+
+
+def test_install_packages_from_wheelhouse(tmp_path, monkeypatch):
+    monkeypatch.setenv("PIP_DISABLE_PIP_VERSION_CHECK", "1")
+    app_dir = tmp_path / "apps" / "sample" / "1.0"
+    app_dir.mkdir(parents=True)
+    (app_dir / "requirements.txt").write_text("mordor-sample==1.0\n")
+    (tmp_path / "wheelhouse").mkdir()
+    _write_wheel(tmp_path / "wheelhouse")
+    _create_venv(tmp_path)
+
+    # packages come from the wheelhouse only
+    assert _install(tmp_path, tmp_path / "wheelhouse") == 0
+    output = subprocess.check_output(
+        [str(tmp_path / "venvs" / "sample-1.0" / "bin" / "python"), "-c", "import mordor_sample; print(mordor_sample.VALUE)"]
+    )
+    assert output.strip() == b"42"
+
+
+def test_create_wheelhouse(tmp_path, monkeypatch):
+    monkeypatch.setenv("PIP_DISABLE_PIP_VERSION_CHECK", "1")
+    wheel_filename = _write_wheel(tmp_path)
+    home_dir = tmp_path / "app"
+    home_dir.mkdir()
+    (home_dir / "requirements.txt").write_text(f"{wheel_filename}\n")
+    app = AppConfig("sample", {"home_dir": str(home_dir), "deploy_to": []})
+    cache = ArtifactCache(str(tmp_path / "cache"))
+
+    wheelhouse_filename = app.create_wheelhouse(cache)
+    with tarfile.open(wheelhouse_filename) as tar:
+        assert tar.getnames() == [wheel_filename.name]
+    # reused from the artifact cache, no wheel is built
+    wheel_filename.unlink()
+    assert app.create_wheelhouse(cache) == wheelhouse_filename
+
+    # the requirements changed
+    _write_wheel(tmp_path)
+    (home_dir / "requirements_pre.txt").write_text("")
+    assert app.create_wheelhouse(cache) != wheelhouse_filename
+
+
+def test_venv_rebuild(tmp_path):
+    home_dir = tmp_path / "app"
+    home_dir.mkdir()
+    (home_dir / "manifest.yaml").write_text("version: 1.0\n")
+    app = AppConfig("sample_beta", {"name": "sample", "stage": "beta", "home_dir": str(home_dir)})
+    host = HostConfig("localhost", {"env_home": str(tmp_path / "env"), "python3": sys.executable})
+    (tmp_path / "env" / "bin").mkdir(parents=True)
+    shutil.copy(INSTALL_PACKAGES, tmp_path / "env" / "bin" / "install_packages.sh")
+    os.chmod(tmp_path / "env" / "bin" / "install_packages.sh", 0o755)
+    (tmp_path / "env" / "apps" / "sample" / "1.0").mkdir(parents=True)
+    (tmp_path / "env" / "venvs").mkdir()
+    (tmp_path / "wheelhouse").mkdir()
+    wheelhouse_dir = str(tmp_path / "wheelhouse")
+
+    host.execute_batch(get_venv_lines(app, host, wheelhouse_dir=wheelhouse_dir))
+    venv_dir = os.path.realpath(tmp_path / "env" / "venvs" / "sample")
+    assert os.path.isfile(os.path.join(venv_dir, ".mordor_complete"))
+    # a complete virtual environment is kept as is
+    with open(os.path.join(venv_dir, "damaged"), "w"):
+        pass
+    host.execute_batch(get_venv_lines(app, host, wheelhouse_dir=wheelhouse_dir))
+    assert os.path.exists(os.path.join(venv_dir, "damaged"))
+
+    host.execute_batch(get_venv_lines(app, host, wheelhouse_dir=wheelhouse_dir, rebuild=True))
+    assert not os.path.exists(os.path.join(venv_dir, "damaged"))
+    assert os.path.isfile(os.path.join(venv_dir, ".mordor_complete"))
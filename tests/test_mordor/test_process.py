@@ -0,0 +1,47 @@
+import sys
+
+from mordor.libs.process import LineSplitter, OutputBuffer, run_process
+
+
+def test_output_buffer():
+    buffer = OutputBuffer(4)
+    buffer.write(b"abc")
+    buffer.write(b"defg")
+    assert buffer.getvalue() == b"defg"
+    assert buffer.total_size == 7
+    assert buffer.truncated
+
+
+def test_run_process_large_output():
+    # more than the pipe buffer on both stdout and stderr
+    code = "import sys; sys.stdout.write('o' * 1000000); sys.stderr.write('e' * 1000000); sys.exit(3)"
+    chunks = []
+    result = run_process([sys.executable, "-c", code], on_stdout=chunks.append, max_output=10)
+    assert result.exit_code == 3
+    assert result.stdout == b"o" * 10
+    assert result.stdout_size == 1000000
+    assert result.stderr_size == 1000000
+    assert sum(len(chunk) for chunk in chunks) == 1000000
+    assert chunks[-1] == b""
+
+
+def test_run_process_timeout():
+    result = run_process([sys.executable, "-c", "import time; time.sleep(10)"], timeout=0.2)
+    assert result.timed_out
+    assert result.exit_code != 0
+    assert result.duration < 5
+
+
+def test_run_process_timeout_kills_children():
+    # bash waits for sleep, which holds the pipes too
+    result = run_process(["bash", "-c", "sleep 4; echo x"], timeout=0.3)
+    assert result.timed_out
+    assert result.duration < 2
+
+
+def test_line_splitter():
+    lines = []
+    splitter = LineSplitter(lines.append)
+    for chunk in [b"a\r\nb", b"c\n", b"d", b""]:
+        splitter(chunk)
+    assert lines == ["a", "bc", "d"]
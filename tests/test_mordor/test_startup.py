@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# heavy modules that must only be imported by code paths needing them
+HEAVY_MODULES = ["jinja2", "yaml", "tarfile", "concurrent.futures"]
+
+
+def _imported_modules(code):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    output = subprocess.check_output(
+        [sys.executable, "-c", code + "\nimport sys\nprint('\\n'.join(sys.modules))"],
+        env=env
+    )
+    return set(output.decode("utf-8").splitlines())
+
+
+@pytest.mark.parametrize("code", [
+    "import mordor",
+    "from mordor import AppEnv",
+])
+def test_app_import_is_light(code):
+    modules = _imported_modules(code)
+    assert not [name for name in HEAVY_MODULES if name in modules]
+
+
+def test_cli_import_is_light():
+    modules = _imported_modules("import mordor.mordor")
+    assert "jinja2" not in modules
+    assert "yaml" not in modules
@@ -0,0 +1,27 @@
+import io
+
+import pytest
+
+from mordor.libs.timing import CountingWriter, Tracer
+
+
+def test_tracer():
+    tracer = Tracer()
+    received = []
+    tracer.add_listener(received.append)
+
+    with tracer.phase("upload", "h1") as event:
+        CountingWriter(io.BytesIO(), event).write(b"abc")
+    with pytest.raises(Exception):
+        with tracer.phase("extract", "h1"):
+            raise Exception("boom")
+
+    assert [(event.name, event.bytes, event.succeeded) for event in received] == [
+        ("upload", 3, True),
+        ("extract", None, False),
+    ]
+    assert received == tracer.events
+
+    trace = tracer.to_chrome_trace()
+    assert [event["name"] for event in trace["traceEvents"]] == ["thread_name", "upload", "extract"]
+    assert trace["traceEvents"][0]["args"] == {"name": "h1"}
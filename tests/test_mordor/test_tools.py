@@ -0,0 +1,20 @@
+import os
+
+from mordor.libs.tools import get_config_cached
+
+
+def test_get_config_cached(tmp_path, monkeypatch):
+    monkeypatch.setenv("MORDOR_CACHE_DIR", str(tmp_path / "cache"))
+    config_filename = tmp_path / "config.yaml"
+    config_filename.write_text("hosts:\n  h1:\n    env_home: /tmp\n")
+    st = os.stat(config_filename)
+    assert get_config_cached(str(config_filename)) == {"hosts": {"h1": {"env_home": "/tmp"}}}
+
+    # same location, mtime and size, served from the cache
+    config_filename.write_text("hosts:\n  h2:\n    env_home: /tmp\n")
+    os.utime(config_filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert get_config_cached(str(config_filename)) == {"hosts": {"h1": {"env_home": "/tmp"}}}
+
+    # mtime changed, parsed again
+    os.utime(config_filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert get_config_cached(str(config_filename)) == {"hosts": {"h2": {"env_home": "/tmp"}}}
@@ -0,0 +1,106 @@
+import os
+import subprocess
+
+import pytest
+
+from mordor.libs import HostConfig
+
+
+def test_transport_selection():
+    assert HostConfig("h1", {"env_home": "/tmp", "ssh_host": "localhost"}).is_local
+    assert HostConfig("localhost", {"env_home": "/tmp"}).is_local
+    assert not HostConfig("h1", {"env_home": "/tmp"}).is_local
+    assert HostConfig("h1", {"env_home": "/tmp", "transport": "local"}).is_local
+    assert not HostConfig("localhost", {"env_home": "/tmp", "transport": "ssh"}).is_local
+
+
+def test_local_host(tmp_path):
+    host = HostConfig("localhost", {"env_home": str(tmp_path / "env")})
+    source = tmp_path / "a.txt"
+    source.write_text("a\n")
+
+    host.execute("mkdir", "-p", host.path("bin"))
+    host.upload(str(source), host.path("bin"))
+    assert (tmp_path / "env" / "bin" / "a.txt").read_text() == "a\n"
+
+    # put_file links instead of copying
+    host.put_file(str(source), host.path("temp", "a.txt"))
+    assert os.path.samefile(source, host.path("temp", "a.txt"))
+
+    assert host.capture(f"cat {host.path('temp', 'a.txt')}") == (b"a\n", 0)
+    host.execute_batch([f"rm {host.path('temp', 'a.txt')}"])
+    assert source.is_file()
+
+
+def test_local_host_env_home_with_variables(tmp_path, monkeypatch):
+    # as in the samples, env_home is expanded by the shell of the host
+    monkeypatch.setenv("MORDOR_TEST_HOME", str(tmp_path))
+    host = HostConfig("localhost", {"env_home": "$MORDOR_TEST_HOME/env"})
+    source = tmp_path / "a.txt"
+    source.write_text("a\n")
+
+    host.execute("mkdir", "-p", host.path("bin"))
+    host.upload(str(source), host.path("bin", "a.txt"))
+    assert (tmp_path / "env" / "bin" / "a.txt").read_text() == "a\n"
+    host.put_file(str(source), host.path("temp", "a.txt"))
+    assert os.path.samefile(source, tmp_path / "env" / "temp" / "a.txt")
+
+
+def test_open_stream(tmp_path):
+    host = HostConfig("localhost", {"env_home": str(tmp_path)})
+    data = os.urandom(3*1024*1024)
+    with host.open_stream(f"cat > {tmp_path / 'a.bin'}") as stdin:
+        for offset in range(0, len(data), 100000):
+            stdin.write(data[offset:offset + 100000])
+    assert (tmp_path / "a.bin").read_bytes() == data
+
+    # the command failing fails the upload, even if it exits before reading everything
+    with pytest.raises(subprocess.CalledProcessError):
+        with host.open_stream("exit 3") as stdin:
+            stdin.write(data)
+            stdin.write(data)
+
+
+
+def test_ssh_multiplex(tmp_path, monkeypatch):
+    # stand-in for ssh, logs its args, starting the master connection exits with $MASTER_EXIT
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "ssh").write_text(
+        "#!/bin/bash\n"
+        "echo \"$*\" >> $SSH_LOG\n"
+        "case \"$*\" in *ControlMaster=yes*) exit ${MASTER_EXIT:-0};; esac\n"
+    )
+    os.chmod(tmp_path / "bin" / "ssh", 0o755)
+    monkeypatch.setenv("PATH", str(tmp_path / "bin") + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("SSH_LOG", str(tmp_path / "ssh.log"))
+
+    def pop_ssh_calls():
+        calls = (tmp_path / "ssh.log").read_text().splitlines()
+        (tmp_path / "ssh.log").write_text("")
+        return calls
+
+    # one master connection is shared by all commands, and closed with the host
+    host = HostConfig("h1", {"env_home": "/tmp"})
+    control_path = f"ControlPath={host.transport.control_path}"
+    for i in range(3):
+        args = host.transport.shell_args("true")
+        assert args[-2:] == ["h1", "true"] and "ControlMaster=no" in args and control_path in args
+    calls = pop_ssh_calls()
+    assert len(calls) == 1 and "ControlMaster=yes" in calls[0] and control_path in calls[0]
+    host.close()
+    assert pop_ssh_calls() == [f"-q -O exit -o {control_path} h1"]
+
+    # no multiplexing if the master connection cannot be started, it is only tried once
+    monkeypatch.setenv("MASTER_EXIT", "255")
+    host = HostConfig("h2", {"env_home": "/tmp"})
+    assert host.transport.shell_args("true") == ["ssh", "-q", "h2", "true"]
+    assert host.transport.shell_args("true") == ["ssh", "-q", "h2", "true"]
+    assert len(pop_ssh_calls()) == 1
+    host.close()
+    assert pop_ssh_calls() == []
+
+    # or if it is turned off for the host
+    host = HostConfig("h3", {"env_home": "/tmp", "ssh_multiplex": False})
+    assert host.transport.shell_args("true") == ["ssh", "-q", "h3", "true"]
+    assert host.ssh_options() == []
+    assert not (tmp_path / "ssh.log").read_text()
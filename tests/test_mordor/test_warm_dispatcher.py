@@ -0,0 +1,120 @@
+import base64
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+from mordor.libs import Config
+from mordor.mordor import run_app
+
+WARM_DISPATCHER = os.path.join(os.path.dirname(__file__), "..", "..", "src", "mordor", "bin", "warm_dispatcher.py")
+
+DISPATCH_PY = """\
+import os
+import sys
+import time
+
+def main():
+    print(VERSION, os.getppid(), *sys.argv[1:])
+    if len(sys.argv) > 2 and sys.argv[2] == "sleep":
+        time.sleep(float(sys.argv[3]))
+    sys.exit(int(sys.argv[1]))
+
+VERSION = "{version}"
+
+if __name__ == '__main__':
+    main()
+"""
+
+
+def _stage(env_home, version):
+    app_dir = env_home / "apps" / "sample" / version
+    app_dir.mkdir(parents=True)
+    (app_dir / "dispatch.py").write_text(DISPATCH_PY.format(version=version))
+    current = env_home / "apps" / "sample" / "current"
+    if os.path.lexists(current):
+        current.unlink()
+    current.symlink_to(app_dir)
+
+
+def _start(env_home, cmd):
+    return subprocess.Popen(
+        [sys.executable, WARM_DISPATCHER, "run", str(env_home), "sample", base64.b64encode(cmd.encode()).decode()],
+        stdout=subprocess.PIPE
+    )
+
+
+def _run(env_home, cmd):
+    p = _start(env_home, cmd)
+    stdout, _ = p.communicate(timeout=60)
+    return p.returncode, stdout.decode().split()
+
+
+def _stop(env_home):
+    pid_filename = env_home / "pids" / "sample" / "dispatcher.pid"
+    if pid_filename.exists():
+        os.kill(int(pid_filename.read_text()), signal.SIGTERM)
+
+
+def test_warm_dispatcher(tmp_path):
+    (tmp_path / "venvs" / "sample" / "bin").mkdir(parents=True)
+    (tmp_path / "venvs" / "sample" / "bin" / "python").symlink_to(sys.executable)
+    _stage(tmp_path, "1.0")
+    try:
+        exit_code, output = _run(tmp_path, "0 hello")
+        assert (exit_code, output[0], output[2:]) == (0, "1.0", ["0", "hello"])
+        daemon_pid = output[1]
+        # the same dispatcher runs the next command
+        exit_code, output = _run(tmp_path, "3")
+        assert (exit_code, output[0], output[1]) == (3, "1.0", daemon_pid)
+
+        # a new version gets a new dispatcher
+        _stage(tmp_path, "2.0")
+        exit_code, output = _run(tmp_path, "0")
+        assert (exit_code, output[0]) == (0, "2.0")
+        assert output[1] != daemon_pid
+    finally:
+        _stop(tmp_path)
+
+
+def test_warm_dispatcher_overlapping_commands(tmp_path):
+    (tmp_path / "venvs" / "sample" / "bin").mkdir(parents=True)
+    (tmp_path / "venvs" / "sample" / "bin" / "python").symlink_to(sys.executable)
+    _stage(tmp_path, "1.0")
+    try:
+        assert _run(tmp_path, "0")[0] == 0
+        start_time = time.time()
+        short = _start(tmp_path, "0 sleep 1")
+        time.sleep(0.3)
+        # forked while the short command runs, it must not keep the short one waiting
+        long = _start(tmp_path, "0 sleep 5")
+        assert short.wait(timeout=60) == 0
+        assert time.time() - start_time < 3
+        assert long.wait(timeout=60) == 0
+    finally:
+        _stop(tmp_path)
+
+
+def test_run_app_warm_env_home_with_variables(tmp_path, monkeypatch):
+    # as in the samples, env_home is expanded by the shell of the host
+    monkeypatch.setenv("HOME", str(tmp_path))
+    env_home = tmp_path / "mordor"
+    (env_home / "bin").mkdir(parents=True)
+    shutil.copy(WARM_DISPATCHER, env_home / "bin" / "warm_dispatcher.py")
+    (env_home / "venvs" / "sample" / "bin").mkdir(parents=True)
+    (env_home / "venvs" / "sample" / "bin" / "python").symlink_to(sys.executable)
+    _stage(env_home, "1.0")
+    config = Config({
+        "hosts": {"localhost": {"env_home": "$HOME/mordor"}},
+        "deployments": {
+            "sample_beta": {"name": "sample", "stage": "beta", "home_dir": str(tmp_path), "deploy_to": ["localhost"]}
+        }
+    }, str(tmp_path))
+    try:
+        results = run_app(config, "sample", "beta", cmd="3", warm=True)
+        assert [(result.exit_code, result.tail[-1].split()[0]) for result in results] == [(3, "1.0")]
+    finally:
+        _stop(env_home)
+        config.close()